@@ -0,0 +1,184 @@
+import glm
+import numpy as np
+import pygltflib
+
+# Components each animated path writes, morph target weights are not rendered
+PATH_WIDTHS = {
+    'translation': 3,
+    'rotation': 4,
+    'scale': 3
+}
+
+def compose_transforms(translations: np.ndarray, rotations: np.ndarray, scales: np.ndarray) -> np.ndarray:
+    # T * R * S for every node at once, stored transposed like DrawList.transforms
+    (x, y, z, w) = rotations.T
+    rotation = np.empty((len(rotations), 3, 3), np.float32)
+    rotation[:, 0, 0] = 1 - 2 * (y * y + z * z)
+    rotation[:, 0, 1] = 2 * (x * y - z * w)
+    rotation[:, 0, 2] = 2 * (x * z + y * w)
+    rotation[:, 1, 0] = 2 * (x * y + z * w)
+    rotation[:, 1, 1] = 1 - 2 * (x * x + z * z)
+    rotation[:, 1, 2] = 2 * (y * z - x * w)
+    rotation[:, 2, 0] = 2 * (x * z - y * w)
+    rotation[:, 2, 1] = 2 * (y * z + x * w)
+    rotation[:, 2, 2] = 1 - 2 * (x * x + y * y)
+
+    transforms = np.zeros((len(rotations), 4, 4), np.float32)
+    transforms[:, :3, :3] = (rotation * scales[:, None, :]).transpose(0, 2, 1)
+    transforms[:, 3, :3] = translations
+    transforms[:, 3, 3] = 1
+    return transforms
+
+class NodeHierarchy:
+    def __init__(self, gltf: pygltflib.GLTF2, root_transform: glm.mat4):
+        count = len(gltf.nodes)
+        self.parents = np.full(count, -1, np.int64)
+        self.translations = np.zeros((count, 3), np.float32)
+        self.rotations = np.zeros((count, 4), np.float32)
+        self.rotations[:, 3] = 1
+        self.scales = np.ones((count, 3), np.float32)
+        self.local = np.zeros((count, 4, 4), np.float32)
+        self.world = np.zeros((count, 4, 4), np.float32)
+        # glTF nodes with a matrix are never animated, their local transform is fixed
+        self.fixed = np.zeros(count, bool)
+        for (i, node) in enumerate(gltf.nodes):
+            if node.matrix:
+                self.local[i] = np.array(node.matrix, np.float32).reshape(4, 4)
+                self.fixed[i] = True
+            else:
+                if node.translation:
+                    self.translations[i] = node.translation
+                if node.rotation:
+                    self.rotations[i] = node.rotation
+                if node.scale:
+                    self.scales[i] = node.scale
+            self.parents[node.children] = i
+
+        # Nodes grouped by depth, so a whole level is multiplied with its parents in one call
+        self.levels = []
+        level = list(gltf.scenes[gltf.scene].nodes)
+        while level:
+            self.levels.append(np.array(level, np.int64))
+            level = [child for node in level for child in gltf.nodes[node].children]
+
+        self.root = np.array(root_transform.to_list(), np.float32)
+        self.changed = np.ones(count, bool)
+        self.pending = True
+        self.update()
+
+    def set_root(self, transform: glm.mat4):
+        self.root = np.array(transform.to_list(), np.float32)
+        if len(self.levels):
+            self.changed[self.levels[0]] = True
+            self.pending = True
+
+    def set(self, path: str, nodes: np.ndarray, values: np.ndarray):
+        target = getattr(self, path + 's')
+        # Channels holding a pose don't dirty anything
+        moved = (target[nodes] != values).any(axis=1)
+        if not moved.any():
+            return
+        target[nodes[moved]] = values[moved]
+        self.changed[nodes[moved]] = True
+        self.pending = True
+
+    def update(self) -> np.ndarray:
+        if not self.pending:
+            return np.zeros(0, np.int64)
+
+        recompose = np.flatnonzero(self.changed & ~self.fixed)
+        self.local[recompose] = compose_transforms(self.translations[recompose], self.rotations[recompose], self.scales[recompose])
+
+        # Dirty flags flow down one level at a time, clean subtrees are never touched
+        dirty = self.changed
+        updated = []
+        for (depth, level) in enumerate(self.levels):
+            if depth > 0:
+                dirty[level] |= dirty[self.parents[level]]
+            nodes = level[dirty[level]]
+            if len(nodes) == 0:
+                continue
+            parents = self.root if depth == 0 else self.world[self.parents[nodes]]
+            self.world[nodes] = self.local[nodes] @ parents
+            updated.append(nodes)
+
+        self.changed = np.zeros(len(self.changed), bool)
+        self.pending = False
+        return np.concatenate(updated) if updated else np.zeros(0, np.int64)
+
+class ChannelGroup:
+    # Every channel of one path in a clip, padded to the longest sampler so one set of numpy calls samples them all
+    def __init__(self, path: str, channels: list[tuple]):
+        width = PATH_WIDTHS[path]
+        count = len(channels)
+        keys = max(len(times) for (_, _, times, _) in channels)
+        self.path = path
+        self.nodes = np.array([node for (node, _, _, _) in channels], np.int64)
+        self.key_counts = np.array([len(times) for (_, _, times, _) in channels], np.int64)
+        self.times = np.full((count, keys), np.inf, np.float32)
+        # In-tangent, value and out-tangent per key, only cubic splines use the tangents
+        self.values = np.zeros((count, keys, 3, width), np.float32)
+        self.step = np.array([interpolation == 'STEP' for (_, interpolation, _, _) in channels])
+        self.cubic = np.array([interpolation == 'CUBICSPLINE' for (_, interpolation, _, _) in channels])
+        for (i, (_, interpolation, times, values)) in enumerate(channels):
+            self.times[i, :len(times)] = times
+            if interpolation == 'CUBICSPLINE':
+                self.values[i, :len(times)] = values.reshape(len(times), 3, width)
+            else:
+                self.values[i, :len(times), 1] = values
+
+    def sample(self, time: float) -> np.ndarray:
+        rows = np.arange(len(self.nodes))
+        first = np.clip((self.times <= time).sum(axis=1) - 1, 0, self.key_counts - 1)
+        second = np.minimum(first + 1, self.key_counts - 1)
+        start = self.times[rows, first]
+        span = self.times[rows, second] - start
+        alpha = np.where(span > 0, np.clip((time - start) / np.where(span > 0, span, 1), 0, 1), 0)[:, None]
+        a = self.values[rows, first, 1]
+        b = self.values[rows, second, 1]
+
+        if self.path == 'rotation':
+            # Slerp along the shorter arc, nearly parallel quaternions fall back to a lerp
+            dot = (a * b).sum(axis=1, keepdims=True)
+            b = np.where(dot < 0, -b, b)
+            angle = np.arccos(np.clip(np.abs(dot), 0, 1))
+            sin = np.sin(angle)
+            near = sin < 1e-5
+            safe_sin = np.where(near, 1, sin)
+            weight_a = np.where(near, 1 - alpha, np.sin((1 - alpha) * angle) / safe_sin)
+            weight_b = np.where(near, alpha, np.sin(alpha * angle) / safe_sin)
+            values = a * weight_a + b * weight_b
+        else:
+            values = a + (b - a) * alpha
+
+        values = np.where(self.step[:, None], a, values)
+        if self.cubic.any():
+            t2 = alpha * alpha
+            t3 = t2 * alpha
+            out_tangent = self.values[rows, first, 2] * span[:, None]
+            in_tangent = self.values[rows, second, 0] * span[:, None]
+            spline = (2 * t3 - 3 * t2 + 1) * a + (t3 - 2 * t2 + alpha) * out_tangent + (-2 * t3 + 3 * t2) * self.values[rows, second, 1] + (t3 - t2) * in_tangent
+            values = np.where(self.cubic[:, None], spline, values)
+
+        if self.path == 'rotation':
+            values /= np.maximum(np.linalg.norm(values, axis=1, keepdims=True), 1e-12)
+        return values
+
+class AnimationClip:
+    def __init__(self, animation: pygltflib.Animation, samplers: list[tuple]):
+        self.name = animation.name
+        channels = {}
+        for channel in animation.channels:
+            if channel.target.node is None or channel.target.path not in PATH_WIDTHS:
+                continue
+            sampler = animation.samplers[channel.sampler]
+            (times, values) = samplers[channel.sampler]
+            channels.setdefault(channel.target.path, []).append((channel.target.node, sampler.interpolation or 'LINEAR', times, values))
+        self.groups = [ChannelGroup(path, path_channels) for (path, path_channels) in channels.items()]
+        self.duration = max((float(group.times[np.arange(len(group.nodes)), group.key_counts - 1].max()) for group in self.groups), default=0)
+
+    def apply(self, hierarchy: NodeHierarchy, time: float):
+        if self.duration > 0:
+            time %= self.duration
+        for group in self.groups:
+            hierarchy.set(group.path, group.nodes, group.sample(time))
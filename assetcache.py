@@ -0,0 +1,71 @@
+import hashlib
+import json
+import os
+import pickle
+import shutil
+import threading
+import numpy as np
+
+# Bump whenever the layout of cached assets changes
+CACHE_VERSION = 8
+
+class CacheEntry:
+    def __init__(self, directory: str, manifest: dict):
+        self.directory = directory
+        self.manifest = manifest
+
+    def array(self, name: str) -> np.ndarray:
+        return np.load(os.path.join(self.directory, name + '.npy'), mmap_mode='r')
+
+    def load_object(self, name: str):
+        with open(os.path.join(self.directory, name + '.pickle'), 'rb') as file:
+            return pickle.load(file)
+
+class AssetCache:
+    def __init__(self, directory: str = '.glview_cache'):
+        self.directory = directory
+        self.hits = []
+        self.misses = []
+        self.lock = threading.Lock()
+
+    def key(self, filename: str, variant: str = '', dependencies: list[str] = ()) -> str:
+        digest = hashlib.sha256(b'glview-cache-%i-%s' % (CACHE_VERSION, variant.encode()))
+        for path in [filename, *dependencies]:
+            with open(path, 'rb') as file:
+                for chunk in iter(lambda: file.read(1 << 20), b''):
+                    digest.update(chunk)
+        return digest.hexdigest()
+
+    def lookup(self, filename: str, key: str) -> CacheEntry:
+        directory = os.path.join(self.directory, key)
+        try:
+            with open(os.path.join(directory, 'manifest.json')) as file:
+                manifest = json.load(file)
+        except (OSError, ValueError):
+            manifest = None
+
+        with self.lock:
+            (self.hits if manifest is not None else self.misses).append(filename)
+        return CacheEntry(directory, manifest) if manifest is not None else None
+
+    def store(self, key: str, manifest: dict, arrays: dict, objects: dict = None):
+        directory = os.path.join(self.directory, key)
+        temp_directory = '%s.%i.%i.tmp' % (directory, os.getpid(), threading.get_ident())
+        os.makedirs(temp_directory, exist_ok=True)
+        for (name, array) in arrays.items():
+            np.save(os.path.join(temp_directory, name + '.npy'), array)
+        for (name, obj) in (objects or {}).items():
+            with open(os.path.join(temp_directory, name + '.pickle'), 'wb') as file:
+                pickle.dump(obj, file, pickle.HIGHEST_PROTOCOL)
+        with open(os.path.join(temp_directory, 'manifest.json'), 'w') as file:
+            json.dump(manifest, file)
+
+        # Rename last so an interrupted write never shows up as a hit
+        try:
+            os.rename(temp_directory, directory)
+        except OSError:
+            shutil.rmtree(temp_directory, ignore_errors=True)
+
+    def report(self) -> str:
+        with self.lock:
+            return 'Asset cache: %i hits, %i misses' % (len(self.hits), len(self.misses))
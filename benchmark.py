@@ -0,0 +1,257 @@
+import argparse
+import ctypes
+import json
+import os
+import subprocess
+import sys
+import time
+
+parser = argparse.ArgumentParser(description='Render a scene offscreen along a camera path and report frame timings as JSON')
+parser.add_argument('model', help='glTF/GLB file to load')
+parser.add_argument('--skybox', default='skybox_texture.jpg')
+parser.add_argument('--path', help='camera path recorded with main.py --record, defaults to an orbit around the model')
+parser.add_argument('--frames', type=int, default=300)
+parser.add_argument('--warmup', type=int, default=10)
+parser.add_argument('--width', type=int, default=1280)
+parser.add_argument('--height', type=int, default=720)
+parser.add_argument('--platform', choices=['egl', 'osmesa'], default='egl')
+parser.add_argument('--occlusion', action='store_true', help='enable occlusion culling against the previous frame\'s depth')
+parser.add_argument('--quantize', action='store_true', help='quantize normals and texture coordinates at load time')
+parser.add_argument('--texture-budget', type=float, default=256, help='texture memory budget in MB')
+parser.add_argument('--render-scale', type=float, default=1.0, help='offscreen render resolution relative to the output')
+parser.add_argument('--frame-budget', type=float, default=0, help='GPU frame time in ms the render scale is adjusted to hold, 0 keeps it fixed')
+parser.add_argument('--capture', help='write every frame to this directory through asynchronous readback instead of timing frames one by one')
+parser.add_argument('--capture-format', choices=['png', 'raw'], default='png', help='png, or raw top-down RGB8 frames')
+parser.add_argument('--copies', type=int, default=0, help='extra placements of the model in a row beside it, sharing its GPU resources')
+parser.add_argument('--output', help='write the JSON report here instead of stdout')
+parser.add_argument('--trace', help='also write a Chrome trace of the measured frames')
+args = parser.parse_args()
+
+# Animations advance by this much per rendered frame, independent of how long frames take
+ANIMATION_STEP = 1 / 60
+
+# PyOpenGL picks its platform when OpenGL is first imported
+os.environ['PYOPENGL_PLATFORM'] = args.platform
+if args.platform == 'egl':
+    os.environ.setdefault('EGL_PLATFORM', 'surfaceless')
+
+from OpenGL import GL
+
+from scene import Scene
+from lights import Light
+from objects import Camera, GltfObject, Skybox
+from camerapath import CameraPath
+from capture import FrameCapture
+from loader import peak_rss_mb
+from geometry import geometry_summary
+
+import glm
+import numpy as np
+
+def create_egl_context(width: int, height: int):
+    from OpenGL import EGL
+
+    display = EGL.eglGetDisplay(EGL.EGL_DEFAULT_DISPLAY)
+    if not EGL.eglInitialize(display, None, None):
+        raise RuntimeError('eglInitialize failed')
+
+    config = EGL.EGLConfig()
+    config_count = EGL.EGLint()
+    attributes = (EGL.EGLint * 5)(EGL.EGL_SURFACE_TYPE, EGL.EGL_PBUFFER_BIT, EGL.EGL_RENDERABLE_TYPE, EGL.EGL_OPENGL_BIT, EGL.EGL_NONE)
+    EGL.eglChooseConfig(display, attributes, ctypes.pointer(config), 1, ctypes.pointer(config_count))
+    if config_count.value == 0:
+        raise RuntimeError('No EGL config with desktop OpenGL support')
+
+    EGL.eglBindAPI(EGL.EGL_OPENGL_API)
+    context_attributes = (EGL.EGLint * 7)(EGL.EGL_CONTEXT_MAJOR_VERSION, 4, EGL.EGL_CONTEXT_MINOR_VERSION, 1, EGL.EGL_CONTEXT_OPENGL_PROFILE_MASK, EGL.EGL_CONTEXT_OPENGL_COMPATIBILITY_PROFILE_BIT, EGL.EGL_NONE)
+    context = EGL.eglCreateContext(display, config, EGL.EGL_NO_CONTEXT, context_attributes)
+    if context == EGL.EGL_NO_CONTEXT:
+        raise RuntimeError('eglCreateContext failed')
+    EGL.eglMakeCurrent(display, EGL.EGL_NO_SURFACE, EGL.EGL_NO_SURFACE, context)
+    return context
+
+def create_osmesa_context(width: int, height: int):
+    from OpenGL import osmesa
+
+    attributes = (ctypes.c_int * 9)(osmesa.OSMESA_FORMAT, osmesa.OSMESA_RGBA, osmesa.OSMESA_CONTEXT_MAJOR_VERSION, 4, osmesa.OSMESA_CONTEXT_MINOR_VERSION, 1, osmesa.OSMESA_PROFILE, osmesa.OSMESA_COMPAT_PROFILE, 0)
+    context = osmesa.OSMesaCreateContextAttribs(attributes, None)
+    if not context:
+        raise RuntimeError('OSMesaCreateContextAttribs failed')
+    buffer = (GL.GLubyte * (width * height * 4))()
+    osmesa.OSMesaMakeCurrent(context, buffer, GL.GL_UNSIGNED_BYTE, width, height)
+    return (context, buffer)
+
+def create_framebuffer(width: int, height: int) -> int:
+    color = GL.glGenRenderbuffers(1)
+    GL.glBindRenderbuffer(GL.GL_RENDERBUFFER, color)
+    GL.glRenderbufferStorage(GL.GL_RENDERBUFFER, GL.GL_RGBA8, width, height)
+    fbo = GL.glGenFramebuffers(1)
+    GL.glBindFramebuffer(GL.GL_FRAMEBUFFER, fbo)
+    GL.glFramebufferRenderbuffer(GL.GL_FRAMEBUFFER, GL.GL_COLOR_ATTACHMENT0, GL.GL_RENDERBUFFER, color)
+    return fbo
+
+def percentiles(samples: list[float]) -> dict:
+    if not samples:
+        return {}
+    values = np.array(samples) * 1000
+    return {
+        'mean': float(values.mean()),
+        'p50': float(np.percentile(values, 50)),
+        'p95': float(np.percentile(values, 95)),
+        'p99': float(np.percentile(values, 99)),
+        'max': float(values.max())
+    }
+
+def git_revision() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+context = (create_egl_context if args.platform == 'egl' else create_osmesa_context)(args.width, args.height)
+fbo = create_framebuffer(args.width, args.height)
+
+camera = Camera(glm.vec3(0, .5, 0), 50)
+light = Light(glm.vec3(8, 8, -11), 2000.0)
+gltf_object = GltfObject(args.model, quantize=args.quantize)
+scene = Scene([gltf_object], camera, [light], Skybox(args.skybox), occlusion_culling=args.occlusion, texture_budget=int(args.texture_budget * (1 << 20)), render_scale=args.render_scale, target_frame_time=args.frame_budget / 1000)
+
+load_start_time = time.perf_counter()
+scene.init_gl(args.width, args.height)
+scene.wait_for_assets()
+extent = float(gltf_object.bounds_max.max(axis=0)[0] - gltf_object.bounds_min.min(axis=0)[0])
+for copy in range(args.copies):
+    scene.spawn(gltf_object, glm.translate(glm.vec3(extent * (copy + 1), 0, 0)))
+GL.glFinish()
+load_time = time.perf_counter() - load_start_time
+load_timings = {name: {stage: seconds * 1000 for (stage, seconds) in timings.items()} for (name, timings, _) in scene.loader.take_completed()}
+
+if args.path:
+    path = CameraPath.load(args.path)
+else:
+    center = glm.vec3(*((gltf_object.bounds_min.min(axis=0) + gltf_object.bounds_max.max(axis=0)) / 2))
+    radius = float(np.linalg.norm(gltf_object.bounds_max.max(axis=0) - gltf_object.bounds_min.min(axis=0))) / 2
+    path = CameraPath.orbit(args.frames, center, radius * .8, radius * .3, radius * .5, radius * .5)
+
+if args.trace:
+    scene.profiler.start_trace()
+
+time_query = int(np.atleast_1d(GL.glGenQueries(1))[0])
+submit_times = []
+gpu_times = []
+frame_times = []
+pass_times = {}
+pass_gpu_times = {}
+capture = None
+if args.capture:
+    # Frames are submitted back to back, the readback ring and writer threads keep up without per-frame waits
+    scene.start_capture(FrameCapture(args.capture, args.capture_format))
+    for i in range(args.frames):
+        path.apply(i, camera, scene.lights)
+        scene.time = i * ANIMATION_STEP
+        GL.glBindFramebuffer(GL.GL_FRAMEBUFFER, fbo)
+        scene.render(args.width, args.height)
+    capture = scene.stop_capture()
+    print(capture.report(), file=sys.stderr)
+else:
+    for i in range(args.warmup + args.frames):
+        path.apply(i, camera, scene.lights)
+        scene.time = i * ANIMATION_STEP
+        GL.glBindFramebuffer(GL.GL_FRAMEBUFFER, fbo)
+
+        frame_start_time = time.perf_counter()
+        GL.glBeginQuery(GL.GL_TIME_ELAPSED, time_query)
+        scene.render(args.width, args.height)
+        GL.glEndQuery(GL.GL_TIME_ELAPSED)
+        submit_end_time = time.perf_counter()
+        GL.glFinish()
+        frame_end_time = time.perf_counter()
+        # The 32-bit result is nanoseconds, plenty for a single frame
+        gpu_time = int(GL.glGetQueryObjectuiv(time_query, GL.GL_QUERY_RESULT)) / 1e9
+
+        if i < args.warmup:
+            continue
+        submit_times.append(submit_end_time - frame_start_time)
+        frame_times.append(frame_end_time - frame_start_time)
+        gpu_times.append(gpu_time)
+        for (name, seconds) in scene.profiler.frame_times.items():
+            pass_times.setdefault(name, []).append(seconds)
+        for (name, seconds) in scene.profiler.gpu_times.items():
+            pass_gpu_times.setdefault(name, []).append(seconds)
+
+report = {
+    'model': args.model,
+    'revision': git_revision(),
+    'renderer': GL.glGetString(GL.GL_RENDERER).decode(),
+    'platform': args.platform,
+    'occlusion_culling': args.occlusion,
+    'quantize': args.quantize,
+    'resolution': [args.width, args.height],
+    'frames': args.frames,
+    'load_ms': load_time * 1000,
+    'load_stages_ms': load_timings,
+    'textures': {
+        'budget_mb': args.texture_budget,
+        'resident_mb': scene.texture_streamer.resident_bytes / (1 << 20),
+        'streaming_latency_ms': scene.texture_streamer.latency * 1000,
+        'uploads': scene.texture_streamer.uploads,
+        'evictions': scene.texture_streamer.evictions
+    },
+    'capture': {
+        'directory': args.capture,
+        'format': args.capture_format,
+        'frames': capture.frames_written,
+        'fps': capture.fps,
+        'stall_ms': capture.stall_time * 1000
+    } if capture else None,
+    'render_scale': {
+        'initial_scale': args.render_scale,
+        'frame_budget_ms': args.frame_budget,
+        'final_scale': scene.render_scale,
+        'scale_changes': scene.resolution.changes if scene.resolution else 0
+    },
+    'resources': {
+        'copies': args.copies,
+        'geometry_requested_mb': scene.resources.requested_bytes / (1 << 20),
+        'geometry_unique_mb': scene.resources.unique_bytes / (1 << 20),
+        'texture_requests': scene.resources.texture_requests,
+        'unique_textures': len(scene.resources.textures),
+        'texture_requested_mb': scene.resources.requested_texture_bytes / (1 << 20),
+        'texture_unique_mb': scene.resources.unique_texture_bytes / (1 << 20)
+    },
+    'shaders': {
+        'programs': len(scene.shader_cache.cache),
+        'compile_ms': scene.shader_cache.compile_time * 1000,
+        'binary_cache_hits': scene.shader_cache.binary_hits,
+        'binary_cache_misses': scene.shader_cache.binary_misses
+    },
+    'peak_rss_mb': peak_rss_mb(),
+    'geometry': geometry_summary(gltf_object.geometry_stats),
+    'frame_ms': percentiles(frame_times),
+    'cpu_submit_ms': percentiles(submit_times),
+    'gpu_ms': percentiles(gpu_times),
+    'passes_cpu_ms': {name: percentiles(samples) for (name, samples) in pass_times.items()},
+    'passes_gpu_ms': {name: percentiles(samples) for (name, samples) in pass_gpu_times.items()},
+    'stats': {
+        'visible_primitives': scene.visible_count,
+        'culled_primitives': scene.culled_count,
+        'occluded_primitives': scene.occluded_count,
+        'shadow_occluded_primitives': scene.profiler.counters['shadow_occluded'],
+        'state_changes': scene.profiler.counters['state_changes'],
+        'state_changes_skipped': scene.profiler.counters['state_changes_skipped'],
+        'uniform_blocks_written': scene.profiler.counters['uniform_blocks'],
+        'draw_calls': scene.profiler.counters['draw_calls'],
+        'triangles': scene.profiler.counters['triangles'],
+        'updated_nodes': scene.profiler.counters['updated_nodes']
+    }
+}
+
+if args.trace:
+    scene.profiler.write_trace(args.trace)
+
+if args.output:
+    with open(args.output, 'w') as file:
+        json.dump(report, file, indent=2)
+else:
+    json.dump(report, sys.stdout, indent=2)
+    print()
@@ -0,0 +1,55 @@
+from objects import Camera
+from lights import Light
+
+import glm
+import json
+import math
+
+class CameraPath:
+    def __init__(self, frames: list[dict] = None):
+        self.frames = frames or []
+
+    def __len__(self):
+        return len(self.frames)
+
+    @staticmethod
+    def load(filename: str) -> 'CameraPath':
+        with open(filename) as file:
+            return CameraPath(json.load(file)['frames'])
+
+    def save(self, filename: str):
+        with open(filename, 'w') as file:
+            json.dump({'frames': self.frames}, file)
+
+    @staticmethod
+    def orbit(frame_count: int, center: glm.vec3, radius: float, height: float, light_radius: float, light_height: float) -> 'CameraPath':
+        frames = []
+        for i in range(frame_count):
+            angle = 2 * math.pi * i / max(frame_count, 1)
+            position = center + glm.vec3(math.sin(angle) * radius, height, math.cos(angle) * radius)
+            direction = glm.normalize(center - position)
+            orientation = glm.vec3(-math.degrees(math.asin(direction.y)), math.degrees(math.atan2(direction.x, -direction.z)), 0)
+            light_position = center + glm.vec3(math.cos(angle * 3) * light_radius, light_height, math.sin(angle * 3) * light_radius)
+            frames.append({
+                'camera_position': list(position),
+                'camera_orientation': list(orientation),
+                'light_positions': [list(light_position)]
+            })
+        return CameraPath(frames)
+
+    def record(self, camera: Camera, lights: list[Light]):
+        self.frames.append({
+            'camera_position': list(camera.position),
+            'camera_orientation': list(camera.orientation),
+            'light_positions': [list(light.position) for light in lights]
+        })
+
+    def apply(self, index: int, camera: Camera, lights: list[Light]):
+        frame = self.frames[index % len(self.frames)]
+        camera.position = glm.vec3(*frame['camera_position'])
+        camera.orientation = glm.vec3(*frame['camera_orientation'])
+        for (light, position) in zip(lights, frame.get('light_positions', [])):
+            position = glm.vec3(*position)
+            if light.position != position:
+                light.position = position
+                light.need_shadow_render = True
@@ -0,0 +1,117 @@
+from OpenGL import GL
+from PIL import Image
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import ctypes
+import os
+import time
+import numpy as np
+
+# Pixel pack buffers cycled through, a frame is mapped this many frames after it was read
+CAPTURE_RING = 4
+# Frames encoded or waiting for an encoder before rendering waits for the writers
+MAX_PENDING_WRITES = 16
+# zlib level for PNG output, sequences are usually re-encoded into video afterwards
+PNG_COMPRESSION = 1
+IMAGE_FORMATS = ('png', 'raw')
+
+class FrameCapture:
+    def __init__(self, directory: str, image_format: str = 'png', ring_size: int = CAPTURE_RING, workers: int = None):
+        if image_format not in IMAGE_FORMATS:
+            raise ValueError('Unknown capture format %s' % image_format)
+        self.directory = directory
+        self.image_format = image_format
+        self.ring_size = ring_size
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='glview-capture')
+        self.writes = deque()
+        self.frame_index = 0
+        self.frames_written = 0
+        self.start_time = None
+        self.end_time = None
+        self.stall_time = 0
+
+    def init_gl(self):
+        os.makedirs(self.directory, exist_ok=True)
+        self.pixel_buffers = np.atleast_1d(GL.glGenBuffers(self.ring_size)).tolist()
+        self.buffer_sizes = [0] * self.ring_size
+        self.pending = [None] * self.ring_size
+
+    def read(self, fbo: int, width: int, height: int):
+        if self.start_time is None:
+            self.start_time = time.perf_counter()
+        slot = self.frame_index % self.ring_size
+        if self.pending[slot] is not None:
+            # Only when the GPU is a whole ring behind does the CPU wait for it
+            self.collect(slot)
+
+        size = width * height * 4
+        GL.glBindBuffer(GL.GL_PIXEL_PACK_BUFFER, self.pixel_buffers[slot])
+        if self.buffer_sizes[slot] != size:
+            GL.glBufferData(GL.GL_PIXEL_PACK_BUFFER, size, None, GL.GL_STREAM_READ)
+            self.buffer_sizes[slot] = size
+        GL.glBindFramebuffer(GL.GL_READ_FRAMEBUFFER, fbo)
+        GL.glReadPixels(0, 0, width, height, GL.GL_RGBA, GL.GL_UNSIGNED_BYTE, ctypes.c_void_p(0))
+        GL.glBindBuffer(GL.GL_PIXEL_PACK_BUFFER, 0)
+        self.pending[slot] = (GL.glFenceSync(GL.GL_SYNC_GPU_COMMANDS_COMPLETE, 0), self.frame_index, width, height)
+        self.frame_index += 1
+
+    def poll(self):
+        # Frames are collected in order, stopping at the first copy the GPU has not finished
+        for offset in range(self.ring_size):
+            slot = (self.frame_index + offset) % self.ring_size
+            if self.pending[slot] is None:
+                continue
+            if GL.glClientWaitSync(self.pending[slot][0], 0, 0) in (GL.GL_TIMEOUT_EXPIRED, GL.GL_WAIT_FAILED):
+                return
+            self.collect(slot)
+
+    def collect(self, slot: int):
+        (fence, index, width, height) = self.pending[slot]
+        self.pending[slot] = None
+        start_time = time.perf_counter()
+        GL.glClientWaitSync(fence, GL.GL_SYNC_FLUSH_COMMANDS_BIT, 10000000000)
+        GL.glDeleteSync(fence)
+
+        GL.glBindBuffer(GL.GL_PIXEL_PACK_BUFFER, self.pixel_buffers[slot])
+        pointer = GL.glMapBufferRange(GL.GL_PIXEL_PACK_BUFFER, 0, width * height * 4, GL.GL_MAP_READ_BIT)
+        pixels = np.empty((height, width, 4), np.uint8)
+        ctypes.memmove(pixels.ctypes.data, pointer, pixels.nbytes)
+        GL.glUnmapBuffer(GL.GL_PIXEL_PACK_BUFFER)
+        GL.glBindBuffer(GL.GL_PIXEL_PACK_BUFFER, 0)
+
+        while len(self.writes) >= MAX_PENDING_WRITES:
+            self.writes.popleft().result()
+        self.stall_time += time.perf_counter() - start_time
+        self.writes.append(self.executor.submit(self.write, index, pixels))
+
+    def write(self, index: int, pixels: np.ndarray):
+        # GL rows start at the bottom
+        pixels = np.ascontiguousarray(pixels[::-1, :, :3])
+        if self.image_format == 'png':
+            Image.fromarray(pixels).save(os.path.join(self.directory, 'frame_%05i.png' % index), compress_level=PNG_COMPRESSION)
+        else:
+            with open(os.path.join(self.directory, 'frame_%05i_%ix%i.rgb' % (index, pixels.shape[1], pixels.shape[0])), 'wb') as file:
+                file.write(pixels.tobytes())
+        self.frames_written += 1
+
+    def finish(self):
+        for offset in range(self.ring_size):
+            slot = (self.frame_index + offset) % self.ring_size
+            if self.pending[slot] is not None:
+                self.collect(slot)
+        while self.writes:
+            self.writes.popleft().result()
+        self.executor.shutdown()
+        self.end_time = time.perf_counter()
+
+    @property
+    def fps(self) -> float:
+        if self.start_time is None:
+            return 0
+        elapsed = (self.end_time or time.perf_counter()) - self.start_time
+        return self.frames_written / elapsed if elapsed > 0 else 0
+
+    def report(self) -> str:
+        return 'Captured %i frames to %s at %.1f fps, %.0fms waiting on readback and writers' % (self.frames_written, self.directory, self.fps, self.stall_time * 1000)
@@ -0,0 +1,269 @@
+import numpy as np
+
+try:
+    import DracoPy
+except ImportError:
+    DracoPy = None
+
+MESHOPT_EXTENSIONS = ('EXT_meshopt_compression', 'KHR_meshopt_compression')
+DRACO_EXTENSION = 'KHR_draco_mesh_compression'
+
+# Bitstream constants from the EXT_meshopt_compression specification, which defines version 0 vertex streams and version 0 and 1 index streams
+VERTEX_HEADER = 0xa0
+TRIANGLES_HEADER = 0xe0
+SEQUENCE_HEADER = 0xd0
+VERTEX_BLOCK_BYTES = 8192
+VERTEX_BLOCK_MAX_SIZE = 256
+BYTE_GROUP_SIZE = 16
+TAIL_MIN_SIZE = 32
+
+INDEX_WIDTHS = {
+    2: np.uint16,
+    4: np.uint32
+}
+
+UNZIGZAG = np.array([((value >> 1) ^ -(value & 1)) & 0xff for value in range(256)], np.uint8)
+# 2 and 4 bit deltas are packed most significant bits first
+GROUP_UNPACK = {
+    1: [((byte >> 6) & 3, (byte >> 4) & 3, (byte >> 2) & 3, byte & 3) for byte in range(256)],
+    2: [(byte >> 4, byte & 15) for byte in range(256)]
+}
+
+def meshopt_extension(view) -> dict:
+    extensions = view.extensions or {}
+    return next((extensions[name] for name in MESHOPT_EXTENSIONS if name in extensions), None)
+
+def decode_byte_groups(data: bytes, position: int, size: int) -> tuple[bytearray, int]:
+    groups = size // BYTE_GROUP_SIZE
+    header = data[position:position + (groups + 3) // 4]
+    position += len(header)
+    output = bytearray(size)
+    for group in range(groups):
+        mode = (header[group // 4] >> (group % 4 * 2)) & 3
+        start = group * BYTE_GROUP_SIZE
+        if mode == 0:
+            continue
+        if mode == 3:
+            output[start:start + BYTE_GROUP_SIZE] = data[position:position + BYTE_GROUP_SIZE]
+            position += BYTE_GROUP_SIZE
+            continue
+
+        # Deltas too large for the bit width are stored whole after the packed bytes, marked by an all ones value
+        packed = 2 << mode
+        sentinel = (1 << (1 << mode)) - 1
+        table = GROUP_UNPACK[mode]
+        values = [value for byte in data[position:position + packed] for value in table[byte]]
+        position += packed
+        for (i, value) in enumerate(values):
+            if value == sentinel:
+                value = data[position]
+                position += 1
+            output[start + i] = value
+    return (output, position)
+
+def decode_vertex_buffer(data: bytes, count: int, stride: int) -> np.ndarray:
+    if len(data) < 1 + stride or data[0] & 0xf0 != VERTEX_HEADER:
+        raise ValueError('Invalid meshopt vertex stream')
+    if data[0] & 0x0f:
+        raise ValueError('Unsupported meshopt vertex stream version %i' % (data[0] & 0x0f))
+
+    # The tail holds the vertex the first deltas are relative to
+    last = np.frombuffer(data, np.uint8, stride, len(data) - stride)
+    block_size = min(VERTEX_BLOCK_BYTES // stride & ~(BYTE_GROUP_SIZE - 1), VERTEX_BLOCK_MAX_SIZE)
+    output = np.empty((count, stride), np.uint8)
+    position = 1
+    for start in range(0, count, block_size):
+        size = min(block_size, count - start)
+        aligned = (size + BYTE_GROUP_SIZE - 1) & ~(BYTE_GROUP_SIZE - 1)
+        # Every byte of the vertex is its own column of zigzag deltas
+        deltas = np.empty((stride, aligned), np.uint8)
+        for k in range(stride):
+            (column, position) = decode_byte_groups(data, position, aligned)
+            deltas[k] = np.frombuffer(column, np.uint8)
+        block = np.cumsum(UNZIGZAG[deltas[:, :size].T], axis=0, dtype=np.uint8) + last
+        output[start:start + size] = block
+        last = block[-1]
+
+    if len(data) - position != max(stride, TAIL_MIN_SIZE):
+        raise ValueError('Invalid meshopt vertex stream')
+    return output
+
+def read_varint(data: bytes, position: int) -> tuple[int, int]:
+    value = 0
+    for shift in range(0, 35, 7):
+        if position >= len(data):
+            raise ValueError('Truncated meshopt index stream')
+        byte = data[position]
+        position += 1
+        value |= (byte & 127) << shift
+        if byte < 128:
+            break
+    return (value & 0xffffffff, position)
+
+def decode_index(data: bytes, position: int, last: int) -> tuple[int, int]:
+    (value, position) = read_varint(data, position)
+    return ((last + ((value >> 1) ^ -(value & 1))) & 0xffffffff, position)
+
+def decode_index_buffer(data: bytes, count: int) -> np.ndarray:
+    if len(data) < 1 + count // 3 + 16 or data[0] & 0xf0 != TRIANGLES_HEADER or data[0] & 0x0f > 1:
+        raise ValueError('Invalid meshopt index stream')
+    # Version 1 streams spend vertex FIFO entries 13 and 14 on small deltas from the last explicit index
+    fifo_limit = 13 if data[0] & 0x0f else 15
+    codes = data[1:1 + count // 3]
+    aux_table = data[-16:]
+    position = 1 + count // 3
+
+    edges = [(0, 0)] * 16
+    vertices = [0] * 16
+    edge_offset = 0
+    vertex_offset = 0
+    next_index = 0
+    last = 0
+    output = []
+    for code in codes:
+        if code < 0xf0:
+            # Triangle sharing an edge with a recent one
+            (a, b) = edges[(edge_offset - 1 - (code >> 4)) & 15]
+            fc = code & 15
+            if fc < fifo_limit:
+                c = next_index if fc == 0 else vertices[(vertex_offset - 1 - fc) & 15]
+                if fc == 0:
+                    vertices[vertex_offset] = c
+                    vertex_offset = (vertex_offset + 1) & 15
+                    next_index += 1
+            else:
+                if fc == 15:
+                    (c, position) = decode_index(data, position, last)
+                else:
+                    c = (last + fc - (fc ^ 3)) & 0xffffffff
+                last = c
+                vertices[vertex_offset] = c
+                vertex_offset = (vertex_offset + 1) & 15
+            output += (a, b, c)
+            edges[edge_offset] = (c, b)
+            edges[(edge_offset + 1) & 15] = (a, c)
+            edge_offset = (edge_offset + 2) & 15
+            continue
+
+        if code < 0xfe:
+            # Common vertex reuse patterns are looked up in the table at the end of the stream
+            aux = aux_table[code & 15]
+            (fa, fb, fc) = (0, aux >> 4, aux & 15)
+        else:
+            aux = data[position]
+            position += 1
+            (fa, fb, fc) = (0 if code == 0xfe else 15, aux >> 4, aux & 15)
+            if aux == 0:
+                next_index = 0
+
+        corners = []
+        for fifo_index in (fa, fb, fc):
+            if fifo_index == 0:
+                corners.append(next_index)
+                next_index += 1
+            elif fifo_index == 15:
+                corners.append(None)
+            else:
+                corners.append(vertices[(vertex_offset - fifo_index) & 15])
+        for (i, fifo_index) in enumerate((fa, fb, fc)):
+            if fifo_index == 15:
+                (corners[i], position) = decode_index(data, position, last)
+                last = corners[i]
+        (a, b, c) = corners
+        output += corners
+        for (i, fifo_index) in enumerate((fa, fb, fc)):
+            if i == 0 or fifo_index in (0, 15):
+                vertices[vertex_offset] = corners[i]
+                vertex_offset = (vertex_offset + 1) & 15
+        for edge in ((b, a), (c, b), (a, c)):
+            edges[edge_offset] = edge
+            edge_offset = (edge_offset + 1) & 15
+
+    if position > len(data) - 16:
+        raise ValueError('Invalid meshopt index stream')
+    return np.array(output, np.uint32)
+
+def decode_index_sequence(data: bytes, count: int) -> np.ndarray:
+    if len(data) < 1 + count + 4 or data[0] & 0xf0 != SEQUENCE_HEADER or data[0] & 0x0f > 1:
+        raise ValueError('Invalid meshopt index sequence')
+    # Deltas alternate between two baselines, the low bit picks one
+    last = [0, 0]
+    output = np.empty(count, np.uint32)
+    position = 1
+    for i in range(count):
+        (value, position) = read_varint(data, position)
+        baseline = value & 1
+        value >>= 1
+        last[baseline] = (last[baseline] + ((value >> 1) ^ -(value & 1))) & 0xffffffff
+        output[i] = last[baseline]
+
+    # Decoding must stop before the 4 byte tail
+    if position > len(data) - 4:
+        raise ValueError('Invalid meshopt index sequence')
+    return output
+
+def round_away(values: np.ndarray) -> np.ndarray:
+    return np.trunc(values + np.where(values >= 0, np.float32(.5), np.float32(-.5)))
+
+def filter_octahedral(values: np.ndarray) -> np.ndarray:
+    # x and y are octahedral coordinates scaled by the third component, the fourth passes through
+    one = np.float32(np.iinfo(values.dtype).max)
+    x = values[:, 0].astype(np.float32)
+    y = values[:, 1].astype(np.float32)
+    z = values[:, 2] - np.abs(x) - np.abs(y)
+    t = np.minimum(z, 0)
+    x += np.where(x >= 0, t, -t)
+    y += np.where(y >= 0, t, -t)
+    scale = one / np.sqrt(x * x + y * y + z * z)
+    result = values.copy()
+    for (i, component) in enumerate((x, y, z)):
+        result[:, i] = round_away(component * scale)
+    return result
+
+def filter_quaternion(values: np.ndarray) -> np.ndarray:
+    # Three smallest components, the low bits of the fourth say which one was dropped and the rest scale them
+    scale = np.float32(1 / np.sqrt(2)) / (values[:, 3] | 3).astype(np.float32)
+    (x, y, z) = (values[:, :3] * scale[:, None]).T
+    w = np.sqrt(np.maximum(1 - x * x - y * y - z * z, 0))
+    dropped = (values[:, 3] & 3).astype(np.int64)
+    rows = np.arange(len(values))
+    result = np.empty_like(values)
+    for (offset, component) in enumerate((w, x, y, z)):
+        result[rows, (dropped + offset) & 3] = round_away(component * np.float32(32767))
+    return result
+
+def filter_exponential(values: np.ndarray) -> np.ndarray:
+    # Signed 8 bit exponent above a signed 24 bit mantissa
+    return np.ldexp(((values << 8) >> 8).astype(np.float32), (values >> 24).astype(np.int32)).astype(np.float32)
+
+def decode_meshopt_view(extension: dict, buffers: list) -> np.ndarray:
+    offset = extension.get('byteOffset', 0)
+    data = bytes(buffers[extension['buffer']][offset:offset + extension['byteLength']])
+    (count, stride, mode) = (extension['count'], extension['byteStride'], extension['mode'])
+    if mode == 'ATTRIBUTES':
+        values = decode_vertex_buffer(data, count, stride)
+        filter_name = extension.get('filter', 'NONE')
+        if filter_name == 'OCTAHEDRAL':
+            values = filter_octahedral(values.view(np.int8 if stride == 4 else np.int16))
+        elif filter_name == 'QUATERNION':
+            values = filter_quaternion(values.view(np.int16))
+        elif filter_name == 'EXPONENTIAL':
+            values = filter_exponential(values.view(np.int32))
+        elif filter_name != 'NONE':
+            raise ValueError('Unknown meshopt filter %s' % filter_name)
+    elif mode == 'TRIANGLES':
+        values = decode_index_buffer(data, count).astype(INDEX_WIDTHS[stride])
+    elif mode == 'INDICES':
+        values = decode_index_sequence(data, count).astype(INDEX_WIDTHS[stride])
+    else:
+        raise ValueError('Unknown meshopt mode %s' % mode)
+    return np.ascontiguousarray(values).reshape(-1).view(np.uint8)
+
+def decode_draco(data: bytes, attributes: dict) -> dict:
+    if DracoPy is None:
+        raise RuntimeError('%s needs the DracoPy package' % DRACO_EXTENSION)
+    mesh = DracoPy.decode(bytes(data))
+    # Attributes come back per point as floats, Draco dequantizes them itself
+    decoded = {semantic: np.asarray(mesh.get_attribute_by_unique_id(unique_id)['data'], np.float32) for (semantic, unique_id) in attributes.items()}
+    decoded['indices'] = np.asarray(mesh.faces, np.uint32).ravel()
+    return decoded
@@ -0,0 +1,144 @@
+import glm
+import numpy as np
+
+def frustum_planes(view_projection: glm.mat4) -> np.ndarray:
+    m = np.array(view_projection, np.float64)
+    planes = np.array([
+        m[3] + m[0],
+        m[3] - m[0],
+        m[3] + m[1],
+        m[3] - m[1],
+        m[3] + m[2],
+        m[3] - m[2],
+    ])
+    return planes / np.linalg.norm(planes[:, :3], axis=1)[:, None]
+
+def transform_bounds(bounds_min: np.ndarray, bounds_max: np.ndarray, transforms: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    # Center and half extents through the matrix give the same box as transforming all eight corners
+    centers = (bounds_min + bounds_max) / 2
+    extents = (bounds_max - bounds_min) / 2
+    rotations = transforms[:, :3, :3]
+    world_centers = np.matmul(centers[:, None, :], rotations)[:, 0] + transforms[:, 3, :3]
+    world_extents = np.matmul(extents[:, None, :], np.abs(rotations))[:, 0]
+    return (world_centers - world_extents, world_centers + world_extents)
+
+def expand_ranges(starts: np.ndarray, counts: np.ndarray) -> np.ndarray:
+    total = counts.sum()
+    if total == 0:
+        return np.zeros(0, np.int64)
+    offsets = np.cumsum(counts) - counts
+    return np.repeat(starts - offsets, counts) + np.arange(total)
+
+def boxes_vs_planes(centers: np.ndarray, extents: np.ndarray, planes: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    distance = centers @ planes[:, :3].T + planes[:, 3]
+    radius = extents @ np.abs(planes[:, :3]).T
+    outside = (distance < -radius).any(axis=1)
+    inside = (distance >= radius).all(axis=1)
+    return (outside, inside)
+
+class BVH:
+    def __init__(self, bounds_min: np.ndarray, bounds_max: np.ndarray, leaf_size: int = 8):
+        self.item_centers = (bounds_min + bounds_max) / 2
+        self.item_extents = (bounds_max - bounds_min) / 2
+        self.items = np.arange(len(bounds_min))
+        self.leaf_size = leaf_size
+        self.occluded_count = 0
+
+        self.node_min = []
+        self.node_max = []
+        self.node_start = []
+        self.node_count = []
+        self.node_left = []
+        self.node_right = []
+        self.node_depth = []
+        if len(bounds_min) > 0:
+            self.build(bounds_min, bounds_max, 0, len(bounds_min))
+
+        self.node_min = np.array(self.node_min, np.float32).reshape(-1, 3)
+        self.node_max = np.array(self.node_max, np.float32).reshape(-1, 3)
+        self.node_centers = (self.node_min + self.node_max) / 2
+        self.node_extents = (self.node_max - self.node_min) / 2
+        self.node_start = np.array(self.node_start, np.int64)
+        self.node_count = np.array(self.node_count, np.int64)
+        self.node_left = np.array(self.node_left, np.int64)
+        self.node_right = np.array(self.node_right, np.int64)
+        self.node_depth = np.array(self.node_depth, np.int64)
+        leaves = np.flatnonzero(self.node_left == -1)
+        self.leaves = leaves[np.argsort(self.node_start[leaves])]
+        self.internal_levels = [np.flatnonzero((self.node_depth == depth) & (self.node_left != -1)) for depth in range(int(self.node_depth.max(initial=0)), -1, -1)]
+
+    def build(self, bounds_min: np.ndarray, bounds_max: np.ndarray, start: int, end: int, depth: int = 0) -> int:
+        items = self.items[start:end]
+        node = len(self.node_start)
+        self.node_min.append(bounds_min[items].min(axis=0))
+        self.node_max.append(bounds_max[items].max(axis=0))
+        self.node_start.append(start)
+        self.node_count.append(end - start)
+        self.node_left.append(-1)
+        self.node_right.append(-1)
+        self.node_depth.append(depth)
+
+        if end - start <= self.leaf_size:
+            return node
+
+        centers = self.item_centers[items]
+        axis = np.argmax(centers.max(axis=0) - centers.min(axis=0))
+        middle = (end - start) // 2
+        self.items[start:end] = items[np.argpartition(centers[:, axis], middle)]
+
+        self.node_left[node] = self.build(bounds_min, bounds_max, start, start + middle, depth + 1)
+        self.node_right[node] = self.build(bounds_min, bounds_max, start + middle, end, depth + 1)
+        return node
+
+    def refit(self, bounds_min: np.ndarray, bounds_max: np.ndarray):
+        # Moved items keep their place in the tree, only the boxes grow or shrink around them
+        self.item_centers = (bounds_min + bounds_max) / 2
+        self.item_extents = (bounds_max - bounds_min) / 2
+        if len(self.node_start) == 0:
+            return
+        # Leaves partition the item order, so each one is a single reduceat segment
+        starts = self.node_start[self.leaves]
+        self.node_min[self.leaves] = np.minimum.reduceat(bounds_min[self.items], starts)
+        self.node_max[self.leaves] = np.maximum.reduceat(bounds_max[self.items], starts)
+        for nodes in self.internal_levels:
+            self.node_min[nodes] = np.minimum(self.node_min[self.node_left[nodes]], self.node_min[self.node_right[nodes]])
+            self.node_max[nodes] = np.maximum(self.node_max[self.node_left[nodes]], self.node_max[self.node_right[nodes]])
+        self.node_centers = (self.node_min + self.node_max) / 2
+        self.node_extents = (self.node_max - self.node_min) / 2
+
+    def cull(self, planes: np.ndarray, occlusion: 'DepthPyramid' = None) -> np.ndarray:
+        visible = np.zeros(len(self.items), bool)
+        frontier = np.zeros(1 if len(self.node_start) else 0, np.int64)
+        self.occluded_count = 0
+
+        # Breadth-first, testing a whole level of the tree per numpy call
+        while frontier.size:
+            (outside, inside) = boxes_vs_planes(self.node_centers[frontier], self.node_extents[frontier], planes)
+            leaf = self.node_left[frontier] == -1
+
+            if occlusion is not None:
+                tested = np.flatnonzero(~outside)
+                occluded = tested[occlusion.test(self.node_centers[frontier[tested]], self.node_extents[frontier[tested]])]
+                self.occluded_count += int(self.node_count[frontier[occluded]].sum())
+                outside[occluded] = True
+                # Parts of a node inside the frustum can still be hidden, so keep descending
+                inside[:] = False
+
+            accepted = frontier[inside]
+            visible[self.items[expand_ranges(self.node_start[accepted], self.node_count[accepted])]] = True
+
+            partial = ~outside & ~inside
+            leaves = frontier[partial & leaf]
+            items = self.items[expand_ranges(self.node_start[leaves], self.node_count[leaves])]
+            (item_outside, _) = boxes_vs_planes(self.item_centers[items], self.item_extents[items], planes)
+            if occlusion is not None:
+                tested = np.flatnonzero(~item_outside)
+                occluded = tested[occlusion.test(self.item_centers[items[tested]], self.item_extents[items[tested]])]
+                self.occluded_count += len(occluded)
+                item_outside[occluded] = True
+            visible[items[~item_outside]] = True
+
+            internal = frontier[partial & ~leaf]
+            frontier = np.concatenate((self.node_left[internal], self.node_right[internal]))
+
+        return visible
@@ -0,0 +1,64 @@
+import ctypes
+import numpy as np
+
+class DrawList:
+    def __init__(self, entries: list[tuple], level_count: int = 1):
+        count = len(entries)
+        self.level_count = level_count
+        self.transforms = np.zeros((count, 4, 4), np.float32)
+        self.nodes = np.zeros(count, np.int32)
+        self.meshes = np.zeros(count, np.int32)
+        self.primitives = np.zeros(count, np.int32)
+        self.vaos = np.zeros(count, np.uint32)
+        self.counts = np.zeros(count, np.int32)
+        self.offsets = np.zeros(count, np.int64)
+        self.base_vertices = np.zeros(count, np.int32)
+        self.index_types = np.zeros(count, np.uint32)
+        self.materials = np.zeros(count, np.int32)
+        self.level_vaos = np.zeros((count, level_count), np.uint32)
+        self.level_counts = np.zeros((count, level_count), np.int32)
+        self.level_offsets = np.zeros((count, level_count), np.int64)
+        self.level_base_vertices = np.zeros((count, level_count), np.int32)
+
+        for (i, (transform, node, mesh, primitive, vao, index_count, offset, base_vertex, index_type, material, levels)) in enumerate(entries):
+            self.transforms[i] = transform
+            self.nodes[i] = node
+            self.meshes[i] = mesh
+            self.primitives[i] = primitive
+            self.vaos[i] = vao
+            self.counts[i] = index_count
+            self.offsets[i] = offset
+            self.base_vertices[i] = base_vertex
+            self.index_types[i] = index_type
+            self.materials[i] = material
+            for (level, (level_vao, level_index_count, level_offset, level_base_vertex)) in enumerate(levels):
+                self.level_vaos[i, level] = level_vao
+                self.level_counts[i, level] = level_index_count
+                self.level_offsets[i, level] = level_offset
+                self.level_base_vertices[i, level] = level_base_vertex
+
+        self.build_commands()
+
+    def __len__(self):
+        return len(self.vaos)
+
+    def reorder(self, order: np.ndarray):
+        for name in ('transforms', 'nodes', 'meshes', 'primitives', 'vaos', 'counts', 'offsets', 'base_vertices', 'index_types', 'materials', 'level_vaos', 'level_counts', 'level_offsets', 'level_base_vertices'):
+            setattr(self, name, getattr(self, name)[order])
+        self.build_commands()
+
+    def build_commands(self):
+        # Plain Python tuples so the per-frame loop does no numpy scalar boxing or attribute lookups
+        self.level_commands = []
+        for level in range(self.level_count):
+            self.level_commands.append(list(zip(
+                self.transforms,
+                self.nodes.tolist(),
+                self.level_vaos[:, level].tolist(),
+                self.level_counts[:, level].tolist(),
+                self.index_types.tolist(),
+                [ctypes.c_void_p(offset) for offset in self.level_offsets[:, level].tolist()],
+                self.level_base_vertices[:, level].tolist(),
+                self.materials.tolist()
+            )))
+        self.commands = self.level_commands[0]
@@ -0,0 +1,216 @@
+from lod import INDEX_DTYPES, build_lods
+
+from OpenGL import GL
+
+import numpy as np
+
+# Post-transform cache size assumed when ordering triangles and when simulating invocations
+VERTEX_CACHE_SIZE = 16
+
+POSITION_LOCATION = 0
+NORMAL_LOCATION = 1
+TEXCOORD_LOCATION = 2
+
+INDEX_TYPES = {np.dtype(dtype): component_type for (component_type, dtype) in INDEX_DTYPES.items()}
+
+# KHR_mesh_quantization attributes are bound with their integer component type
+VERTEX_COMPONENT_TYPES = {
+    np.dtype(np.int8): GL.GL_BYTE,
+    np.dtype(np.uint8): GL.GL_UNSIGNED_BYTE,
+    np.dtype(np.int16): GL.GL_SHORT,
+    np.dtype(np.uint16): GL.GL_UNSIGNED_SHORT
+}
+
+class PrimitiveGeometry:
+    def __init__(self, vertices: np.ndarray, stride: int, attributes: tuple, indices: np.ndarray, lods: list[np.ndarray], bounds: tuple, stats: dict):
+        self.vertices = vertices
+        self.stride = stride
+        self.attributes = attributes
+        self.indices = indices
+        self.lods = lods
+        self.bounds = bounds
+        self.stats = stats
+
+    @property
+    def index_type(self) -> int:
+        return INDEX_TYPES[self.indices.dtype]
+
+def tipsify(indices: np.ndarray, vertex_count: int, cache_size: int = VERTEX_CACHE_SIZE) -> np.ndarray:
+    # Sander, Nehab and Barczak, "Fast Triangle Reordering for Vertex Locality and Reduced Overdraw"
+    triangles = indices.reshape(-1, 3)
+    corners = triangles.ravel().astype(np.int64)
+    adjacency = (np.argsort(corners, kind='stable') // 3).tolist()
+    adjacency_starts = np.concatenate(([0], np.cumsum(np.bincount(corners, minlength=vertex_count)))).tolist()
+    vertices = triangles.tolist()
+
+    live = np.bincount(corners, minlength=vertex_count).tolist()
+    cache_time = [0] * vertex_count
+    emitted = [False] * len(vertices)
+    order = []
+    dead_end = []
+    time = cache_size + 1
+    cursor = 0
+    vertex = int(corners[0]) if len(corners) else -1
+
+    while vertex >= 0:
+        candidates = []
+        for triangle in adjacency[adjacency_starts[vertex]:adjacency_starts[vertex + 1]]:
+            if emitted[triangle]:
+                continue
+            emitted[triangle] = True
+            order.append(triangle)
+            for corner in vertices[triangle]:
+                dead_end.append(corner)
+                candidates.append(corner)
+                live[corner] -= 1
+                if time - cache_time[corner] > cache_size:
+                    cache_time[corner] = time
+                    time += 1
+
+        # Prefer the candidate that stays in the cache longest while all its triangles are emitted
+        vertex = -1
+        best_priority = -1
+        for candidate in candidates:
+            if live[candidate] > 0:
+                priority = 0
+                if time - cache_time[candidate] + 2 * live[candidate] <= cache_size:
+                    priority = time - cache_time[candidate]
+                if priority > best_priority:
+                    (vertex, best_priority) = (candidate, priority)
+
+        while vertex < 0 and dead_end:
+            candidate = dead_end.pop()
+            if live[candidate] > 0:
+                vertex = candidate
+        while vertex < 0 and cursor < vertex_count:
+            if live[cursor] > 0:
+                vertex = cursor
+            cursor += 1
+
+    return triangles[order].ravel()
+
+def transformed_vertices(indices: np.ndarray, cache_size: int = VERTEX_CACHE_SIZE) -> int:
+    # Vertex shader invocations of a FIFO post-transform cache
+    inserted = {}
+    misses = 0
+    for vertex in indices.tolist():
+        time = inserted.get(vertex)
+        if time is None or misses - time >= cache_size:
+            inserted[vertex] = misses
+            misses += 1
+    return misses
+
+def vertex_fetch_order(indices: np.ndarray, vertex_count: int) -> tuple[np.ndarray, np.ndarray]:
+    # Renumbers vertices in first use order, dropping the ones no triangle references
+    (used, first_use) = np.unique(indices, return_index=True)
+    used = used[np.argsort(first_use)]
+    remap = np.zeros(vertex_count, np.int64)
+    remap[used] = np.arange(len(used))
+    return (used, remap[indices])
+
+def pack_normals(normals: np.ndarray) -> np.ndarray:
+    lengths = np.linalg.norm(normals, axis=1)[:, None]
+    packed = np.round(np.clip(normals / np.maximum(lengths, 1e-12), -1, 1) * 511).astype(np.int32) & 0x3ff
+    return (packed[:, 0] | (packed[:, 1] << 10) | (packed[:, 2] << 20)).astype(np.uint32)
+
+def attribute_values(values: np.ndarray, normalized: bool) -> np.ndarray:
+    # What the vertex shader reads for an attribute stored as values
+    if normalized and values.dtype.kind in 'iu':
+        # Normalized integers map onto [0, 1], or [-1, 1] when signed
+        return np.maximum(values / np.iinfo(values.dtype).max, -1).astype(np.float32)
+    return values.astype(np.float32)
+
+def integer_attribute(name: str, values: np.ndarray, location: int, normalized: bool) -> tuple[tuple, tuple]:
+    # Padded to whole words so the next attribute stays 4 byte aligned
+    components = values.shape[1]
+    padded = -(-components * values.itemsize // 4) * 4 // values.itemsize
+    return ((name, values.dtype, padded), (location, components, VERTEX_COMPONENT_TYPES[values.dtype], normalized))
+
+def interleave(positions: np.ndarray, normals: np.ndarray, texcoords: np.ndarray, quantize: bool, normalized: tuple = (False, False, False)) -> tuple[np.ndarray, int, tuple]:
+    if positions.dtype.kind in 'iu':
+        (field, attribute) = integer_attribute('position', positions, POSITION_LOCATION, normalized[0])
+        fields = [field]
+        attributes = [attribute]
+    else:
+        fields = [('position', np.float32, 3)]
+        attributes = [(POSITION_LOCATION, 3, GL.GL_FLOAT, False)]
+    if normals is not None:
+        if normals.dtype.kind in 'iu':
+            (field, attribute) = integer_attribute('normal', normals, NORMAL_LOCATION, normalized[1])
+            fields.append(field)
+            attributes.append(attribute)
+        elif quantize:
+            fields.append(('normal', np.uint32))
+            attributes.append((NORMAL_LOCATION, 4, GL.GL_INT_2_10_10_10_REV, True))
+        else:
+            fields.append(('normal', np.float32, 3))
+            attributes.append((NORMAL_LOCATION, 3, GL.GL_FLOAT, False))
+    if texcoords is not None:
+        if texcoords.dtype.kind in 'iu':
+            (field, attribute) = integer_attribute('texcoord', texcoords, TEXCOORD_LOCATION, normalized[2])
+            fields.append(field)
+            attributes.append(attribute)
+        elif quantize:
+            fields.append(('texcoord', np.float16, 2))
+            attributes.append((TEXCOORD_LOCATION, 2, GL.GL_HALF_FLOAT, False))
+        else:
+            fields.append(('texcoord', np.float32, 2))
+            attributes.append((TEXCOORD_LOCATION, 2, GL.GL_FLOAT, False))
+
+    dtype = np.dtype(fields)
+    vertices = np.zeros(len(positions), dtype)
+    vertices['position'][:, :positions.shape[1]] = positions
+    if normals is not None:
+        if normals.dtype.kind in 'iu':
+            vertices['normal'][:, :normals.shape[1]] = normals
+        else:
+            vertices['normal'] = pack_normals(normals) if quantize else normals
+    if texcoords is not None:
+        vertices['texcoord'][:, :texcoords.shape[1]] = texcoords
+
+    attributes = tuple((*attribute, dtype.fields[name][1]) for (attribute, name) in zip(attributes, dtype.names))
+    return (vertices.view(np.uint8).reshape(len(positions), dtype.itemsize), dtype.itemsize, attributes)
+
+def select_vertices(values: np.ndarray, used: np.ndarray) -> np.ndarray:
+    if values is None:
+        return None
+    # Quantized attributes keep their integer type, everything else is read as float
+    return np.ascontiguousarray(values[used], None if values.dtype.kind in 'iu' else np.float32)
+
+def optimize_primitive(positions: np.ndarray, normals: np.ndarray, texcoords: np.ndarray, indices: np.ndarray, quantize: bool = False, normalized: tuple = (False, False, False)) -> PrimitiveGeometry:
+    source_transforms = transformed_vertices(indices)
+    source_index_bytes = indices.nbytes
+
+    (used, indices) = vertex_fetch_order(tipsify(indices, len(positions)), len(positions))
+    # Only the vertices this primitive references count, buffers are often shared between primitives
+    source_vertex_size = sum(array.itemsize * array.shape[1] for array in (positions, normals, texcoords) if array is not None)
+    # 16-bit indices halve index bandwidth whenever the primitive fits
+    indices = indices.astype(np.uint16 if len(used) <= 1 << 16 else np.uint32)
+    (positions, normals, texcoords) = (select_vertices(array, used) for array in (positions, normals, texcoords))
+    position_values = np.ascontiguousarray(attribute_values(positions, normalized[0]))
+
+    lods = [tipsify(level, len(used)) for level in build_lods(position_values, indices)]
+    (vertices, stride, attributes) = interleave(positions, normals, texcoords, quantize, normalized)
+    bounds = (position_values.min(axis=0).tolist(), position_values.max(axis=0).tolist()) if len(position_values) else ([0, 0, 0], [0, 0, 0])
+    stats = {
+        'source_bytes': int(len(used) * source_vertex_size + source_index_bytes),
+        'bytes': int(vertices.nbytes + indices.nbytes),
+        'source_transforms': source_transforms,
+        'transforms': transformed_vertices(indices),
+        'triangles': len(indices) // 3
+    }
+    return PrimitiveGeometry(vertices, stride, attributes, indices, lods, bounds, stats)
+
+def geometry_summary(stats: list[dict]) -> dict:
+    summary = {name: sum(stat[name] for stat in stats) for name in ('source_bytes', 'bytes', 'source_transforms', 'transforms', 'triangles')}
+    triangles = max(summary['triangles'], 1)
+    summary['source_acmr'] = summary['source_transforms'] / triangles
+    summary['acmr'] = summary['transforms'] / triangles
+    return summary
+
+def geometry_report(stats: list[dict]) -> str:
+    summary = geometry_summary(stats)
+    saved = 1 - summary['bytes'] / max(summary['source_bytes'], 1)
+    return 'Geometry: %.1fKB -> %.1fKB (%.1f%% smaller), vertex shader invocations %i -> %i (ACMR %.3f -> %.3f with a %i entry FIFO cache)' % (
+        summary['source_bytes'] / 1024, summary['bytes'] / 1024, saved * 100,
+        summary['source_transforms'], summary['transforms'], summary['source_acmr'], summary['acmr'], VERTEX_CACHE_SIZE)
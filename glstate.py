@@ -0,0 +1,108 @@
+from OpenGL import GL
+
+class GLState:
+    def __init__(self):
+        self.uniforms = {}
+        self.issued = 0
+        self.skipped = 0
+        self.frame_issued = 0
+        self.frame_skipped = 0
+        self.draw_calls = 0
+        self.triangles = 0
+        self.frame_draw_calls = 0
+        self.frame_triangles = 0
+        self.program = None
+        self.invalidate()
+
+    def invalidate(self):
+        self.vao = None
+        self.active_texture = None
+        self.textures = {}
+        self.uniform_buffers = {}
+
+    def forget_programs(self):
+        # Reloaded programs can reuse the names of deleted ones, so nothing cached per program is trusted
+        self.uniforms = {}
+        self.program = None
+
+    def begin_frame(self):
+        self.frame_issued = self.issued
+        self.frame_skipped = self.skipped
+        self.frame_draw_calls = self.draw_calls
+        self.frame_triangles = self.triangles
+        self.issued = 0
+        self.skipped = 0
+        self.draw_calls = 0
+        self.triangles = 0
+
+    def count_draw(self, triangles: int, calls: int = 1):
+        self.draw_calls += calls
+        self.triangles += triangles
+
+    def use_program(self, program: int):
+        if self.program == program:
+            self.skipped += 1
+            return
+        GL.glUseProgram(program)
+        self.program = program
+        self.issued += 1
+
+    def bind_vertex_array(self, vao: int):
+        if self.vao == vao:
+            self.skipped += 1
+            return
+        GL.glBindVertexArray(vao)
+        self.vao = vao
+        self.issued += 1
+
+    def bind_texture(self, unit: int, target: int, texture: int):
+        if self.textures.get(unit) == (target, texture):
+            self.skipped += 1
+            return
+        if self.active_texture != unit:
+            GL.glActiveTexture(GL.GL_TEXTURE0 + unit)
+            self.active_texture = unit
+            self.issued += 1
+        GL.glBindTexture(target, texture)
+        self.textures[unit] = (target, texture)
+        self.issued += 1
+
+    def bind_uniform_buffer(self, binding: int, buffer: int, offset: int = 0, size: int = None):
+        if self.uniform_buffers.get(binding) == (buffer, offset, size):
+            self.skipped += 1
+            return
+        if size is None:
+            GL.glBindBufferBase(GL.GL_UNIFORM_BUFFER, binding, buffer)
+        else:
+            GL.glBindBufferRange(GL.GL_UNIFORM_BUFFER, binding, buffer, offset, size)
+        self.uniform_buffers[binding] = (buffer, offset, size)
+        self.issued += 1
+
+    def uniform(self, location: int, key, setter, *args):
+        if location == -1:
+            return
+        program_uniforms = self.uniforms.setdefault(self.program, {})
+        if program_uniforms.get(location) == key:
+            self.skipped += 1
+            return
+        setter(location, *args)
+        program_uniforms[location] = key
+        self.issued += 1
+
+    def uniform_1i(self, location: int, value: int):
+        self.uniform(location, value, GL.glUniform1i, value)
+
+    def uniform_2i(self, location: int, value: tuple):
+        self.uniform(location, value, GL.glUniform2i, *value)
+
+    def uniform_2f(self, location: int, value: tuple):
+        self.uniform(location, value, GL.glUniform2f, *value)
+
+    def uniform_3f(self, location: int, value: tuple):
+        self.uniform(location, value, GL.glUniform3f, *value)
+
+    def uniform_4f(self, location: int, value: tuple):
+        self.uniform(location, value, GL.glUniform4f, *value)
+
+    def uniform_matrix4(self, location: int, key, value):
+        self.uniform(location, key, GL.glUniformMatrix4fv, 1, False, value)
@@ -1,97 +1,68 @@
 from scene import Scene
-import glm
-import math
 import glfw
+import threading
+import time
 
 class InputController:
+    # GLFW only delivers events on the main thread, so the callbacks record state for the simulation to take
     def __init__(self, scene: Scene, window):
         self.scene = scene
         self.window = window
         self.grabbed_mouse = False
         self.last_cursor = (0, 0)
+        self.keys = set()
+        self.mouse_delta = (0, 0)
+        self.input_time = None
+        self.window_size = glfw.get_window_size(window)
+        self.lock = threading.Lock()
 
-    def update(self, delta_time: float):
-        if glfw.get_mouse_button(self.window, glfw.MOUSE_BUTTON_LEFT) == glfw.PRESS:
-            self.grabbed_mouse = True
-            glfw.set_input_mode(self.window, glfw.CURSOR, glfw.CURSOR_DISABLED)
-            self.last_cursor = glfw.get_cursor_pos(self.window)
-
-        if glfw.get_key(self.window, glfw.KEY_ESCAPE) == glfw.PRESS:
-            self.grabbed_mouse = False
-            glfw.set_input_mode(self.window, glfw.CURSOR, glfw.CURSOR_NORMAL)
-
-        mouse_delta = (0, 0)
-        if self.grabbed_mouse:
-            cursor_pos = glfw.get_cursor_pos(self.window)
-            mouse_delta = (cursor_pos[0] - self.last_cursor[0], cursor_pos[1] - self.last_cursor[1])
-            self.last_cursor = cursor_pos
-
-        rotate_speed = 0.05
-        self.scene.camera.orientation += rotate_speed * glm.vec3(mouse_delta[1], mouse_delta[0], 0)
-        self.scene.camera.orientation.x = min(max(self.scene.camera.orientation.x, -45), 45)
+        glfw.set_key_callback(window, self.on_key)
+        glfw.set_mouse_button_callback(window, self.on_mouse_button)
+        glfw.set_cursor_pos_callback(window, self.on_cursor_pos)
+        glfw.set_window_size_callback(window, self.on_window_size)
 
-        light_dirs = glm.vec3()
-        light_key_map = {
-            glfw.KEY_I: (0, 0, -1),
-            glfw.KEY_J: (-1, 0, 0),
-            glfw.KEY_K: (0, 0, 1),
-            glfw.KEY_L: (1, 0, 0),
-            glfw.KEY_U: (0, -1, 0),
-            glfw.KEY_O: (0, 1, 0),
-        }
-        light_moved = False
-        for key in light_key_map:
-            if(glfw.get_key(self.window, key) == glfw.PRESS):
-                light_dirs = light_dirs + glm.vec3(*light_key_map[key])
-                light_moved = True
+    def mark_input(self):
+        # Latency is measured from the oldest event the next simulation step consumes
+        if self.input_time is None:
+            self.input_time = time.perf_counter()
 
-        light_velocity = 3.0
-        self.scene.light.position += light_dirs * light_velocity * delta_time
-        if light_moved:
-            self.scene.light.need_shadow_render = True
+    def on_key(self, window, key: int, scancode: int, action: int, mods: int):
+        with self.lock:
+            if action == glfw.PRESS:
+                self.keys.add(key)
+                self.mark_input()
+            elif action == glfw.RELEASE:
+                self.keys.discard(key)
+                self.mark_input()
 
-        light_intensity_velocity = 500
-        light_intensity_key_map = {
-            glfw.KEY_M: -1,
-            glfw.KEY_N: 1
-        }
-        for key in light_intensity_key_map:
-            if(glfw.get_key(self.window, key) == glfw.PRESS):
-                self.scene.light.intensity += light_intensity_key_map[key] * light_intensity_velocity * delta_time
-                self.scene.light.intensity = max(self.scene.light.intensity, 0)
-
-        dirs = glm.vec3()
-        key_map = {
-            glfw.KEY_W: (0, 0, -1),
-            glfw.KEY_A: (-1, 0, 0),
-            glfw.KEY_S: (0, 0, 1),
-            glfw.KEY_D: (1, 0, 0),
-            glfw.KEY_Q: (0, -1, 0),
-            glfw.KEY_E: (0, 1, 0),
-        }
-
-        accel = 15.0
-        for key in key_map:
-            if(glfw.get_key(self.window, key) == glfw.PRESS):
-                dirs = dirs + glm.vec3(*key_map[key])
-        accel_vector = accel * dirs
-
-        matrix = glm.mat4()
-        matrix = matrix * glm.rotate(math.radians(self.scene.camera.orientation.y), glm.vec3(0, 1, 0))
+        if action != glfw.PRESS:
+            return
+        if key == glfw.KEY_ESCAPE:
+            self.grabbed_mouse = False
+            glfw.set_input_mode(self.window, glfw.CURSOR, glfw.CURSOR_NORMAL)
+        elif key == glfw.KEY_F1:
+            self.scene.show_overlay = not self.scene.show_overlay
 
-        drag = 15.0
-        drag_vector = matrix * (-self.scene.camera.velocity * drag)
+    def on_mouse_button(self, window, button: int, action: int, mods: int):
+        if button == glfw.MOUSE_BUTTON_LEFT and action == glfw.PRESS:
+            self.grabbed_mouse = True
+            glfw.set_input_mode(self.window, glfw.CURSOR, glfw.CURSOR_DISABLED)
+            self.last_cursor = glfw.get_cursor_pos(self.window)
 
-        if accel_vector.x == 0: accel_vector.x = drag_vector.x
-        if accel_vector.y == 0: accel_vector.y = drag_vector.y
-        if accel_vector.z == 0: accel_vector.z = drag_vector.z
+    def on_cursor_pos(self, window, x: float, y: float):
+        if not self.grabbed_mouse:
+            return
+        with self.lock:
+            self.mouse_delta = (self.mouse_delta[0] + x - self.last_cursor[0], self.mouse_delta[1] + y - self.last_cursor[1])
+            self.mark_input()
+        self.last_cursor = (x, y)
 
-        matrix = glm.mat4()
-        matrix = matrix * glm.rotate(math.radians(-self.scene.camera.orientation.y), glm.vec3(0, 1, 0))
+    def on_window_size(self, window, width: int, height: int):
+        self.window_size = (width, height)
 
-        self.scene.camera.velocity += matrix * (accel_vector * delta_time)
-        max_velocity = 7.0
-        if glm.length(self.scene.camera.velocity) > max_velocity:
-            self.scene.camera.velocity = glm.normalize(self.scene.camera.velocity)
-            self.scene.camera.velocity *= max_velocity
-        self.scene.camera.position += self.scene.camera.velocity * delta_time
+    def take(self) -> tuple[frozenset, tuple, float]:
+        with self.lock:
+            state = (frozenset(self.keys), self.mouse_delta, self.input_time)
+            self.mouse_delta = (0, 0)
+            self.input_time = None
+        return state
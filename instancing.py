@@ -0,0 +1,184 @@
+from shaders import Shader
+from glstate import GLState
+from resources import create_vao
+
+from OpenGL import GL
+
+import ctypes
+import numpy as np
+
+INDEX_SIZES = {
+    GL.GL_UNSIGNED_BYTE: 1,
+    GL.GL_UNSIGNED_SHORT: 2,
+    GL.GL_UNSIGNED_INT: 4,
+}
+
+INSTANCE_TRANSFORM_LOCATION = 3
+
+def create_instanced_vao(vertex_buffer: int, stride: int, attributes: tuple, index_buffer: int) -> int:
+    # The transform attributes are pointed at an instance buffer by whichever renderer draws with the VAO
+    vao = create_vao(vertex_buffer, stride, attributes, index_buffer)
+    GL.glBindVertexArray(vao)
+    for column in range(4):
+        GL.glEnableVertexAttribArray(INSTANCE_TRANSFORM_LOCATION + column)
+        GL.glVertexAttribDivisor(INSTANCE_TRANSFORM_LOCATION + column, 1)
+    GL.glBindVertexArray(0)
+    return vao
+
+class InstancedRenderer:
+    def __init__(self, obj: 'GltfObject'):
+        self.obj = obj
+
+        major = GL.glGetIntegerv(GL.GL_MAJOR_VERSION)
+        minor = GL.glGetIntegerv(GL.GL_MINOR_VERSION)
+        version = (int(major), int(minor))
+        self.has_base_instance = version >= (4, 2)
+        self.has_multi_draw_indirect = version >= (4, 3)
+
+        self.instance_buffer = GL.glGenBuffers(1)
+        self.compacted = False
+        self.build_layouts()
+        self.build_batches()
+
+    def build_layouts(self):
+        # Layouts come from the pool like the object's own, so spawned copies draw with the same VAOs
+        self.layout_vaos = {}
+        self.primitive_layouts = {}
+        for (m, p) in self.obj.primitive_levels:
+            index_type = self.obj.index_types[(m, p)]
+            for level in range(self.obj.lod_count):
+                (layout, count, offset, base_vertex) = self.obj.primitive_level(m, p, level)
+                if layout not in self.layout_vaos:
+                    self.layout_vaos[layout] = self.obj.resources.vao(layout, create_instanced_vao)
+                self.primitive_layouts[(m, p, level)] = (layout, base_vertex, offset // INDEX_SIZES[index_type], count, index_type)
+
+    def bind_instance_attributes(self, state: GLState, vao: int, first_instance: int = 0):
+        # Pooled VAOs are shared between copies, they are only repointed when another instance range drew last
+        sources = self.obj.resources.instance_sources
+        state.bind_vertex_array(vao)
+        if sources.get(vao) == (self.instance_buffer, first_instance):
+            return
+        GL.glBindBuffer(GL.GL_ARRAY_BUFFER, self.instance_buffer)
+        for column in range(4):
+            GL.glVertexAttribPointer(INSTANCE_TRANSFORM_LOCATION + column, 4, GL.GL_FLOAT, GL.GL_FALSE, 64, ctypes.c_void_p(first_instance * 64 + column * 16))
+        GL.glBindBuffer(GL.GL_ARRAY_BUFFER, 0)
+        sources[vao] = (self.instance_buffer, first_instance)
+
+    def build_batches(self):
+        # Every draw list entry gets one slot per LOD level, compact() keeps the selected one
+        draw_list = self.obj.draw_list
+        level_count = self.obj.lod_count
+        self.entries = np.repeat(np.arange(len(draw_list)), level_count)
+        self.levels = np.tile(np.arange(level_count), len(draw_list))
+        meshes = draw_list.meshes[self.entries]
+        primitives = draw_list.primitives[self.entries]
+        materials = draw_list.materials[self.entries]
+
+        layouts = [self.primitive_layouts[key] for key in zip(meshes.tolist(), primitives.tolist(), self.levels.tolist())]
+        layout_ids = {key: i for (i, key) in enumerate(self.layout_vaos)}
+        layout_keys = np.array([layout_ids[layout[0]] for layout in layouts], np.int32)
+
+        self.order = np.lexsort((self.levels, primitives, meshes, layout_keys, materials))
+        self.transforms = np.ascontiguousarray(draw_list.transforms[self.entries[self.order]])
+        self.upload_instances(self.transforms)
+
+        # One batch per (mesh, primitive, material, level), runs of batches per (material, layout)
+        batch_keys = np.stack((meshes, primitives, materials, self.levels), axis=1)[self.order]
+        new_batch = np.ones(len(self.order), bool)
+        new_batch[1:] = (batch_keys[1:] != batch_keys[:-1]).any(axis=1)
+        self.batch_starts = np.flatnonzero(new_batch)
+
+        commands = []
+        runs = {}
+        for (b, instance) in enumerate(self.batch_starts.tolist()):
+            i = self.order[instance]
+            (layout, base_vertex, first_index, count, index_type) = layouts[i]
+            instance_count = (self.batch_starts[b + 1] if b + 1 < len(self.batch_starts) else len(self.order)) - instance
+            commands.append((count, instance_count, first_index, base_vertex, instance))
+            runs.setdefault((int(materials[i]), layout, index_type), []).append(b)
+
+        self.commands = np.array(commands, np.uint32).reshape(-1, 5)
+        self.runs = []
+        for ((material, layout, index_type), batches) in runs.items():
+            self.runs.append((material, self.layout_vaos[layout], index_type, batches[0], len(batches)))
+
+        if self.has_multi_draw_indirect:
+            self.indirect_buffer = GL.glGenBuffers(1)
+            self.upload_commands(self.commands)
+
+    def update_transforms(self):
+        self.transforms = np.ascontiguousarray(self.obj.draw_list.transforms[self.entries[self.order]])
+        # Compacted frames upload the visible transforms anyway
+        if not self.compacted:
+            self.upload_instances(self.transforms)
+
+    def upload_instances(self, transforms: np.ndarray):
+        GL.glBindBuffer(GL.GL_ARRAY_BUFFER, self.instance_buffer)
+        GL.glBufferData(GL.GL_ARRAY_BUFFER, max(transforms.nbytes, 64), transforms if len(transforms) else None, GL.GL_STREAM_DRAW)
+        GL.glBindBuffer(GL.GL_ARRAY_BUFFER, 0)
+
+    def upload_commands(self, commands: np.ndarray):
+        GL.glBindBuffer(GL.GL_DRAW_INDIRECT_BUFFER, self.indirect_buffer)
+        GL.glBufferData(GL.GL_DRAW_INDIRECT_BUFFER, commands.nbytes, commands, GL.GL_STREAM_DRAW)
+        GL.glBindBuffer(GL.GL_DRAW_INDIRECT_BUFFER, 0)
+
+    def compact(self, visible: np.ndarray, levels: np.ndarray) -> np.ndarray:
+        visible = (visible[self.entries] & (levels[self.entries] == self.levels))[self.order]
+        instance_counts = np.add.reduceat(visible.astype(np.uint32), self.batch_starts)
+        commands = self.commands.copy()
+        commands[:, 1] = instance_counts
+        commands[:, 4] = np.cumsum(instance_counts) - instance_counts
+
+        self.upload_instances(np.ascontiguousarray(self.transforms[visible]))
+        if self.has_multi_draw_indirect:
+            self.upload_commands(commands)
+        return commands
+
+    def render(self, program: Shader, state: GLState, locations: tuple, visible: np.ndarray = None, levels: np.ndarray = None):
+        commands = self.commands
+        if self.obj.lod_count > 1 and levels is None:
+            levels = np.zeros(len(self.obj.draw_list), np.int64)
+        if visible is None and levels is not None:
+            visible = np.ones(len(self.obj.draw_list), bool)
+
+        if visible is not None:
+            commands = self.compact(visible, levels if levels is not None else np.zeros(len(visible), np.int64))
+            self.compacted = True
+        elif self.compacted:
+            self.upload_instances(self.transforms)
+            if self.has_multi_draw_indirect:
+                self.upload_commands(commands)
+            self.compacted = False
+
+        state.uniform_1i(program.uniform_location('instanced'), 1)
+
+        if self.has_multi_draw_indirect:
+            GL.glBindBuffer(GL.GL_DRAW_INDIRECT_BUFFER, self.indirect_buffer)
+
+        for (material, vao, index_type, first_batch, batch_count) in self.runs:
+            run_commands = commands[first_batch:first_batch + batch_count]
+            if not run_commands[:, 1].any():
+                continue
+
+            self.obj.bind_material(state, locations, material)
+            self.bind_instance_attributes(state, vao)
+
+            if self.has_multi_draw_indirect:
+                GL.glMultiDrawElementsIndirect(GL.GL_TRIANGLES, index_type, ctypes.c_void_p(first_batch * 20), batch_count, 0)
+                state.count_draw(int((run_commands[:, 0] // 3 * run_commands[:, 1]).sum()))
+                continue
+
+            index_size = INDEX_SIZES[index_type]
+            for (count, instance_count, first_index, base_vertex, first_instance) in run_commands.tolist():
+                if instance_count == 0:
+                    continue
+                offset = ctypes.c_void_p(first_index * index_size)
+                if self.has_base_instance:
+                    GL.glDrawElementsInstancedBaseVertexBaseInstance(GL.GL_TRIANGLES, count, index_type, offset, instance_count, base_vertex, first_instance)
+                else:
+                    self.bind_instance_attributes(state, vao, first_instance)
+                    GL.glDrawElementsInstancedBaseVertex(GL.GL_TRIANGLES, count, index_type, offset, instance_count, base_vertex)
+                state.count_draw(count // 3 * instance_count)
+
+        if self.has_multi_draw_indirect:
+            GL.glBindBuffer(GL.GL_DRAW_INDIRECT_BUFFER, 0)
@@ -0,0 +1,168 @@
+from lights import Light, CUBE_FACES
+from shaders import Shader
+from glstate import GLState
+from culling import frustum_planes
+
+from OpenGL import GL
+
+import glm
+import numpy as np
+
+# Must match MAX_LIGHTS in shaders/main.frag
+MAX_LIGHTS = 256
+LIGHTS_BINDING = 0
+TILES_UNIT = 2
+INDICES_UNIT = 3
+
+class ShadowAtlas:
+    def __init__(self, budget: int, size: int = 1024):
+        self.budget = budget
+        self.size = size
+        self.slots = [None] * budget
+
+    def init_gl(self):
+        self.texture = GL.glGenTextures(1)
+        GL.glBindTexture(GL.GL_TEXTURE_CUBE_MAP_ARRAY, self.texture)
+        GL.glTexParameteri(GL.GL_TEXTURE_CUBE_MAP_ARRAY, GL.GL_TEXTURE_MIN_FILTER, GL.GL_LINEAR)
+        GL.glTexParameteri(GL.GL_TEXTURE_CUBE_MAP_ARRAY, GL.GL_TEXTURE_MAG_FILTER, GL.GL_LINEAR)
+        GL.glTexParameteri(GL.GL_TEXTURE_CUBE_MAP_ARRAY, GL.GL_TEXTURE_WRAP_S, GL.GL_CLAMP_TO_EDGE)
+        GL.glTexParameteri(GL.GL_TEXTURE_CUBE_MAP_ARRAY, GL.GL_TEXTURE_WRAP_T, GL.GL_CLAMP_TO_EDGE)
+        GL.glTexParameteri(GL.GL_TEXTURE_CUBE_MAP_ARRAY, GL.GL_TEXTURE_COMPARE_MODE, GL.GL_COMPARE_REF_TO_TEXTURE)
+        GL.glTexParameteri(GL.GL_TEXTURE_CUBE_MAP_ARRAY, GL.GL_TEXTURE_COMPARE_FUNC, GL.GL_LEQUAL)
+        layers = max(self.budget, 1) * len(CUBE_FACES)
+        GL.glTexImage3D(GL.GL_TEXTURE_CUBE_MAP_ARRAY, 0, GL.GL_DEPTH_COMPONENT, self.size, self.size, layers, 0, GL.GL_DEPTH_COMPONENT, GL.GL_FLOAT, None)
+
+    def assign(self, lights: list[Light], camera_position: glm.vec3):
+        if not lights:
+            return
+
+        positions = np.array([light.position.to_list() for light in lights], np.float32)
+        intensities = np.array([light.intensity for light in lights], np.float32)
+        distances = np.sum((positions - np.array(camera_position.to_list(), np.float32)) ** 2, axis=1)
+        importance = intensities / np.maximum(distances, 1)
+        shadowed = [lights[i] for i in np.argsort(-importance, kind='stable')[:self.budget].tolist()]
+
+        # Lights that keep their slot keep their cached shadow maps
+        for (slot, light) in enumerate(self.slots):
+            if light is not None and not any(light is s for s in shadowed):
+                light.shadow_slot = None
+                self.slots[slot] = None
+
+        for light in shadowed:
+            if light.shadow_slot is not None and self.slots[light.shadow_slot] is light:
+                continue
+            slot = self.slots.index(None)
+            self.slots[slot] = light
+            light.shadow_slot = slot
+            light.need_shadow_render = True
+
+class LightGrid:
+    def __init__(self, tile_size: int = 32, cutoff: float = 0.01):
+        self.tile_size = tile_size
+        self.cutoff = cutoff
+        self.tiles = (0, 0)
+        self.light_count = 0
+        self.max_lights_per_tile = 0
+        self.average_lights_per_tile = 0
+
+    def init_gl(self):
+        self.uniform_buffer = GL.glGenBuffers(1)
+        GL.glBindBuffer(GL.GL_UNIFORM_BUFFER, self.uniform_buffer)
+        GL.glBufferData(GL.GL_UNIFORM_BUFFER, MAX_LIGHTS * 32, None, GL.GL_DYNAMIC_DRAW)
+        GL.glBindBuffer(GL.GL_UNIFORM_BUFFER, 0)
+
+        self.tile_texture = GL.glGenTextures(1)
+        GL.glBindTexture(GL.GL_TEXTURE_2D, self.tile_texture)
+        GL.glTexParameteri(GL.GL_TEXTURE_2D, GL.GL_TEXTURE_MIN_FILTER, GL.GL_NEAREST)
+        GL.glTexParameteri(GL.GL_TEXTURE_2D, GL.GL_TEXTURE_MAG_FILTER, GL.GL_NEAREST)
+
+        self.index_buffer = GL.glGenBuffers(1)
+        self.index_texture = GL.glGenTextures(1)
+        GL.glBindTexture(GL.GL_TEXTURE_BUFFER, self.index_texture)
+        GL.glBindBuffer(GL.GL_TEXTURE_BUFFER, self.index_buffer)
+        GL.glTexBuffer(GL.GL_TEXTURE_BUFFER, GL.GL_R32UI, self.index_buffer)
+        GL.glBindBuffer(GL.GL_TEXTURE_BUFFER, 0)
+        GL.glBindTexture(GL.GL_TEXTURE_BUFFER, 0)
+
+    def light_ranges(self, intensities: np.ndarray) -> np.ndarray:
+        return np.sqrt(np.maximum(intensities, 0) / self.cutoff)
+
+    def screen_rects(self, positions: np.ndarray, ranges: np.ndarray, view_transform: glm.mat4, projection_transform: glm.mat4, width: int, height: int) -> np.ndarray:
+        view = np.array(view_transform, np.float32)
+        projection = np.array(projection_transform, np.float32)
+        near = projection[2, 3] / (projection[2, 2] - 1)
+
+        centers = positions @ view[:3, :3].T + view[:3, 3]
+        depth = -centers[:, 2]
+        rects = np.zeros((len(positions), 4), np.float32)
+        rects[:] = (-1, -1, 1, 1)
+
+        # Spheres crossing the near plane cover the whole screen unless the frustum rejects them
+        projectable = depth - ranges > near
+        d0 = (depth - ranges)[projectable]
+        d1 = (depth + ranges)[projectable]
+        r = ranges[projectable]
+        for (axis, scale) in ((0, projection[0, 0]), (1, projection[1, 1])):
+            c = centers[projectable, axis]
+            rects[projectable, axis] = np.minimum((c - r) / d0, (c - r) / d1) * scale
+            rects[projectable, axis + 2] = np.maximum((c + r) / d0, (c + r) / d1) * scale
+        planes = frustum_planes(projection_transform * view_transform)
+        distance = positions @ planes[:, :3].T + planes[:, 3]
+        rects[(distance < -ranges[:, None]).any(axis=1)] = (2, 2, -2, -2)
+
+        rects = (rects + 1) / 2 * np.array([width, height, width, height], np.float32)
+        return rects
+
+    def update(self, state: GLState, lights: list[Light], view_transform: glm.mat4, projection_transform: glm.mat4, width: int, height: int):
+        lights = lights[:MAX_LIGHTS]
+        self.light_count = len(lights)
+        tiles_x = (width + self.tile_size - 1) // self.tile_size
+        tiles_y = (height + self.tile_size - 1) // self.tile_size
+
+        positions = np.array([light.position.to_list() for light in lights], np.float32).reshape(-1, 3)
+        intensities = np.array([light.intensity for light in lights], np.float32)
+        ranges = self.light_ranges(intensities)
+
+        light_data = np.zeros((2, MAX_LIGHTS, 4), np.float32)
+        light_data[0, :len(lights), :3] = positions
+        light_data[0, :len(lights), 3] = intensities
+        light_data[1, :len(lights), 0] = [-1 if light.shadow_slot is None else light.shadow_slot for light in lights]
+        light_data[1, :len(lights), 1] = ranges
+        GL.glBindBuffer(GL.GL_UNIFORM_BUFFER, self.uniform_buffer)
+        GL.glBufferSubData(GL.GL_UNIFORM_BUFFER, 0, light_data.nbytes, light_data)
+        GL.glBindBuffer(GL.GL_UNIFORM_BUFFER, 0)
+
+        rects = self.screen_rects(positions, ranges, view_transform, projection_transform, width, height)
+        tile_min = np.floor(rects[:, :2] / self.tile_size).astype(np.int32)
+        tile_max = np.floor(rects[:, 2:] / self.tile_size).astype(np.int32)
+        tile_x = np.arange(tiles_x, dtype=np.int32)[None, :, None]
+        tile_y = np.arange(tiles_y, dtype=np.int32)[:, None, None]
+        mask = (tile_x >= tile_min[:, 0]) & (tile_x <= tile_max[:, 0]) & (tile_y >= tile_min[:, 1]) & (tile_y <= tile_max[:, 1])
+        mask = mask.reshape(tiles_x * tiles_y, len(lights))
+
+        counts = mask.sum(axis=1).astype(np.uint32)
+        headers = np.zeros((tiles_x * tiles_y, 2), np.uint32)
+        headers[:, 0] = np.cumsum(counts) - counts
+        headers[:, 1] = counts
+        indices = np.nonzero(mask)[1].astype(np.uint32)
+        self.max_lights_per_tile = int(counts.max()) if len(counts) else 0
+        self.average_lights_per_tile = float(counts.mean()) if len(counts) else 0
+
+        state.bind_texture(TILES_UNIT, GL.GL_TEXTURE_2D, self.tile_texture)
+        if self.tiles != (tiles_x, tiles_y):
+            GL.glTexImage2D(GL.GL_TEXTURE_2D, 0, GL.GL_RG32UI, tiles_x, tiles_y, 0, GL.GL_RG_INTEGER, GL.GL_UNSIGNED_INT, headers)
+            self.tiles = (tiles_x, tiles_y)
+        else:
+            GL.glTexSubImage2D(GL.GL_TEXTURE_2D, 0, 0, 0, tiles_x, tiles_y, GL.GL_RG_INTEGER, GL.GL_UNSIGNED_INT, headers)
+
+        GL.glBindBuffer(GL.GL_TEXTURE_BUFFER, self.index_buffer)
+        GL.glBufferData(GL.GL_TEXTURE_BUFFER, max(indices.nbytes, 4), indices if len(indices) else None, GL.GL_STREAM_DRAW)
+        GL.glBindBuffer(GL.GL_TEXTURE_BUFFER, 0)
+
+    def bind(self, program: Shader, state: GLState):
+        state.bind_uniform_buffer(LIGHTS_BINDING, self.uniform_buffer)
+        state.bind_texture(TILES_UNIT, GL.GL_TEXTURE_2D, self.tile_texture)
+        state.bind_texture(INDICES_UNIT, GL.GL_TEXTURE_BUFFER, self.index_texture)
+        state.uniform_1i(program.uniform_location('light_tiles'), TILES_UNIT)
+        state.uniform_1i(program.uniform_location('light_indices'), INDICES_UNIT)
+        state.uniform_1i(program.uniform_location('tile_size'), self.tile_size)
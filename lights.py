@@ -2,8 +2,13 @@ import glm
 from OpenGL import GL
 
 from shaders import ShaderCache
+from culling import frustum_planes, boxes_vs_planes
+from occlusion import DepthPyramid, HiZBuffer
+from glstate import GLState
+from uniforms import FRAME_BINDING, frame_block
 
 import math
+import numpy as np
 
 CUBE_FACES = [
     GL.GL_TEXTURE_CUBE_MAP_POSITIVE_X,
@@ -14,17 +19,49 @@ CUBE_FACES = [
     GL.GL_TEXTURE_CUBE_MAP_NEGATIVE_Z,
 ]
 
+FACE_ROTATIONS = {
+    GL.GL_TEXTURE_CUBE_MAP_POSITIVE_X: (math.radians(-90), glm.vec3(0, 1, 0)),
+    GL.GL_TEXTURE_CUBE_MAP_NEGATIVE_X: (math.radians(90), glm.vec3(0, 1, 0)),
+    GL.GL_TEXTURE_CUBE_MAP_POSITIVE_Y: (math.radians(90), glm.vec3(1, 0, 0)),
+    GL.GL_TEXTURE_CUBE_MAP_NEGATIVE_Y: (math.radians(-90), glm.vec3(1, 0, 0)),
+    GL.GL_TEXTURE_CUBE_MAP_POSITIVE_Z: (math.radians(0), glm.vec3(0, 1, 0)),
+    GL.GL_TEXTURE_CUBE_MAP_NEGATIVE_Z: (math.radians(180), glm.vec3(0, 1, 0))
+}
+
 class Light:
-    def __init__(self, position: glm.vec3, intensity: float):
+    def __init__(self, position: glm.vec3, intensity: float, layered: bool = False):
         self.position = position
+        self.layered = layered
         self.need_shadow_render = True
         self.intensity = intensity
+        self.face_dirty = {face: True for face in CUBE_FACES}
+        self.static_face_dirty = {face: True for face in CUBE_FACES}
+        self.static_shadow_texture = None
+        self.static_occlusion = {}
+        self.static_read = None
+        self.static_hiz = HiZBuffer()
+        self.shadow_slot = None
+        self.face_view_projections = None
+        self.face_view_projections_position = None
+        self.faces_rendered = 0
+        self.shadow_visible_count = 0
+        self.shadow_culled_count = 0
+        self.shadow_occluded_count = 0
 
     def init_gl(self, shader_cache: ShaderCache):
         self.shadow_program = shader_cache.get_shader('shadow')
+        if self.layered:
+            self.layered_program = shader_cache.get_shader('shadow_layered')
+
+        self.shadow_fbo = GL.glGenFramebuffers(1)
+        GL.glBindFramebuffer(GL.GL_FRAMEBUFFER, self.shadow_fbo)
+        GL.glDrawBuffer(GL.GL_NONE)
+        GL.glBindFramebuffer(GL.GL_FRAMEBUFFER, 0)
+        self.static_hiz.init_gl(shader_cache)
 
-        self.shadow_texture = GL.glGenTextures(1)
-        GL.glBindTexture(GL.GL_TEXTURE_CUBE_MAP, self.shadow_texture)
+    def create_shadow_texture(self) -> int:
+        texture = GL.glGenTextures(1)
+        GL.glBindTexture(GL.GL_TEXTURE_CUBE_MAP, texture)
         GL.glTexParameteri(GL.GL_TEXTURE_CUBE_MAP, GL.GL_TEXTURE_MIN_FILTER, GL.GL_LINEAR)
         GL.glTexParameteri(GL.GL_TEXTURE_CUBE_MAP, GL.GL_TEXTURE_MAG_FILTER, GL.GL_LINEAR)
         GL.glTexParameteri(GL.GL_TEXTURE_CUBE_MAP, GL.GL_TEXTURE_WRAP_S, GL.GL_CLAMP_TO_EDGE)
@@ -34,46 +71,218 @@ class Light:
 
         for face in CUBE_FACES:
             GL.glTexImage2D(face, 0, GL.GL_DEPTH_COMPONENT, 1024, 1024, 0, GL.GL_DEPTH_COMPONENT, GL.GL_FLOAT, None)
+        return texture
 
-        self.shadow_fbo = GL.glGenFramebuffers(1)
-        GL.glBindFramebuffer(GL.GL_FRAMEBUFFER, self.shadow_fbo)
+    def create_static_cache(self):
+        self.static_shadow_texture = self.create_shadow_texture()
+        self.static_fbo = GL.glGenFramebuffers(1)
+        GL.glBindFramebuffer(GL.GL_FRAMEBUFFER, self.static_fbo)
+        GL.glDrawBuffer(GL.GL_NONE)
+        GL.glReadBuffer(GL.GL_NONE)
+        GL.glBindFramebuffer(GL.GL_FRAMEBUFFER, 0)
+
+        # The Hi-Z shader can't sample a cube map face, so settled faces are copied here before they are reduced
+        self.static_face_texture = GL.glGenTextures(1)
+        GL.glBindTexture(GL.GL_TEXTURE_2D, self.static_face_texture)
+        GL.glTexParameteri(GL.GL_TEXTURE_2D, GL.GL_TEXTURE_MIN_FILTER, GL.GL_NEAREST)
+        GL.glTexParameteri(GL.GL_TEXTURE_2D, GL.GL_TEXTURE_MAG_FILTER, GL.GL_NEAREST)
+        GL.glTexImage2D(GL.GL_TEXTURE_2D, 0, GL.GL_DEPTH_COMPONENT, 1024, 1024, 0, GL.GL_DEPTH_COMPONENT, GL.GL_FLOAT, None)
+        GL.glBindTexture(GL.GL_TEXTURE_2D, 0)
+        self.static_face_fbo = GL.glGenFramebuffers(1)
+        GL.glBindFramebuffer(GL.GL_FRAMEBUFFER, self.static_face_fbo)
+        GL.glFramebufferTexture2D(GL.GL_FRAMEBUFFER, GL.GL_DEPTH_ATTACHMENT, GL.GL_TEXTURE_2D, self.static_face_texture, 0)
         GL.glDrawBuffer(GL.GL_NONE)
+        GL.glReadBuffer(GL.GL_NONE)
         GL.glBindFramebuffer(GL.GL_FRAMEBUFFER, 0)
 
+    def face_transforms(self) -> dict:
+        projection_transform = glm.perspective(math.radians(90), 1, .1, 30)
+        transforms = {}
+        for face in CUBE_FACES:
+            view_transform = glm.mat4()
+            view_transform = view_transform * glm.scale(glm.vec3(1, -1, -1))
+            view_transform = view_transform * glm.rotate(*FACE_ROTATIONS[face])
+            view_transform = view_transform * glm.translate(-self.position)
+            transforms[face] = (projection_transform, view_transform)
+        return transforms
+
+    def layered_transforms(self) -> np.ndarray:
+        if self.face_view_projections_position != self.position:
+            transforms = self.face_transforms()
+            self.face_view_projections = np.array([(transforms[face][0] * transforms[face][1]).to_list() for face in CUBE_FACES], np.float32)
+            self.face_view_projections_position = glm.vec3(self.position)
+        return self.face_view_projections
+
+    def bounds_planes(self) -> np.ndarray:
+        far = 30
+        planes = []
+        for axis in range(3):
+            normal = np.zeros(3)
+            normal[axis] = 1
+            planes.append((*normal, far - self.position[axis]))
+            planes.append((*-normal, far + self.position[axis]))
+        return np.array(planes)
+
+    def shadow_layer(self, face: int) -> int:
+        return self.shadow_slot * len(CUBE_FACES) + CUBE_FACES.index(face)
+
+    def attach_shadow_face(self, target: int, atlas: 'ShadowAtlas', face: int):
+        GL.glFramebufferTextureLayer(target, GL.GL_DEPTH_ATTACHMENT, atlas.texture, 0, self.shadow_layer(face))
+
+    def copy_static_face(self, atlas: 'ShadowAtlas', face: int):
+        GL.glBindFramebuffer(GL.GL_READ_FRAMEBUFFER, self.static_fbo)
+        GL.glFramebufferTexture2D(GL.GL_READ_FRAMEBUFFER, GL.GL_DEPTH_ATTACHMENT, face, self.static_shadow_texture, 0)
+        GL.glBindFramebuffer(GL.GL_DRAW_FRAMEBUFFER, self.shadow_fbo)
+        self.attach_shadow_face(GL.GL_DRAW_FRAMEBUFFER, atlas, face)
+        GL.glBlitFramebuffer(0, 0, 1024, 1024, 0, 0, 1024, 1024, GL.GL_DEPTH_BUFFER_BIT, GL.GL_NEAREST)
+
+    def read_static_face(self, state: GLState, face: int, view_projection: glm.mat4):
+        GL.glBindFramebuffer(GL.GL_READ_FRAMEBUFFER, self.static_fbo)
+        GL.glFramebufferTexture2D(GL.GL_READ_FRAMEBUFFER, GL.GL_DEPTH_ATTACHMENT, face, self.static_shadow_texture, 0)
+        GL.glBindFramebuffer(GL.GL_DRAW_FRAMEBUFFER, self.static_face_fbo)
+        GL.glBlitFramebuffer(0, 0, 1024, 1024, 0, 0, 1024, 1024, GL.GL_DEPTH_BUFFER_BIT, GL.GL_NEAREST)
+        self.static_hiz.build(self.static_face_texture, 1024, 1024, view_projection, state)
+        self.static_read = face
+
+    def finish_static_read(self):
+        if self.static_read is None:
+            return
+        pyramid = self.static_hiz.update()
+        if pyramid is None:
+            return
+        self.static_occlusion[self.static_read] = pyramid
+        # Cleared so the next face is not given this one's pyramid before its own readback lands
+        self.static_hiz.pyramid = None
+        self.static_read = None
+
+    def cancel_static_read(self, face: int):
+        # The stale reduction stays in its pixel buffer, the next build writes the other one and only that is read
+        if self.static_read == face:
+            self.static_read = None
+
+    def invalidate_bounds(self, bounds_min: np.ndarray, bounds_max: np.ndarray):
+        center = ((bounds_min + bounds_max) / 2).reshape(1, 3)
+        extent = ((bounds_max - bounds_min) / 2).reshape(1, 3)
+        for (face, (projection_transform, view_transform)) in self.face_transforms().items():
+            (outside, _) = boxes_vs_planes(center, extent, frustum_planes(projection_transform * view_transform))
+            if not outside[0]:
+                self.face_dirty[face] = True
+
+    def render_objects(self, scene: 'Scene', program: 'Shader', objects: list, planes: np.ndarray, occlusion: DepthPyramid = None):
+        for obj in objects:
+            visible = obj.cull(planes, occlusion)
+            visible_count = int(np.count_nonzero(visible))
+            self.shadow_visible_count += visible_count
+            self.shadow_culled_count += len(visible) - visible_count - obj.bvh.occluded_count
+            self.shadow_occluded_count += obj.bvh.occluded_count
+            if visible_count > 0:
+                obj.render(program, scene.gl_state, visible)
+
     def render_shadow_map(self, scene: 'Scene'):
-        if not self.need_shadow_render:
+        self.faces_rendered = 0
+        self.shadow_visible_count = 0
+        self.shadow_culled_count = 0
+        self.shadow_occluded_count = 0
+
+        if self.shadow_slot is None:
+            return
+
+        if self.need_shadow_render:
+            for face in CUBE_FACES:
+                self.face_dirty[face] = True
+                self.static_face_dirty[face] = True
+            self.need_shadow_render = False
+
+        dirty_faces = [face for face in CUBE_FACES if self.face_dirty[face]]
+        if not dirty_faces:
             return
 
+        objects = scene.ready_objects()
+        static_objects = [obj for obj in objects if not obj.dynamic]
+        dynamic_objects = [obj for obj in objects if obj.dynamic]
+        if dynamic_objects and self.static_shadow_texture is None:
+            self.create_static_cache()
+            scene.gl_state.invalidate()
+
+        with scene.profiler.section('shadow %i' % self.shadow_slot, gpu=True):
+            GL.glViewport(0, 0, 1024, 1024)
+            if self.layered:
+                self.render_layered(scene, scene.shadow_atlas, static_objects, dynamic_objects)
+            else:
+                self.render_faces(scene, scene.shadow_atlas, dirty_faces, static_objects, dynamic_objects)
+            scene.gl_state.use_program(0)
+
+    def render_layered(self, scene: 'Scene', atlas: 'ShadowAtlas', static_objects: list, dynamic_objects: list):
+        program = self.layered_program
+        scene.gl_state.use_program(program.program)
+        GL.glUniformMatrix4fv(program.uniform_location('face_transforms'), 6, False, self.layered_transforms())
+        GL.glUniform1i(program.uniform_location('layer_offset'), 0)
+        planes = self.bounds_planes()
+
+        if dynamic_objects:
+            if any(self.static_face_dirty.values()):
+                GL.glBindFramebuffer(GL.GL_FRAMEBUFFER, self.static_fbo)
+                GL.glFramebufferTexture(GL.GL_FRAMEBUFFER, GL.GL_DEPTH_ATTACHMENT, self.static_shadow_texture, 0)
+                GL.glClear(GL.GL_DEPTH_BUFFER_BIT)
+                self.render_objects(scene, program, static_objects, planes)
+
+            for face in CUBE_FACES:
+                self.copy_static_face(atlas, face)
+            objects = dynamic_objects
+        else:
+            # Clear only this light's layers, a layered clear would wipe the whole atlas
+            GL.glBindFramebuffer(GL.GL_FRAMEBUFFER, self.shadow_fbo)
+            for face in CUBE_FACES:
+                self.attach_shadow_face(GL.GL_FRAMEBUFFER, atlas, face)
+                GL.glClear(GL.GL_DEPTH_BUFFER_BIT)
+            objects = static_objects
+
         GL.glBindFramebuffer(GL.GL_FRAMEBUFFER, self.shadow_fbo)
-        GL.glUseProgram(self.shadow_program.program)
-        GL.glViewport(0, 0, 1024, 1024)
+        GL.glFramebufferTexture(GL.GL_FRAMEBUFFER, GL.GL_DEPTH_ATTACHMENT, atlas.texture, 0)
+        GL.glUniform1i(program.uniform_location('layer_offset'), self.shadow_slot * len(CUBE_FACES))
+        self.render_objects(scene, program, objects, planes)
 
         for face in CUBE_FACES:
-            GL.glFramebufferTexture2D(GL.GL_FRAMEBUFFER, GL.GL_DEPTH_ATTACHMENT, face, self.shadow_texture, 0)
-        
-            GL.glClear(GL.GL_DEPTH_BUFFER_BIT)
+            self.face_dirty[face] = False
+            self.static_face_dirty[face] = False
+        self.faces_rendered = len(CUBE_FACES)
 
-            projection_transform = glm.perspective(math.radians(90), 1, .1, 30)
+    def render_faces(self, scene: 'Scene', atlas: 'ShadowAtlas', dirty_faces: list, static_objects: list, dynamic_objects: list):
+        scene.gl_state.use_program(self.shadow_program.program)
+        transforms = self.face_transforms()
+        if dynamic_objects:
+            self.finish_static_read()
+        for face in dirty_faces:
+            (projection_transform, view_transform) = transforms[face]
+            planes = frustum_planes(projection_transform * view_transform)
 
-            view_transform = glm.mat4()
-            view_transform = view_transform * glm.scale(glm.vec3(1, -1, -1))
-            face_transforms = {
-                GL.GL_TEXTURE_CUBE_MAP_POSITIVE_X: (math.radians(-90), glm.vec3(0, 1, 0)),
-                GL.GL_TEXTURE_CUBE_MAP_NEGATIVE_X: (math.radians(90), glm.vec3(0, 1, 0)),
-                GL.GL_TEXTURE_CUBE_MAP_POSITIVE_Y: (math.radians(90), glm.vec3(1, 0, 0)),
-                GL.GL_TEXTURE_CUBE_MAP_NEGATIVE_Y: (math.radians(-90), glm.vec3(1, 0, 0)),
-                GL.GL_TEXTURE_CUBE_MAP_POSITIVE_Z: (math.radians(0), glm.vec3(0, 1, 0)),
-                GL.GL_TEXTURE_CUBE_MAP_NEGATIVE_Z: (math.radians(180), glm.vec3(0, 1, 0))
-            }
-            view_transform = view_transform * glm.rotate(*face_transforms[face])
-            view_transform = view_transform * glm.translate(-self.position)
-            
-            GL.glUniformMatrix4fv(self.shadow_program.uniform_location('projection_transform'), 1, False, glm.value_ptr(projection_transform))
-            GL.glUniformMatrix4fv(self.shadow_program.uniform_location('view_transform'), 1, False, glm.value_ptr(view_transform))
+            scene.frame_uniforms.push(FRAME_BINDING, frame_block(projection_transform, view_transform, self.position))
+
+            if dynamic_objects:
+                # Static depth lives in its own cube map and is only redrawn when the light moves
+                if self.static_face_dirty[face]:
+                    GL.glBindFramebuffer(GL.GL_FRAMEBUFFER, self.static_fbo)
+                    GL.glFramebufferTexture2D(GL.GL_FRAMEBUFFER, GL.GL_DEPTH_ATTACHMENT, face, self.static_shadow_texture, 0)
+                    GL.glClear(GL.GL_DEPTH_BUFFER_BIT)
+                    self.render_objects(scene, self.shadow_program, static_objects, planes)
+                    self.static_face_dirty[face] = False
+                    self.static_occlusion.pop(face, None)
+                    self.cancel_static_read(face)
+                elif scene.occlusion_culling and face not in self.static_occlusion and self.static_read is None:
+                    # Read back once the light has settled, dynamic casters hidden behind static depth cannot change the face
+                    # One face is in flight at a time, the rest are culled without it until their turn
+                    self.read_static_face(scene.gl_state, face, projection_transform * view_transform)
+                    GL.glViewport(0, 0, 1024, 1024)
+                    scene.gl_state.use_program(self.shadow_program.program)
 
-            for obj in scene.objects:
-                obj.render(self.shadow_program)
-        
-        GL.glUseProgram(0)
+                self.copy_static_face(atlas, face)
+                GL.glBindFramebuffer(GL.GL_FRAMEBUFFER, self.shadow_fbo)
+                self.render_objects(scene, self.shadow_program, dynamic_objects, planes, self.static_occlusion.get(face) if scene.occlusion_culling else None)
+            else:
+                GL.glBindFramebuffer(GL.GL_FRAMEBUFFER, self.shadow_fbo)
+                self.attach_shadow_face(GL.GL_FRAMEBUFFER, atlas, face)
+                GL.glClear(GL.GL_DEPTH_BUFFER_BIT)
+                self.render_objects(scene, self.shadow_program, static_objects, planes)
 
-        self.need_shadow_render = False
+            self.face_dirty[face] = False
+            self.faces_rendered += 1
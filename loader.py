@@ -0,0 +1,89 @@
+from shaders import ShaderCache
+from resources import ResourcePool
+from assetcache import AssetCache
+
+from concurrent.futures import ThreadPoolExecutor
+
+import sys
+import time
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+def peak_rss_mb() -> float:
+    if resource is None:
+        return 0
+    # ru_maxrss is reported in bytes on macOS and kilobytes elsewhere
+    scale = 1 << 20 if sys.platform == 'darwin' else 1 << 10
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale
+
+class LoadJob:
+    def __init__(self, asset, name: str):
+        self.asset = asset
+        self.name = name
+        self.timings = {}
+        self.start_time = time.perf_counter()
+        self.stage_start_time = self.start_time
+        self.futures = []
+
+    def finish_stage(self, stage: str):
+        now = time.perf_counter()
+        self.timings[stage] = now - self.stage_start_time
+        self.stage_start_time = now
+
+class AssetLoader:
+    def __init__(self, cache: AssetCache = None, workers: int = None):
+        self.cache = cache
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='glview-loader')
+        self.jobs = []
+        self.completed = []
+
+    def load(self, asset, name: str):
+        job = LoadJob(asset, name)
+        job.futures = [self.executor.submit(asset.parse, self.cache)]
+        job.stage = 'parse'
+        self.jobs.append(job)
+
+    def pending(self) -> bool:
+        return len(self.jobs) > 0
+
+    def poll(self, shader_cache: ShaderCache, resources: ResourcePool, max_uploads: int = 1) -> list:
+        ready = []
+        for job in list(self.jobs):
+            if not all(future.done() for future in job.futures):
+                continue
+            for future in job.futures:
+                future.result()
+
+            if job.stage == 'parse':
+                job.finish_stage('parse')
+                job.futures = [self.executor.submit(task) for task in job.asset.decode_tasks()]
+                job.stage = 'decode'
+            elif job.stage == 'decode':
+                job.finish_stage('decode')
+                job.futures = [self.executor.submit(job.asset.store, self.cache)]
+                job.stage = 'store'
+            elif job.stage == 'store' and len(ready) < max_uploads:
+                # GL calls have to stay on the thread that owns the context
+                job.finish_stage('store')
+                job.asset.init_gl(shader_cache, resources)
+                job.finish_stage('upload')
+                job.timings['total'] = job.stage_start_time - job.start_time
+                self.jobs.remove(job)
+                self.completed.append((job.name, job.timings, job.asset.cache_hit))
+                ready.append(job.asset)
+        return ready
+
+    def take_completed(self) -> list:
+        completed = self.completed
+        self.completed = []
+        return completed
+
+    def wait(self, shader_cache: ShaderCache, resources: ResourcePool) -> list:
+        ready = []
+        while self.pending():
+            ready += self.poll(shader_cache, resources, len(self.jobs))
+            time.sleep(0.001)
+        return ready
@@ -0,0 +1,119 @@
+import numpy as np
+
+# Triangle ratio of each generated level relative to the full mesh. Changing these
+# needs a CACHE_VERSION bump so cached levels are regenerated.
+LOD_RATIOS = (0.5, 0.25, 0.125)
+
+# A node switches to level i + 1 once its bounding sphere covers less than this
+# fraction of the screen height
+LOD_SCREEN_SIZES = (0.25, 0.1, 0.04)
+
+# Primitives smaller than this are not worth simplifying
+LOD_MIN_TRIANGLES = 256
+
+INDEX_DTYPES = {
+    5121: np.uint8,
+    5123: np.uint16,
+    5125: np.uint32,
+}
+
+def plane_quadrics(positions: np.ndarray, triangles: np.ndarray) -> np.ndarray:
+    corners = positions[triangles]
+    normals = np.cross(corners[:, 1] - corners[:, 0], corners[:, 2] - corners[:, 0])
+    areas = np.linalg.norm(normals, axis=1)
+    normals /= np.maximum(areas, 1e-12)[:, None]
+    planes = np.concatenate((normals, -np.einsum('ij,ij->i', normals, corners[:, 0])[:, None]), axis=1)
+
+    # Area weighted so large faces dominate the error
+    face_quadrics = planes[:, :, None] * planes[:, None, :] * areas[:, None, None]
+    quadrics = np.zeros((len(positions), 4, 4))
+    for corner in range(3):
+        np.add.at(quadrics, triangles[:, corner], face_quadrics)
+    return quadrics
+
+def triangle_normals(positions: np.ndarray, triangles: np.ndarray) -> np.ndarray:
+    corners = positions[triangles]
+    return np.cross(corners[:, 1] - corners[:, 0], corners[:, 2] - corners[:, 0])
+
+def boundary_vertices(triangles: np.ndarray, vertex_count: int) -> np.ndarray:
+    edges = np.sort(np.concatenate((triangles[:, [0, 1]], triangles[:, [1, 2]], triangles[:, [2, 0]])), axis=1)
+    (unique_edges, counts) = np.unique(edges, axis=0, return_counts=True)
+    boundary = np.zeros(vertex_count, bool)
+    boundary[unique_edges[counts == 1].ravel()] = True
+    return boundary
+
+def collapse_pass(positions: np.ndarray, triangles: np.ndarray, quadrics: np.ndarray, locked: np.ndarray, budget: int) -> np.ndarray:
+    # Half-edge collapses u -> v, so vertices never move and the vertex buffer stays shared
+    edges = np.concatenate((triangles[:, [0, 1]], triangles[:, [1, 2]], triangles[:, [2, 0]]))
+    edges = np.unique(np.concatenate((edges, edges[:, ::-1])), axis=0)
+    edges = edges[~locked[edges[:, 0]]]
+    if len(edges) == 0:
+        return None
+    (u, v) = (edges[:, 0], edges[:, 1])
+
+    target = np.concatenate((positions[v], np.ones((len(v), 1))), axis=1)
+    costs = np.einsum('ni,nij,nj->n', target, quadrics[u] + quadrics[v], target)
+
+    # Accept collapses that are the cheapest choice for both of their vertices, so no two overlap
+    order = np.argsort(costs, kind='stable')
+    rank = np.empty(len(order), np.int64)
+    rank[order] = np.arange(len(order))
+    best = np.full(len(positions), len(order), np.int64)
+    np.minimum.at(best, u, rank)
+    np.minimum.at(best, v, rank)
+    accepted = np.flatnonzero((best[u] == rank) & (best[v] == rank))
+    accepted = accepted[np.argsort(rank[accepted])][:budget]
+
+    remap = np.arange(len(positions))
+    remap[u[accepted]] = v[accepted]
+
+    # Reject collapses that flip any of the triangles they touch
+    collapsed = remap[triangles]
+    moved = collapsed != triangles
+    changed = moved.any(axis=1)
+    before = triangle_normals(positions, triangles[changed])
+    after = triangle_normals(positions, collapsed[changed])
+    degenerate = (collapsed[changed, 0] == collapsed[changed, 1]) | (collapsed[changed, 1] == collapsed[changed, 2]) | (collapsed[changed, 2] == collapsed[changed, 0])
+    flipped = (np.einsum('ij,ij->i', before, after) <= 0) & ~degenerate
+    rejected = triangles[changed][flipped][moved[changed][flipped]]
+    remap[rejected] = rejected
+
+    if (remap == np.arange(len(positions))).all():
+        return None
+    moved_vertices = np.flatnonzero(remap != np.arange(len(positions)))
+    np.add.at(quadrics, remap[moved_vertices], quadrics[moved_vertices])
+    return remap
+
+def simplify(positions: np.ndarray, triangles: np.ndarray, quadrics: np.ndarray, locked: np.ndarray, target: int) -> np.ndarray:
+    while len(triangles) > target:
+        remap = collapse_pass(positions, triangles, quadrics, locked, max((len(triangles) - target) // 2, 1))
+        if remap is None:
+            break
+        triangles = remap[triangles]
+        triangles = triangles[(triangles[:, 0] != triangles[:, 1]) & (triangles[:, 1] != triangles[:, 2]) & (triangles[:, 2] != triangles[:, 0])]
+    return triangles
+
+def build_lods(positions: np.ndarray, indices: np.ndarray) -> list[np.ndarray]:
+    triangles = indices.reshape(-1, 3).astype(np.int64)
+    if len(triangles) < LOD_MIN_TRIANGLES:
+        return []
+
+    used = np.unique(triangles)
+    positions = positions.astype(np.float64)
+    quadrics = plane_quadrics(positions, triangles)
+
+    # Open edges include UV and normal seams, where glTF splits vertices, so they must not move
+    locked = boundary_vertices(triangles, len(positions))
+    locked[np.setdiff1d(np.arange(len(positions)), used)] = True
+
+    levels = []
+    for ratio in LOD_RATIOS:
+        triangles = simplify(positions, triangles, quadrics, locked, int(len(indices) // 3 * ratio))
+        levels.append(triangles.astype(indices.dtype).ravel())
+    return levels
+
+def select_levels(centers: np.ndarray, radii: np.ndarray, camera_position: np.ndarray, vertical_fov: float, level_count: int) -> np.ndarray:
+    distances = np.linalg.norm(centers - camera_position, axis=1)
+    screen_sizes = radii / np.maximum(distances * np.tan(np.radians(vertical_fov) / 2), 1e-6)
+    levels = (screen_sizes[:, None] < np.array(LOD_SCREEN_SIZES)).sum(axis=1)
+    return np.minimum(levels, level_count - 1)
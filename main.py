@@ -2,13 +2,37 @@ from scene import Scene
 from lights import Light
 from objects import Camera, GltfObject, Skybox
 from input import InputController
+from loader import peak_rss_mb
+from camerapath import CameraPath
+from geometry import geometry_report
+from simulation import Simulation
+from pacing import FramePacer
+from capture import FrameCapture
 
+import argparse
 import glfw
 import glm
+import threading
 import time
 
+parser = argparse.ArgumentParser()
+parser.add_argument('--record', help='save the camera and light path to this file for benchmark.py --path')
+parser.add_argument('--trace', help='write a Chrome trace of per-pass CPU and GPU timings to this file')
+parser.add_argument('--occlusion', action='store_true', help='cull objects hidden behind the previous frame\'s depth')
+parser.add_argument('--quantize', action='store_true', help='store normals as 10-bit and texture coordinates as half floats')
+parser.add_argument('--vsync', action=argparse.BooleanOptionalAction, default=True, help='wait for vertical blank when swapping')
+parser.add_argument('--fps-cap', type=float, default=0, help='limit the render rate, 0 renders as fast as swapping allows')
+parser.add_argument('--tick-rate', type=float, default=120, help='fixed simulation steps per second')
+parser.add_argument('--texture-budget', type=float, default=256, help='texture memory budget in MB, textures stream in finer mips as they are seen')
+parser.add_argument('--render-scale', type=float, default=1.0, help='offscreen render resolution relative to the window, upscaled when presenting')
+parser.add_argument('--frame-budget', type=float, default=0, help='GPU frame time in ms to hold by adjusting the render scale, 0 keeps the scale fixed')
+parser.add_argument('--hot-reload-shaders', action=argparse.BooleanOptionalAction, default=True, help='rebuild shader programs when their sources change')
+parser.add_argument('--capture', help='write every rendered frame to this directory as PNG')
+parser.add_argument('--overlay', action='store_true', help='start with the profiling overlay shown, F1 toggles it')
+args = parser.parse_args()
+
 # https://sketchfab.com/3d-models/lowpoly-fps-tdm-game-map-d41a19f699ea421a9aa32b407cb7537b
-gltf_object = GltfObject('lowpoly__fps__tdm__game__map.glb')
+gltf_object = GltfObject('lowpoly__fps__tdm__game__map.glb', quantize=args.quantize)
 
 # https://sketchfab.com/3d-models/viking-room-6d61f7f0b597490aab7afa003e4ec725
 # gltf_object = GltfObject('viking_room.glb')
@@ -16,42 +40,102 @@ gltf_object = GltfObject('lowpoly__fps__tdm__game__map.glb')
 camera = Camera(glm.vec3(0, .5, 0), 50)
 light = Light(glm.vec3(8, 8, -11), 2000.0)
 skybox = Skybox('skybox_texture.jpg')
-scene = Scene([gltf_object], camera, light, skybox)
+scene = Scene([gltf_object], camera, [light], skybox, occlusion_culling=args.occlusion, hot_reload_shaders=args.hot_reload_shaders, texture_budget=int(args.texture_budget * (1 << 20)), render_scale=args.render_scale, target_frame_time=args.frame_budget / 1000)
 
 glfw.init()
 window = glfw.create_window(1600, 1200, 'glview', None, None)
 
 input_controller = InputController(scene, window)
+simulation = Simulation(scene, input_controller, args.tick_rate)
+recorded_path = CameraPath()
+render_error = []
+
+def render_loop():
+    glfw.make_context_current(window)
+    glfw.swap_interval(1 if args.vsync else 0)
+
+    scene.init_gl(*input_controller.window_size)
+    scene.show_overlay = args.overlay
+    if args.trace:
+        scene.profiler.start_trace()
+    if args.capture:
+        scene.start_capture(FrameCapture(args.capture))
+    pacer = FramePacer(args.fps_cap)
+    presented_input_time = None
+    render_time = 0
+    render_frames = 0
+    last_fps_print_time = time.time()
+
+    while not glfw.window_should_close(window):
+        pacer.wait()
+        (width, height) = input_controller.window_size
+        if width == 0 or height == 0:
+            time.sleep(.01)
+            continue
+
+        state = simulation.interpolate(time.perf_counter())
+        state.apply(scene)
+        if args.record:
+            recorded_path.record(camera, scene.lights)
+
+        render_start_time = time.time()
+        scene.render(width, height)
+        render_end_time = time.time()
 
-glfw.make_context_current(window)
+        glfw.swap_buffers(window)
+        if state.input_time is not None and state.input_time != presented_input_time:
+            scene.profiler.record_present(state.input_time)
+            presented_input_time = state.input_time
 
-scene.init_gl(*glfw.get_window_size(window))
-grabbed_mouse = False
-last_frame_start_time = time.time()
-render_time = 0
-render_frames = 0
-last_fps_print_time = time.time()
+        render_time += (render_end_time - render_start_time)
+        render_frames += 1
+        if render_end_time > last_fps_print_time + 1:
+            print('Average render time: %ims, GPU frame time %.2fms, %i draw calls, %i triangles, %i GL state changes skipped per frame, %i primitives visible, %i culled, %i occluded, %i shadow faces rendered, input latency %.1fms, render scale %.2f, %i nodes updated' % (render_time * 1000 / render_frames, scene.profiler.gpu_times.get('frame', 0) * 1000, scene.gl_state.frame_draw_calls, scene.gl_state.frame_triangles, scene.gl_state.frame_skipped, scene.visible_count, scene.culled_count, scene.occluded_count, light.faces_rendered, scene.profiler.counters.get('input_latency', 0) * 1000, scene.render_scale, scene.updated_nodes))
+            render_time = 0
+            render_frames = 0
+            last_fps_print_time = render_end_time
+
+        completed = scene.loader.take_completed()
+        for (name, timings, cache_hit) in completed:
+            print('Loaded %s in %ims (%s, parse %ims, decode %ims, store %ims, upload %ims)' % (name, timings['total'] * 1000, 'cache hit' if cache_hit else 'cache miss', timings['parse'] * 1000, timings['decode'] * 1000, timings['store'] * 1000, timings['upload'] * 1000))
+        if completed and not scene.loader.pending():
+            print('Peak RSS after loading: %iMB' % peak_rss_mb())
+            if scene.asset_cache:
+                print(scene.asset_cache.report())
+            print(scene.shader_cache.report())
+            print(scene.texture_streamer.report())
+            print(scene.resources.report())
+            print(geometry_report([stats for obj in scene.objects for stats in obj.geometry_stats]))
+
+    if scene.capture:
+        print(scene.stop_capture().report())
+    glfw.make_context_current(None)
+
+def run_render_loop():
+    try:
+        render_loop()
+    except BaseException as error:
+        render_error.append(error)
+        glfw.set_window_should_close(window, True)
+
+# The main thread owns GLFW events and runs the fixed step simulation, rendering gets its own thread
+render_thread = threading.Thread(target=run_render_loop, name='glview-render')
+render_thread.start()
 
 while not glfw.window_should_close(window):
-    frame_start_time = time.time()
-    delta_time = frame_start_time - last_frame_start_time
-    last_frame_start_time = frame_start_time
-
-    input_controller.update(delta_time)
-
-    render_start_time = time.time()
-    scene.render(*glfw.get_window_size(window))
-    render_end_time = time.time()
-
-    render_time += (render_end_time - render_start_time)
-    render_frames += 1
-    if render_end_time > last_fps_print_time + 1:
-        print('Average render time: %ims' % (render_time * 1000 / render_frames))
-        render_time = 0
-        render_frames = 0
-        last_fps_print_time = render_end_time
-    
-    glfw.swap_buffers(window)
-    glfw.poll_events()
-
-glfw.terminate()
\ No newline at end of file
+    timeout = simulation.next_step_time - time.perf_counter() if simulation.next_step_time is not None else 0
+    if timeout > 0:
+        glfw.wait_events_timeout(timeout)
+    else:
+        glfw.poll_events()
+    simulation.advance(time.perf_counter())
+
+render_thread.join()
+glfw.terminate()
+if render_error:
+    raise render_error[0]
+
+if args.record:
+    recorded_path.save(args.record)
+if args.trace:
+    scene.profiler.write_trace(args.trace)
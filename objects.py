@@ -1,4 +1,17 @@
 from shaders import ShaderCache, Shader
+from drawlist import DrawList
+from glstate import GLState
+from instancing import InstancedRenderer
+from culling import BVH, transform_bounds
+from assetcache import AssetCache
+from lod import LOD_RATIOS, INDEX_DTYPES, select_levels
+from geometry import PrimitiveGeometry, optimize_primitive, attribute_values
+from compression import DRACO_EXTENSION, meshopt_extension, decode_meshopt_view, decode_draco
+from occlusion import DepthPyramid
+from uniforms import MaterialBuffer
+from textures import StreamedTexture, TextureStreamer, BYTES_PER_TEXEL, build_mips, chain_bytes
+from resources import ResourcePool, content_hash, file_hash
+from animation import NodeHierarchy, AnimationClip
 
 from OpenGL import GL
 import pygltflib
@@ -6,10 +19,31 @@ import pygltflib
 import glm
 import math
 import io
+import os
+import base64
+import urllib.parse
+import functools
+import threading
 import ctypes
 import numpy as np
 from PIL import Image
 
+BUFFER_ALIGNMENT = 16
+
+COMPONENT_DTYPES = {
+    5120: np.int8,
+    5122: np.int16,
+    5126: np.float32,
+    **INDEX_DTYPES
+}
+
+ACCESSOR_COMPONENTS = {
+    'SCALAR': 1,
+    'VEC2': 2,
+    'VEC3': 3,
+    'VEC4': 4
+}
+
 class Camera:
     def __init__(self, position: glm.vec3, fov: float):
         self.orientation = glm.vec3()
@@ -27,130 +61,482 @@ class Camera:
     def projection_transform(self, aspect_ratio: float) -> glm.mat4:
         return glm.perspective(math.radians(self.vertical_fov), aspect_ratio, .1, 100)
 
+# Everything a spawned copy shares with the object it was spawned from
+SHARED_ATTRIBUTES = ['gltf', 'program', 'textures', 'materials', 'default_material', 'material_buffer', 'lod_count', 'layout_vaos', 'primitive_levels', 'index_types', 'primitive_bounds', 'geometry_bytes', 'animations', 'resources']
+
 class GltfObject:
-    def __init__(self, filename: str):
-        gltf = pygltflib.GLTF2().load(filename)
-        self.gltf = gltf
-
-    def init_gl(self, shader_cache: ShaderCache):
-        self.program = shader_cache.get_shader('main')
-
-        buffer = self.gltf.buffers[0]
-        data = self.gltf.get_data_from_buffer_uri(buffer.uri)
-        data = memoryview(data)
-        self.buffers = []
-        for view in self.gltf.bufferViews:
-            buffer = GL.glGenBuffers(1)
-            if view.target:
-                GL.glBindBuffer(view.target, buffer)
-                m = data[view.byteOffset:view.byteOffset + view.byteLength]
-                GL.glBufferData(view.target, view.byteLength, np.array(m), GL.GL_STATIC_DRAW)
-                GL.glBindBuffer(view.target, 0)
-            self.buffers.append(buffer)
+    def __init__(self, filename: str, instanced: bool = False, dynamic: bool = False, quantize: bool = False, transform: glm.mat4 = None):
+        self.filename = filename
+        self.gltf = None
+        self.instanced = instanced
+        self.dynamic = dynamic
+        self.quantize = quantize
+        self.transform = glm.mat4(transform) if transform is not None else glm.mat4()
+        self.ready = False
+        self.cache_hit = False
+        self.geometry_stats = []
 
-        self.textures = []
-        for texture in self.gltf.textures:
-            image = self.gltf.images[texture.source]
-            sampler = self.gltf.samplers[texture.sampler]
-            view = self.gltf.bufferViews[image.bufferView]
-            imagedata = data[view.byteOffset:view.byteOffset + view.byteLength]
-            file = io.BytesIO(imagedata)
-            pil_image = Image.open(file).convert('RGB')
-            tex = GL.glGenTextures(1)
-            GL.glActiveTexture(GL.GL_TEXTURE0)
-            GL.glBindTexture(GL.GL_TEXTURE_2D, tex)
-            GL.glTexImage2D(GL.GL_TEXTURE_2D, 0, GL.GL_RGB, pil_image.width, pil_image.height, 0, GL.GL_RGB, GL.GL_UNSIGNED_BYTE, pil_image.tobytes())
-            GL.glGenerateMipmap(GL.GL_TEXTURE_2D)
-            GL.glTexParameteri(GL.GL_TEXTURE_2D, GL.GL_TEXTURE_MIN_FILTER, sampler.minFilter)
-            GL.glTexParameteri(GL.GL_TEXTURE_2D, GL.GL_TEXTURE_MAG_FILTER, sampler.magFilter)
-            GL.glTexParameteri(GL.GL_TEXTURE_2D, GL.GL_TEXTURE_WRAP_S, sampler.wrapS)
-            GL.glTexParameteri(GL.GL_TEXTURE_2D, GL.GL_TEXTURE_WRAP_T, sampler.wrapT)
-            self.textures.append(tex)
-
-        self.mesh_vaos = []
+    def resource_path(self, uri: str) -> str:
+        return os.path.join(os.path.dirname(self.filename), urllib.parse.unquote(uri))
+
+    def read_uri(self, uri: str) -> bytes:
+        if uri.startswith('data:'):
+            return base64.b64decode(uri.split(',', 1)[1])
+        with open(self.resource_path(uri), 'rb') as file:
+            return file.read()
+
+    def external_files(self, gltf: pygltflib.GLTF2) -> list[str]:
+        return [self.resource_path(item.uri) for item in gltf.buffers + gltf.images if item.uri and not item.uri.startswith('data:')]
+
+    def parse(self, cache: AssetCache = None):
+        # .gltf files keep buffers and images next to them, those are part of the cache key too
+        gltf = None if self.filename.lower().endswith('.glb') else pygltflib.GLTF2().load(self.filename)
+        dependencies = self.external_files(gltf) if gltf else []
+        self.cache_key = cache.key(self.filename, 'quantized' if self.quantize else '', dependencies) if cache else None
+        entry = cache.lookup(self.filename, self.cache_key) if cache else None
+        if entry:
+            # Warm start, optimized geometry and decoded images are memory-mapped straight from the cache
+            self.cache_hit = True
+            self.gltf = entry.load_object('gltf')
+            self.images = [[entry.array('image_%i_%i' % (i, level)) for level in range(level_count)] for (i, level_count) in enumerate(entry.manifest['images'])]
+            self.image_hashes = entry.manifest['image_hashes']
+            self.animation_samplers = [[(entry.array('animation_%i_%i_times' % (a, i)), entry.array('animation_%i_%i_values' % (a, i))) for i in range(sampler_count)] for (a, sampler_count) in enumerate(entry.manifest['animations'])]
+            self.geometry = {}
+            for (m, p, stride, attributes, bounds, level_count, stats) in entry.manifest['primitives']:
+                lods = [entry.array('lod_%i_%i_%i' % (m, p, level)) for level in range(level_count)]
+                attributes = tuple(tuple(attribute) for attribute in attributes)
+                self.geometry[(m, p)] = PrimitiveGeometry(entry.array('vertices_%i_%i' % (m, p)), stride, attributes, entry.array('indices_%i_%i' % (m, p)), lods, bounds, stats)
+            return
+
+        self.gltf = gltf or pygltflib.GLTF2().load(self.filename)
+        self.data = [memoryview(self.read_buffer(i)) for i in range(len(self.gltf.buffers))]
+        self.buffer_data = [None] * len(self.gltf.bufferViews)
+        self.view_locks = {}
+        for i in self.geometry_views() | self.animation_views():
+            view = self.gltf.bufferViews[i]
+            if meshopt_extension(view) is not None:
+                # Compressed views are decoded on the loader threads by whichever task needs them first
+                self.view_locks[i] = threading.Lock()
+            else:
+                self.buffer_data[i] = np.frombuffer(self.data[view.buffer], np.uint8, view.byteLength, view.byteOffset or 0)
+        self.images = [None] * len(self.gltf.textures)
+        self.image_hashes = [None] * len(self.gltf.textures)
+        self.geometry = {}
+        self.animation_samplers = [[(self.read_floats(sampler.input).ravel(), self.read_floats(sampler.output)) for sampler in animation.samplers] for animation in self.gltf.animations]
+
+    def read_buffer(self, index: int) -> bytes:
+        buffer = self.gltf.buffers[index]
+        if buffer.uri is not None:
+            return self.read_uri(buffer.uri)
+        # Only the first buffer can live in the GLB chunk, others without a URI are meshopt fallbacks with no data
+        return (self.gltf.binary_blob() or b'') if index == 0 else b''
+
+    def geometry_views(self) -> set:
+        # Only views that primitives actually read are kept around for the optimizer
+        views = set()
         for mesh in self.gltf.meshes:
-            primitive_vaos = []
             for primitive in mesh.primitives:
-                vao = GL.glGenVertexArrays(1)
-                GL.glBindVertexArray(vao)
-
-                GL.glEnableVertexAttribArray(0)
-                GL.glEnableVertexAttribArray(1)
-                GL.glEnableVertexAttribArray(2)
-
-                accessor = self.gltf.accessors[primitive.attributes.POSITION]
-                buffer = self.buffers[accessor.bufferView]
-                GL.glBindBuffer(GL.GL_ARRAY_BUFFER, buffer)
-                GL.glVertexAttribPointer(0, 3, GL.GL_FLOAT, GL.GL_FALSE, 0, ctypes.c_void_p(accessor.byteOffset))
-            
-                accessor = self.gltf.accessors[primitive.attributes.NORMAL]
-                buffer = self.buffers[accessor.bufferView]
-                GL.glBindBuffer(GL.GL_ARRAY_BUFFER, buffer)
-                GL.glVertexAttribPointer(1, 3, GL.GL_FLOAT, GL.GL_FALSE, 0, ctypes.c_void_p(accessor.byteOffset))
-
-                if primitive.attributes.TEXCOORD_0 is not None:
-                    accessor = self.gltf.accessors[primitive.attributes.TEXCOORD_0]
-                    buffer = self.buffers[accessor.bufferView]
-                    GL.glBindBuffer(GL.GL_ARRAY_BUFFER, buffer)
-                    GL.glVertexAttribPointer(2, 2, GL.GL_FLOAT, GL.GL_FALSE, 0, ctypes.c_void_p(accessor.byteOffset))
-
-                accessor = self.gltf.accessors[primitive.indices]
-                buffer = self.buffers[accessor.bufferView]
-                GL.glBindBuffer(GL.GL_ELEMENT_ARRAY_BUFFER, buffer)
-                
-                primitive_vaos.append(vao)
-            self.mesh_vaos.append(primitive_vaos)
-        
-    def draw_mesh(self, mesh: pygltflib.Mesh, model_transform: glm.mat4, program: Shader, primitive_vaos: list[GL.GLuint]):
-        GL.glUniformMatrix4fv(program.uniform_location('model_transform'), 1, False, glm.value_ptr(model_transform))
+                draco = (primitive.extensions or {}).get(DRACO_EXTENSION)
+                if draco is not None:
+                    views.add(draco['bufferView'])
+                    continue
+                for index in (primitive.attributes.POSITION, primitive.attributes.NORMAL, primitive.attributes.TEXCOORD_0, primitive.indices):
+                    if index is not None:
+                        views.add(self.gltf.accessors[index].bufferView)
+        return views
+
+    def animation_views(self) -> set:
+        return {self.gltf.accessors[index].bufferView for animation in self.gltf.animations for sampler in animation.samplers for index in (sampler.input, sampler.output)}
+
+    def buffer_view(self, index: int) -> np.ndarray:
+        lock = self.view_locks.get(index)
+        if lock is not None:
+            with lock:
+                if self.buffer_data[index] is None:
+                    self.buffer_data[index] = decode_meshopt_view(meshopt_extension(self.gltf.bufferViews[index]), self.data)
+        return self.buffer_data[index]
+
+    def read_accessor(self, index: int) -> np.ndarray:
+        accessor = self.gltf.accessors[index]
+        view = self.gltf.bufferViews[accessor.bufferView]
+        dtype = np.dtype(COMPONENT_DTYPES[accessor.componentType])
+        components = ACCESSOR_COMPONENTS[accessor.type]
+        stride = view.byteStride or (meshopt_extension(view) or {}).get('byteStride') or dtype.itemsize * components
+        return np.ndarray((accessor.count, components), dtype, self.buffer_view(accessor.bufferView), accessor.byteOffset or 0, (stride, dtype.itemsize))
+
+    def read_floats(self, index: int) -> np.ndarray:
+        return attribute_values(self.read_accessor(index), self.gltf.accessors[index].normalized)
+
+    def decode_tasks(self) -> list:
+        if self.cache_hit:
+            return []
+        tasks = [functools.partial(self.decode_image, i) for i in range(len(self.gltf.textures))]
+        # Compressed views go first, so primitives sharing one rarely wait for it
+        tasks += [functools.partial(self.buffer_view, i) for i in self.view_locks]
+        for (m, mesh) in enumerate(self.gltf.meshes):
+            tasks += [functools.partial(self.build_geometry, m, p) for p in range(len(mesh.primitives))]
+        return tasks
+
+    def build_geometry(self, m: int, p: int):
+        primitive = self.gltf.meshes[m].primitives[p]
+        draco = (primitive.extensions or {}).get(DRACO_EXTENSION)
+        if draco is not None:
+            decoded = decode_draco(self.buffer_view(draco['bufferView']), draco['attributes'])
+            (positions, normals, texcoords) = (decoded.get(semantic) for semantic in ('POSITION', 'NORMAL', 'TEXCOORD_0'))
+            self.geometry[(m, p)] = optimize_primitive(positions, normals, texcoords, decoded['indices'], self.quantize)
+            return
+
+        attributes = primitive.attributes
+        positions = self.read_accessor(attributes.POSITION)
+        normals = self.read_accessor(attributes.NORMAL) if attributes.NORMAL is not None else None
+        texcoords = self.read_accessor(attributes.TEXCOORD_0) if attributes.TEXCOORD_0 is not None else None
+        indices = self.read_accessor(primitive.indices).ravel() if primitive.indices is not None else np.arange(len(positions), dtype=np.uint32)
+        # KHR_mesh_quantization attributes stay integers, normalized ones are bound as normalized vertex formats
+        normalized = tuple(index is not None and bool(self.gltf.accessors[index].normalized) for index in (attributes.POSITION, attributes.NORMAL, attributes.TEXCOORD_0))
+        self.geometry[(m, p)] = optimize_primitive(positions, normals, texcoords, indices, self.quantize, normalized)
+
+    def decode_image(self, index: int):
+        image = self.gltf.images[self.gltf.textures[index].source]
+        if image.bufferView is not None:
+            view = self.gltf.bufferViews[image.bufferView]
+            imagedata = self.data[view.buffer][view.byteOffset or 0:(view.byteOffset or 0) + view.byteLength]
+        else:
+            imagedata = self.read_uri(image.uri)
+        # Hashing the encoded image is enough to find textures shared between models
+        self.image_hashes[index] = content_hash(imagedata)
+        pil_image = Image.open(io.BytesIO(imagedata)).convert('RGB')
+        self.images[index] = build_mips(np.asarray(pil_image))
+
+    def store(self, cache: AssetCache = None):
+        if cache is None or self.cache_hit:
+            return
+
+        self.data = None
+        self.buffer_data = None
+        self.view_locks = None
+        self.gltf._glb_data = None
+        # Embedded data would only bloat the pickled document, the cache already holds what was decoded from it
+        for item in self.gltf.buffers + self.gltf.images:
+            if item.uri and item.uri.startswith('data:'):
+                item.uri = None
+        arrays = {'image_%i_%i' % (i, level): pixels for (i, mips) in enumerate(self.images) for (level, pixels) in enumerate(mips)}
+        primitives = []
+        for ((m, p), geometry) in self.geometry.items():
+            arrays['vertices_%i_%i' % (m, p)] = geometry.vertices
+            arrays['indices_%i_%i' % (m, p)] = geometry.indices
+            arrays.update({'lod_%i_%i_%i' % (m, p, level): indices for (level, indices) in enumerate(geometry.lods)})
+            primitives.append((m, p, geometry.stride, geometry.attributes, geometry.bounds, len(geometry.lods), geometry.stats))
+        for (a, samplers) in enumerate(self.animation_samplers):
+            for (i, (times, values)) in enumerate(samplers):
+                arrays['animation_%i_%i_times' % (a, i)] = times
+                arrays['animation_%i_%i_values' % (a, i)] = values
+        manifest = {
+            'source': self.filename,
+            'images': [len(mips) for mips in self.images],
+            'image_hashes': self.image_hashes,
+            'animations': [len(samplers) for samplers in self.animation_samplers],
+            'primitives': primitives
+        }
+        cache.store(self.cache_key, manifest, arrays, {'gltf': self.gltf})
+
+    def upload_geometry(self, resources: ResourcePool):
+        self.lod_count = 1 + len(LOD_RATIOS) if any(geometry.lods for geometry in self.geometry.values()) else 1
+
+        # Vertex chunks are aligned to their stride so every primitive starts at a whole base vertex
+        chunks = []
+        for (key, geometry) in self.geometry.items():
+            chunks.append(((key, 'vertices'), GL.GL_ARRAY_BUFFER, geometry.stride, geometry.vertices))
+            for (level, indices) in enumerate([geometry.indices] + geometry.lods):
+                chunks.append(((key, level), GL.GL_ELEMENT_ARRAY_BUFFER, BUFFER_ALIGNMENT, indices))
+        placements = resources.upload(chunks)
+        self.geometry_bytes = sum(chunk[3].nbytes for chunk in chunks)
+
+        self.layout_vaos = {}
+        self.primitive_levels = {}
+        self.index_types = {}
+        for (key, geometry) in self.geometry.items():
+            (vertex_buffer, vertex_offset) = placements[(key, 'vertices')]
+            levels = []
+            for (level, indices) in enumerate([geometry.indices] + geometry.lods):
+                (index_buffer, index_offset) = placements[(key, level)]
+                layout = (vertex_buffer, geometry.stride, geometry.attributes, index_buffer)
+                if layout not in self.layout_vaos:
+                    self.layout_vaos[layout] = resources.vao(layout)
+                levels.append((layout, len(indices), index_offset, vertex_offset // geometry.stride))
+            self.primitive_levels[key] = levels
+            self.index_types[key] = geometry.index_type
+
+    def primitive_level(self, m: int, p: int, level: int) -> tuple:
+        levels = self.primitive_levels[(m, p)]
+        # Primitives too small to simplify draw their full mesh at every level
+        return levels[level] if level < len(levels) else levels[0]
+
+    def init_gl(self, shader_cache: ShaderCache, resources: ResourcePool):
+        # Models without textures get the variant that never samples one
+        self.program = shader_cache.get_shader('main', ('COLOR_TEXTURE',) if self.gltf.textures else ())
+        self.resources = resources
+
+        self.upload_geometry(resources)
+        self.primitive_bounds = {key: geometry.bounds for (key, geometry) in self.geometry.items()}
+
+        # Only the coarse mips are uploaded here, the TextureStreamer raises them as they are seen
+        self.textures = []
+        for (i, texture) in enumerate(self.gltf.textures):
+            sampler = self.gltf.samplers[texture.sampler]
+            sampler = (sampler.minFilter, sampler.magFilter, sampler.wrapS, sampler.wrapT)
+            mips = self.images[i]
+            self.textures.append(resources.texture((self.image_hashes[i], sampler), functools.partial(StreamedTexture, mips, sampler), chain_bytes(mips[0].shape[1], mips[0].shape[0])))
+
+        self.build_materials()
+        self.animations = [AnimationClip(animation, samplers) for (animation, samplers) in zip(self.gltf.animations, self.animation_samplers)]
+        self.geometry_stats = [geometry.stats for geometry in self.geometry.values()]
+        self.finish_gl()
+
+        self.data = None
+        self.buffer_data = None
+        self.view_locks = None
+        self.images = None
+        self.geometry = None
+        self.animation_samplers = None
+
+    def finish_gl(self):
+        self.build_draw_list()
+        self.build_bounds()
+        if self.instanced:
+            self.instanced_renderer = InstancedRenderer(self)
+        # The first clip plays in a loop, animated objects are redrawn into shadow maps every time they move
+        self.transform_version = 0
+        self.changed_bounds = None
+        self.play(0 if self.animations else None)
+        self.ready = True
+
+    def play(self, animation: int = 0):
+        self.playing = self.animations[animation] if animation is not None else None
+        self.play_start = None
+        if self.playing:
+            self.dynamic = True
 
-        for (primitive, vao) in zip(mesh.primitives, primitive_vaos):
-            material = self.gltf.materials[primitive.material]
+    def set_transform(self, transform: glm.mat4):
+        self.transform = glm.mat4(transform)
+        self.hierarchy.set_root(self.transform)
 
+    def animate(self, time: float) -> int:
+        if self.playing:
+            if self.play_start is None:
+                self.play_start = time
+            self.playing.apply(self.hierarchy, time - self.play_start)
+        nodes = self.hierarchy.update()
+        if len(nodes) == 0:
+            return 0
+
+        updated = np.zeros(len(self.hierarchy.world), bool)
+        updated[nodes] = True
+        entries = np.flatnonzero(updated[self.draw_list.nodes])
+        # Rows are written in place, the draw commands hold views of them
+        self.draw_list.transforms[entries] = self.hierarchy.world[self.draw_list.nodes[entries]]
+        self.transform_version += 1
+        if len(entries):
+            self.update_bounds(entries)
+            if self.instanced:
+                self.instanced_renderer.update_transforms()
+        return len(nodes)
+
+    def spawn(self, transform: glm.mat4, dynamic: bool = None) -> 'GltfObject':
+        # Only the draw list and bounds are built again, buffers, textures and VAOs come from this object
+        obj = GltfObject(self.filename, self.instanced, self.dynamic if dynamic is None else dynamic, self.quantize, transform)
+        for name in SHARED_ATTRIBUTES:
+            setattr(obj, name, getattr(self, name))
+        obj.cache_hit = True
+        obj.finish_gl()
+        return obj
+
+    def build_materials(self):
+        self.materials = []
+        for material in self.gltf.materials:
+            texture = None
+            base_color = (1.0, 1.0, 1.0)
             if material.pbrMetallicRoughness:
                 baseColorTexture = material.pbrMetallicRoughness.baseColorTexture
                 if baseColorTexture:
-                    location = program.uniform_location('color_texture')
-                    if location != -1:
-                        tex = baseColorTexture.index
-                        GL.glActiveTexture(GL.GL_TEXTURE1)
-                        GL.glBindTexture(GL.GL_TEXTURE_2D, self.textures[tex])
-                        GL.glUniform1iv(location, 1, 1)
-                        GL.glUniform1iv(program.uniform_location('has_color_texture'), 1, 1)
+                    texture = baseColorTexture.index
                 else:
-                    location = program.uniform_location('base_color')
-                    if location != -1:
-                        color = material.pbrMetallicRoughness.baseColorFactor
-                        GL.glUniform3fv(location, 1, color)
-                        GL.glUniform1iv(program.uniform_location('has_color_texture'), 1, 0)
-
-            GL.glBindVertexArray(vao)
-            accessor = self.gltf.accessors[primitive.indices]
-            GL.glDrawElements(GL.GL_TRIANGLES, accessor.count, GL.GL_UNSIGNED_INT, ctypes.c_void_p(accessor.byteOffset))
-
-    def draw_node(self, node: pygltflib.Node, model_transform: glm.mat4, program: Shader):
-        if node.matrix:
-            model_transform = model_transform * glm.mat4(*node.matrix)
-
-        if node.mesh is not None:
-            self.draw_mesh(self.gltf.meshes[node.mesh], model_transform, program, self.mesh_vaos[node.mesh])
-        
-        for n in node.children:
-            child_node = self.gltf.nodes[n]
-            
-            self.draw_node(child_node, model_transform, program)
-
-    def render(self, program: Shader):
-        model_transform = glm.mat4()
+                    base_color = tuple(material.pbrMetallicRoughness.baseColorFactor[:3])
+            self.materials.append((texture, base_color))
+        self.default_material = len(self.materials)
+        self.materials.append((None, (1.0, 1.0, 1.0)))
+        self.material_buffer = MaterialBuffer(self.materials)
+
+    def build_draw_list(self):
+        self.hierarchy = NodeHierarchy(self.gltf, self.transform)
+        entries = []
+
+        def visit(index: int):
+            node = self.gltf.nodes[index]
+            if node.mesh is not None:
+                mesh = self.gltf.meshes[node.mesh]
+                for (p, primitive) in enumerate(mesh.primitives):
+                    material = primitive.material if primitive.material is not None else self.default_material
+                    levels = [self.primitive_level(node.mesh, p, level) for level in range(self.lod_count)]
+                    levels = [(self.layout_vaos[layout], count, offset, base_vertex) for (layout, count, offset, base_vertex) in levels]
+                    entries.append((self.hierarchy.world[index], index, node.mesh, p, *levels[0], self.index_types[(node.mesh, p)], material, levels))
+
+            for n in node.children:
+                visit(n)
+
         scene = self.gltf.scenes[self.gltf.scene]
         for node in scene.nodes:
-            self.draw_node(self.gltf.nodes[node], model_transform, program)
+            visit(node)
+
+        self.draw_list = DrawList(entries, self.lod_count)
+
+        textures = np.array([self.materials[m][0] if self.materials[m][0] is not None else -1 for m in self.draw_list.materials.tolist()], np.int64)
+        order = np.lexsort((self.draw_list.nodes, self.draw_list.vaos, self.draw_list.materials, textures))
+        self.draw_list.reorder(order)
+        self.entry_textures = textures[order]
+
+    def build_bounds(self):
+        local_bounds = [self.primitive_bounds[key] for key in zip(self.draw_list.meshes.tolist(), self.draw_list.primitives.tolist())]
+        self.local_min = np.array([bounds[0] for bounds in local_bounds], np.float32).reshape(-1, 3)
+        self.local_max = np.array([bounds[1] for bounds in local_bounds], np.float32).reshape(-1, 3)
+        (self.bounds_min, self.bounds_max) = transform_bounds(self.local_min, self.local_max, self.draw_list.transforms)
+        self.bvh = BVH(self.bounds_min, self.bounds_max)
+        (self.node_indices, self.entry_nodes) = np.unique(self.draw_list.nodes, return_inverse=True)
+        self.build_node_bounds()
+
+    def update_bounds(self, entries: np.ndarray):
+        # Lights redraw whatever the moved entries covered before and after
+        (bounds_min, bounds_max) = transform_bounds(self.local_min[entries], self.local_max[entries], self.draw_list.transforms[entries])
+        self.changed_bounds = (
+            np.minimum(self.bounds_min[entries].min(axis=0), bounds_min.min(axis=0)),
+            np.maximum(self.bounds_max[entries].max(axis=0), bounds_max.max(axis=0)))
+        self.bounds_min[entries] = bounds_min
+        self.bounds_max[entries] = bounds_max
+        self.bvh.refit(self.bounds_min, self.bounds_max)
+        self.build_node_bounds()
+
+    def build_node_bounds(self):
+        # LODs are chosen per node, from the sphere around all of its primitives
+        nodes = self.node_indices
+        node_min = np.full((len(nodes), 3), np.inf, np.float32)
+        node_max = np.full((len(nodes), 3), -np.inf, np.float32)
+        np.minimum.at(node_min, self.entry_nodes, self.bounds_min)
+        np.maximum.at(node_max, self.entry_nodes, self.bounds_max)
+        self.node_centers = (node_min + node_max) / 2
+        self.node_radii = np.linalg.norm(node_max - node_min, axis=1) / 2
+
+    def select_lods(self, camera: Camera) -> np.ndarray:
+        if self.lod_count == 1:
+            return None
+        levels = select_levels(self.node_centers, self.node_radii, np.array(camera.position.to_list(), np.float32), camera.vertical_fov, self.lod_count)
+        return levels[self.entry_nodes]
+
+    def cull(self, planes: np.ndarray, occlusion: DepthPyramid = None) -> np.ndarray:
+        return self.bvh.cull(planes, occlusion)
+
+    def request_textures(self, streamer: TextureStreamer, visible: np.ndarray, camera: Camera, viewport_height: int):
+        entries = np.flatnonzero(visible & (self.entry_textures >= 0))
+        if len(entries) == 0:
+            return
+
+        # The finest level needed is where one texel covers about a pixel, assuming each texture spans its node once
+        nodes = self.entry_nodes[entries]
+        radii = self.node_radii[nodes]
+        distances = np.linalg.norm(self.node_centers[nodes] - np.array(camera.position.to_list(), np.float32), axis=1)
+        pixels = radii / np.maximum(distances, radii + 1e-6) / math.tan(math.radians(camera.vertical_fov) / 2) * viewport_height
+        textures = self.entry_textures[entries]
+        sizes = np.array([max(texture.mips[0].shape[:2]) for texture in self.textures], np.float32)[textures]
+        levels = np.floor(np.log2(np.maximum(sizes / np.maximum(pixels, 1), 1))).astype(np.int64)
+
+        wanted = np.full(len(self.textures), np.iinfo(np.int64).max)
+        np.minimum.at(wanted, textures, levels)
+        for i in np.flatnonzero(wanted != np.iinfo(np.int64).max).tolist():
+            streamer.request(self.textures[i], int(wanted[i]))
+
+    def material_locations(self, program: Shader) -> tuple:
+        return (program.uniform_location('color_texture'), program.uniform_location('material_index'))
+
+    def bind_material(self, state: GLState, locations: tuple, material: int):
+        (color_texture_location, material_index_location) = locations
+        if material_index_location == -1:
+            return
+
+        state.uniform_1i(material_index_location, self.material_buffer.bind(state, material))
+        state.uniform_1i(color_texture_location, 1)
+        texture = self.materials[material][0]
+        if texture is not None:
+            state.bind_texture(1, GL.GL_TEXTURE_2D, self.textures[texture].texture)
+
+    def render(self, program: Shader, state: GLState, visible: np.ndarray = None, levels: np.ndarray = None):
+        locations = self.material_locations(program)
+        if self.instanced:
+            self.instanced_renderer.render(program, state, locations, visible, levels)
+            return
+
+        model_location = program.uniform_location('model_transform')
+        state.uniform_1i(program.uniform_location('instanced'), 0)
+
+        commands = self.draw_list.commands
+        if levels is not None:
+            level_commands = self.draw_list.level_commands
+            indices = np.flatnonzero(visible) if visible is not None else np.arange(len(commands))
+            commands = [level_commands[level][i] for (i, level) in zip(indices.tolist(), levels[indices].tolist())]
+        elif visible is not None:
+            commands = [commands[i] for i in np.flatnonzero(visible).tolist()]
+
+        for (transform, node, vao, count, index_type, offset, base_vertex, material) in commands:
+            state.uniform_matrix4(model_location, (self, node, self.transform_version), transform)
+            self.bind_material(state, locations, material)
+            state.bind_vertex_array(vao)
+            GL.glDrawElementsBaseVertex(GL.GL_TRIANGLES, count, index_type, offset, base_vertex)
+            state.count_draw(count // 3)
+
+SKYBOX_FACES = {
+    GL.GL_TEXTURE_CUBE_MAP_POSITIVE_X: (2, 1),
+    GL.GL_TEXTURE_CUBE_MAP_NEGATIVE_X: (0, 1),
+    GL.GL_TEXTURE_CUBE_MAP_POSITIVE_Y: (1, 0),
+    GL.GL_TEXTURE_CUBE_MAP_NEGATIVE_Y: (1, 2),
+    GL.GL_TEXTURE_CUBE_MAP_POSITIVE_Z: (1, 1),
+    GL.GL_TEXTURE_CUBE_MAP_NEGATIVE_Z: (3, 1)
+}
 
 class Skybox:
     def __init__(self, filename):
         self.filename = filename
+        self.ready = False
+        self.cache_hit = False
+
+    def parse(self, cache: AssetCache = None):
+        self.cache_key = cache.key(self.filename) if cache else None
+        entry = cache.lookup(self.filename, self.cache_key) if cache else None
+        if entry:
+            self.cache_hit = True
+            self.face_size = entry.manifest['face_size']
+            self.faces = {face: entry.array('face_%i' % face) for face in SKYBOX_FACES}
+            return
+
+        self.image = Image.open(self.filename)
+        self.image.load()
+        self.face_size = self.image.width / 4
+        self.faces = {}
+
+    def decode_tasks(self) -> list:
+        if self.cache_hit:
+            return []
+        return [functools.partial(self.decode_face, face) for face in SKYBOX_FACES]
+
+    def decode_face(self, face: int):
+        (column, row) = SKYBOX_FACES[face]
+        (x, y) = (self.face_size * column, self.face_size * row)
+        self.faces[face] = np.asarray(self.image.crop((x, y, x + self.face_size, y + self.face_size)))
+
+    def store(self, cache: AssetCache = None):
+        if cache is None or self.cache_hit:
+            return
 
-    def init_gl(self, shader_cache: ShaderCache):
+        arrays = {'face_%i' % face: pixels for (face, pixels) in self.faces.items()}
+        cache.store(self.cache_key, {'source': self.filename, 'face_size': self.face_size}, arrays)
+
+    def init_gl(self, shader_cache: ShaderCache, resources: ResourcePool):
         self.program = shader_cache.get_shader('skybox')
 
         self.vao = GL.glGenVertexArrays(1)
@@ -176,39 +562,35 @@ class Skybox:
         GL.glBufferData(GL.GL_ELEMENT_ARRAY_BUFFER, index_data, GL.GL_STATIC_DRAW)
         GL.glBindVertexArray(0)
 
-        pil_image = Image.open(self.filename)
-        self.texture = GL.glGenTextures(1)
+        face_size = int(self.face_size)
+        key = ('skybox', self.cache_key or file_hash(self.filename))
+        self.texture = resources.texture(key, self.create_texture, face_size * face_size * BYTES_PER_TEXEL * len(SKYBOX_FACES))
+        GL.glEnable(GL.GL_TEXTURE_CUBE_MAP_SEAMLESS)
+
+        self.image = None
+        self.faces = None
+        self.ready = True
+
+    def create_texture(self) -> int:
+        texture = GL.glGenTextures(1)
         GL.glActiveTexture(GL.GL_TEXTURE0)
-        GL.glBindTexture(GL.GL_TEXTURE_CUBE_MAP, self.texture)
+        GL.glBindTexture(GL.GL_TEXTURE_CUBE_MAP, texture)
         GL.glTexParameteri(GL.GL_TEXTURE_CUBE_MAP, GL.GL_TEXTURE_MIN_FILTER, GL.GL_LINEAR)
         GL.glTexParameteri(GL.GL_TEXTURE_CUBE_MAP, GL.GL_TEXTURE_MAG_FILTER, GL.GL_LINEAR)
-        
-        face_size = pil_image.width / 4
-
-        face_map = {
-            GL.GL_TEXTURE_CUBE_MAP_POSITIVE_X: (face_size * 2, face_size),
-            GL.GL_TEXTURE_CUBE_MAP_NEGATIVE_X: (0, face_size),
-            GL.GL_TEXTURE_CUBE_MAP_POSITIVE_Y: (face_size, 0),
-            GL.GL_TEXTURE_CUBE_MAP_NEGATIVE_Y: (face_size, face_size * 2),
-            GL.GL_TEXTURE_CUBE_MAP_POSITIVE_Z: (face_size, face_size),
-            GL.GL_TEXTURE_CUBE_MAP_NEGATIVE_Z: (face_size * 3, face_size)
-        }
 
-        for face in face_map:
-            (x, y) = face_map[face]
-            face_image = pil_image.crop((x, y, x + face_size, y + face_size))
-            GL.glTexImage2D(face, 0, GL.GL_RGB, face_size, face_size, 0, GL.GL_RGB, GL.GL_UNSIGNED_BYTE, face_image.tobytes())
+        face_size = self.face_size
+        for face in SKYBOX_FACES:
+            GL.glTexImage2D(face, 0, GL.GL_RGB, face_size, face_size, 0, GL.GL_RGB, GL.GL_UNSIGNED_BYTE, self.faces[face])
         GL.glGenerateMipmap(GL.GL_TEXTURE_CUBE_MAP)
-        GL.glEnable(GL.GL_TEXTURE_CUBE_MAP_SEAMLESS)
+        return texture
 
-    def render(self):
+    def render(self, state: GLState):
         GL.glDepthFunc(GL.GL_LEQUAL)
-        GL.glBindVertexArray(self.vao)
+        state.bind_vertex_array(self.vao)
 
-        GL.glActiveTexture(GL.GL_TEXTURE0)
-        GL.glBindTexture(GL.GL_TEXTURE_CUBE_MAP, self.texture)
-        GL.glUniform1iv(self.program.uniform_location('skybox_texture'), 1, 0)
+        state.bind_texture(0, GL.GL_TEXTURE_CUBE_MAP, self.texture)
+        state.uniform_1i(self.program.uniform_location('skybox_texture'), 0)
     
         GL.glDrawElements(GL.GL_TRIANGLES, 12 * 3, GL.GL_UNSIGNED_INT, ctypes.c_void_p(0))
-        GL.glBindVertexArray(0)
+        state.count_draw(12)
         GL.glDepthFunc(GL.GL_LESS)
\ No newline at end of file
@@ -0,0 +1,142 @@
+from shaders import ShaderCache
+from glstate import GLState
+
+from OpenGL import GL
+
+import ctypes
+import glm
+import numpy as np
+
+# Absorbs depth buffer quantization so surfaces never occlude their own bounds
+DEPTH_BIAS = 1e-5
+
+BOX_CORNERS = np.array([[x, y, z] for x in (-1, 1) for y in (-1, 1) for z in (-1, 1)], np.float32)
+
+class DepthPyramid:
+    def __init__(self, depth: np.ndarray, view_projection: glm.mat4, screen_size: tuple[int, int], scale: int):
+        self.view_projection = np.array(view_projection, np.float64)
+        self.screen_size = screen_size
+        self.scale = scale
+        self.levels = [depth]
+        while depth.shape[0] > 1 or depth.shape[1] > 1:
+            depth = np.pad(depth, ((0, depth.shape[0] % 2), (0, depth.shape[1] % 2)), mode='edge')
+            depth = depth.reshape(depth.shape[0] // 2, 2, depth.shape[1] // 2, 2).max(axis=(1, 3))
+            self.levels.append(depth)
+
+    def test(self, centers: np.ndarray, extents: np.ndarray) -> np.ndarray:
+        corners = centers[:, None, :] + extents[:, None, :] * BOX_CORNERS
+        clip = corners @ self.view_projection[:, :3].T + self.view_projection[:, 3]
+        w = clip[:, :, 3]
+        # Boxes crossing the near plane cover an unbounded part of the screen
+        near = ((w <= 1e-6) | (clip[:, :, 2] < -w)).any(axis=1)
+        ndc = clip[:, :, :3] / np.maximum(w, 1e-6)[:, :, None]
+        depth = ndc[:, :, 2].min(axis=1) * .5 + .5
+
+        (height, width) = self.levels[0].shape
+        x = (ndc[:, :, 0] * .5 + .5) * (self.screen_size[0] / self.scale)
+        y = (ndc[:, :, 1] * .5 + .5) * (self.screen_size[1] / self.scale)
+        x0 = np.clip(np.floor(x.min(axis=1)), 0, width - 1).astype(np.int64)
+        x1 = np.clip(np.floor(x.max(axis=1)), 0, width - 1).astype(np.int64)
+        y0 = np.clip(np.floor(y.min(axis=1)), 0, height - 1).astype(np.int64)
+        y1 = np.clip(np.floor(y.max(axis=1)), 0, height - 1).astype(np.int64)
+
+        # The level where the rectangle spans at most 2x2 texels, so four lookups cover it
+        span = np.maximum(x1 - x0, y1 - y0)
+        level = np.minimum(np.ceil(np.log2(span + 1)).astype(np.int64), len(self.levels) - 1)
+
+        max_depth = np.ones(len(centers))
+        for l in np.unique(level).tolist():
+            mask = level == l
+            data = self.levels[l]
+            (lx0, lx1, ly0, ly1) = (x0[mask] >> l, x1[mask] >> l, y0[mask] >> l, y1[mask] >> l)
+            max_depth[mask] = np.maximum(np.maximum(data[ly0, lx0], data[ly0, lx1]), np.maximum(data[ly1, lx0], data[ly1, lx1]))
+        return ~near & (depth > max_depth + DEPTH_BIAS)
+
+class HiZBuffer:
+    def __init__(self, max_size: int = 128):
+        self.max_size = max_size
+        self.size = None
+        self.levels = []
+        self.pending = [None, None]
+        self.frame_index = 0
+        self.pyramid = None
+
+    def init_gl(self, shader_cache: ShaderCache):
+        self.program = shader_cache.get_shader('hiz')
+        self.pixel_buffers = np.atleast_1d(GL.glGenBuffers(2)).tolist()
+
+    def resize(self, width: int, height: int):
+        for (texture, fbo, _, _) in self.levels:
+            GL.glDeleteTextures([texture])
+            GL.glDeleteFramebuffers(1, [fbo])
+        self.levels = []
+        self.size = (width, height)
+        self.scale = 1
+        self.pending = [None, None]
+        self.pyramid = None
+
+        while not self.levels or max(width, height) > self.max_size:
+            (width, height) = ((width + 1) // 2, (height + 1) // 2)
+            self.scale *= 2
+            texture = GL.glGenTextures(1)
+            GL.glBindTexture(GL.GL_TEXTURE_2D, texture)
+            GL.glTexParameteri(GL.GL_TEXTURE_2D, GL.GL_TEXTURE_MIN_FILTER, GL.GL_NEAREST)
+            GL.glTexParameteri(GL.GL_TEXTURE_2D, GL.GL_TEXTURE_MAG_FILTER, GL.GL_NEAREST)
+            GL.glTexImage2D(GL.GL_TEXTURE_2D, 0, GL.GL_R32F, width, height, 0, GL.GL_RED, GL.GL_FLOAT, None)
+            fbo = GL.glGenFramebuffers(1)
+            GL.glBindFramebuffer(GL.GL_FRAMEBUFFER, fbo)
+            GL.glFramebufferTexture2D(GL.GL_FRAMEBUFFER, GL.GL_COLOR_ATTACHMENT0, GL.GL_TEXTURE_2D, texture, 0)
+            self.levels.append((texture, fbo, width, height))
+        GL.glBindTexture(GL.GL_TEXTURE_2D, 0)
+
+        for pixel_buffer in self.pixel_buffers:
+            GL.glBindBuffer(GL.GL_PIXEL_PACK_BUFFER, pixel_buffer)
+            GL.glBufferData(GL.GL_PIXEL_PACK_BUFFER, width * height * 4, None, GL.GL_STREAM_READ)
+        GL.glBindBuffer(GL.GL_PIXEL_PACK_BUFFER, 0)
+
+    def build(self, depth_texture: int, width: int, height: int, view_projection: glm.mat4, state: GLState):
+        if self.size != (width, height):
+            self.resize(width, height)
+            state.invalidate()
+
+        GL.glDisable(GL.GL_DEPTH_TEST)
+        state.use_program(self.program.program)
+        state.uniform_1i(self.program.uniform_location('source'), 0)
+        (source, source_width, source_height) = (depth_texture, width, height)
+        for (texture, fbo, level_width, level_height) in self.levels:
+            GL.glBindFramebuffer(GL.GL_FRAMEBUFFER, fbo)
+            GL.glViewport(0, 0, level_width, level_height)
+            state.bind_texture(0, GL.GL_TEXTURE_2D, source)
+            state.uniform_2i(self.program.uniform_location('source_size'), (source_width, source_height))
+            GL.glDrawArrays(GL.GL_TRIANGLE_FAN, 0, 4)
+            state.count_draw(2)
+            (source, source_width, source_height) = (texture, level_width, level_height)
+        GL.glEnable(GL.GL_DEPTH_TEST)
+
+        # Copied into a pixel buffer and only mapped next frame, so the CPU never waits on it
+        slot = self.frame_index % len(self.pixel_buffers)
+        GL.glBindBuffer(GL.GL_PIXEL_PACK_BUFFER, self.pixel_buffers[slot])
+        GL.glReadPixels(0, 0, source_width, source_height, GL.GL_RED, GL.GL_FLOAT, ctypes.c_void_p(0))
+        GL.glBindBuffer(GL.GL_PIXEL_PACK_BUFFER, 0)
+        if self.pending[slot] is not None:
+            GL.glDeleteSync(self.pending[slot][0])
+        self.pending[slot] = (GL.glFenceSync(GL.GL_SYNC_GPU_COMMANDS_COMPLETE, 0), glm.mat4(view_projection))
+        self.frame_index += 1
+
+    def update(self) -> DepthPyramid:
+        slot = (self.frame_index - 1) % len(self.pixel_buffers)
+        if self.pending[slot] is None:
+            return self.pyramid
+        (fence, view_projection) = self.pending[slot]
+        # Keep culling against the older pyramid rather than stall on an unfinished copy
+        if GL.glClientWaitSync(fence, 0, 0) in (GL.GL_TIMEOUT_EXPIRED, GL.GL_WAIT_FAILED):
+            return self.pyramid
+        GL.glDeleteSync(fence)
+        self.pending[slot] = None
+
+        (_, _, width, height) = self.levels[-1]
+        GL.glBindBuffer(GL.GL_PIXEL_PACK_BUFFER, self.pixel_buffers[slot])
+        depth = GL.glGetBufferSubData(GL.GL_PIXEL_PACK_BUFFER, 0, width * height * 4)
+        GL.glBindBuffer(GL.GL_PIXEL_PACK_BUFFER, 0)
+        self.pyramid = DepthPyramid(np.asarray(depth).view(np.float32).reshape(height, width), view_projection, self.size, self.scale)
+        return self.pyramid
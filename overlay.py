@@ -0,0 +1,99 @@
+from shaders import ShaderCache
+from glstate import GLState
+from profiler import Profiler
+
+from OpenGL import GL
+from PIL import Image, ImageDraw, ImageFont
+
+import time
+import numpy as np
+
+class ProfilerOverlay:
+    def __init__(self, refresh_interval: float = 0.25):
+        self.refresh_interval = refresh_interval
+        self.last_refresh_time = 0
+        self.size = (0, 0)
+
+    def init_gl(self, shader_cache: ShaderCache):
+        self.program = shader_cache.get_shader('overlay')
+        self.font = ImageFont.load_default()
+        self.texture = GL.glGenTextures(1)
+        GL.glBindTexture(GL.GL_TEXTURE_2D, self.texture)
+        GL.glTexParameteri(GL.GL_TEXTURE_2D, GL.GL_TEXTURE_MIN_FILTER, GL.GL_NEAREST)
+        GL.glTexParameteri(GL.GL_TEXTURE_2D, GL.GL_TEXTURE_MAG_FILTER, GL.GL_NEAREST)
+        GL.glBindTexture(GL.GL_TEXTURE_2D, 0)
+
+    def rows(self, profiler: Profiler) -> list[tuple]:
+        rows = [('pass', 'cpu ms', 'gpu ms')]
+        names = list(profiler.frame_times)
+        names += [name for name in profiler.gpu_times if name not in profiler.frame_times]
+        for name in names:
+            cpu = profiler.frame_times.get(name)
+            gpu = profiler.gpu_times.get(name)
+            rows.append((name, '%.2f' % (cpu * 1000) if cpu is not None else '-', '%.2f' % (gpu * 1000) if gpu is not None else '-'))
+        counters = profiler.counters
+        if counters:
+            rows.append(('%i draws, %i triangles' % (counters['draw_calls'], counters['triangles']),))
+            rows.append(('%i state changes, %i skipped' % (counters['state_changes'], counters['state_changes_skipped']),))
+            if 'occluded' in counters:
+                rows.append(('%i visible, %i culled, %i occluded' % (counters['visible'], counters['culled'], counters['occluded']),))
+            if 'texture_bytes' in counters:
+                rows.append(('textures %.1f MB, streaming %.1f ms' % (counters['texture_bytes'] / (1 << 20), counters['texture_latency'] * 1000),))
+            if counters.get('updated_nodes'):
+                rows.append(('%i nodes updated' % counters['updated_nodes'],))
+            if 'render_scale' in counters:
+                rows.append(('render scale %.2f' % counters['render_scale'],))
+            if 'input_latency' in counters:
+                rows.append(('input latency %.1f ms' % (counters['input_latency'] * 1000),))
+        return rows
+
+    def update(self, state: GLState, profiler: Profiler):
+        now = time.perf_counter()
+        if now < self.last_refresh_time + self.refresh_interval:
+            return
+        self.last_refresh_time = now
+
+        rows = self.rows(profiler)
+        line_height = 14
+        column_widths = [0, 0, 0]
+        for row in rows:
+            if len(row) > 1:
+                for (column, text) in enumerate(row):
+                    column_widths[column] = max(column_widths[column], int(self.font.getlength(text)) + 12)
+        width = max([sum(column_widths)] + [int(self.font.getlength(row[0])) for row in rows]) + 8
+        height = line_height * len(rows) + 8
+
+        image = Image.new('RGBA', (width, height), (0, 0, 0, 160))
+        draw = ImageDraw.Draw(image)
+        for (i, row) in enumerate(rows):
+            x = 4
+            for (column, text) in enumerate(row):
+                # Numbers are right aligned in their column
+                offset = column_widths[column] - 12 - int(self.font.getlength(text)) if column > 0 else 0
+                draw.text((x + offset, 4 + i * line_height), text, font=self.font, fill=(255, 255, 255, 255))
+                x += column_widths[column]
+
+        state.bind_texture(0, GL.GL_TEXTURE_2D, self.texture)
+        GL.glTexImage2D(GL.GL_TEXTURE_2D, 0, GL.GL_RGBA, width, height, 0, GL.GL_RGBA, GL.GL_UNSIGNED_BYTE, np.asarray(image))
+        self.size = (width, height)
+
+    def render(self, state: GLState, width: int, height: int):
+        if self.size == (0, 0):
+            return
+
+        # Pinned to the top left corner at one texel per pixel
+        (overlay_width, overlay_height) = self.size
+        rect = (-1, 1 - 2 * overlay_height / height, -1 + 2 * overlay_width / width, 1)
+
+        GL.glDisable(GL.GL_DEPTH_TEST)
+        GL.glEnable(GL.GL_BLEND)
+        GL.glBlendFunc(GL.GL_SRC_ALPHA, GL.GL_ONE_MINUS_SRC_ALPHA)
+        state.use_program(self.program.program)
+        state.bind_texture(0, GL.GL_TEXTURE_2D, self.texture)
+        state.uniform_1i(self.program.uniform_location('overlay'), 0)
+        state.uniform_4f(self.program.uniform_location('rect'), rect)
+        GL.glDrawArrays(GL.GL_TRIANGLE_FAN, 0, 4)
+        state.count_draw(2)
+        state.use_program(0)
+        GL.glDisable(GL.GL_BLEND)
+        GL.glEnable(GL.GL_DEPTH_TEST)
@@ -0,0 +1,29 @@
+import time
+
+class FramePacer:
+    def __init__(self, fps_cap: float = 0):
+        self.frame_time = 1 / fps_cap if fps_cap > 0 else 0
+        self.next_frame_time = None
+        # How late sleep() tends to wake up, the last stretch before a deadline is spun instead
+        self.sleep_margin = 0.001
+
+    def wait(self):
+        if not self.frame_time:
+            return
+
+        now = time.perf_counter()
+        if self.next_frame_time is None:
+            self.next_frame_time = now
+
+        sleep_time = self.next_frame_time - now - self.sleep_margin
+        if sleep_time > 0:
+            time.sleep(sleep_time)
+            late = time.perf_counter() - (now + sleep_time)
+            self.sleep_margin = min(max(self.sleep_margin * .9 + late * .2, 0.0002), self.frame_time / 2)
+
+        # sleep(0) keeps the GIL free for the input thread while spinning
+        while time.perf_counter() < self.next_frame_time:
+            time.sleep(0)
+
+        # After a hitch the schedule restarts rather than rendering a burst of frames to catch up
+        self.next_frame_time = max(self.next_frame_time + self.frame_time, time.perf_counter())
@@ -0,0 +1,160 @@
+from glstate import GLState
+
+from OpenGL import GL
+from OpenGL.raw.GL.VERSION.GL_3_2 import glGetInteger64v
+from OpenGL.raw.GL.VERSION.GL_3_3 import glGetQueryObjectui64v
+
+import collections
+import contextlib
+import ctypes
+import json
+import time
+import numpy as np
+
+# Queries are read back this many frames later so the CPU never waits on the GPU
+QUERY_LATENCY = 2
+
+# Input latency is averaged over this many of the most recent inputs
+INPUT_LATENCY_SAMPLES = 60
+
+class ProfileEvent:
+    def __init__(self, name: str, depth: int, cpu_start: float):
+        self.name = name
+        self.depth = depth
+        self.cpu_start = cpu_start
+        self.cpu_end = cpu_start
+        self.queries = None
+        self.gpu_start = None
+        self.gpu_end = None
+
+class Profiler:
+    def __init__(self):
+        self.frame_times = {}
+        self.gpu_times = {}
+        self.counters = {}
+        self.events = []
+        self.depth = 0
+        self.frame_index = 0
+        self.gpu_enabled = False
+        self.trace = None
+        self.input_latencies = collections.deque(maxlen=INPUT_LATENCY_SAMPLES)
+        self.present_queries = collections.deque()
+
+    def init_gl(self):
+        major = GL.glGetIntegerv(GL.GL_MAJOR_VERSION)
+        minor = GL.glGetIntegerv(GL.GL_MINOR_VERSION)
+        self.gpu_enabled = (int(major), int(minor)) >= (3, 3)
+        self.free_queries = []
+        self.in_flight = [None] * QUERY_LATENCY
+        if self.gpu_enabled:
+            # Lines GPU timestamps up with perf_counter for the trace
+            timestamp = ctypes.c_int64()
+            glGetInteger64v(GL.GL_TIMESTAMP, ctypes.byref(timestamp))
+            self.gpu_clock_offset = time.perf_counter() - timestamp.value / 1e9
+
+    def allocate_query(self) -> int:
+        if not self.free_queries:
+            self.free_queries = np.atleast_1d(GL.glGenQueries(64)).tolist()
+        return self.free_queries.pop()
+
+    def read_query(self, query: int) -> float:
+        result = ctypes.c_uint64()
+        glGetQueryObjectui64v(query, GL.GL_QUERY_RESULT, ctypes.byref(result))
+        return result.value / 1e9 + self.gpu_clock_offset
+
+    def begin_section(self, name: str, gpu: bool = False) -> ProfileEvent:
+        event = ProfileEvent(name, self.depth, time.perf_counter())
+        self.events.append(event)
+        if gpu and self.gpu_enabled:
+            # Timestamps rather than GL_TIME_ELAPSED, which cannot nest
+            event.queries = (self.allocate_query(), self.allocate_query())
+            GL.glQueryCounter(event.queries[0], GL.GL_TIMESTAMP)
+        self.depth += 1
+        return event
+
+    def end_section(self, event: ProfileEvent):
+        self.depth -= 1
+        if event.queries:
+            GL.glQueryCounter(event.queries[1], GL.GL_TIMESTAMP)
+        event.cpu_end = time.perf_counter()
+        self.frame_times[event.name] = self.frame_times.get(event.name, 0) + event.cpu_end - event.cpu_start
+
+    @contextlib.contextmanager
+    def section(self, name: str, gpu: bool = False):
+        event = self.begin_section(name, gpu)
+        try:
+            yield event
+        finally:
+            self.end_section(event)
+
+    def begin_frame(self):
+        self.frame_times = {}
+        self.events = []
+        self.depth = 0
+        self.frame_event = self.begin_section('frame', gpu=True)
+
+    def end_frame(self, state: GLState, counters: dict = None):
+        self.end_section(self.frame_event)
+        self.counters = {
+            'draw_calls': state.draw_calls,
+            'triangles': state.triangles,
+            'state_changes': state.issued,
+            'state_changes_skipped': state.skipped
+        }
+        self.counters.update(counters or {})
+        self.resolve_presents()
+        if self.input_latencies:
+            self.counters['input_latency'] = sum(self.input_latencies) / len(self.input_latencies)
+
+        slot = self.frame_index % QUERY_LATENCY
+        if self.in_flight[slot] is not None:
+            self.resolve(*self.in_flight[slot])
+        self.in_flight[slot] = (self.events, self.counters)
+        self.frame_index += 1
+
+    def resolve(self, events: list[ProfileEvent], counters: dict):
+        gpu_times = {}
+        for event in events:
+            if event.queries:
+                event.gpu_start = self.read_query(event.queries[0])
+                event.gpu_end = self.read_query(event.queries[1])
+                gpu_times[event.name] = gpu_times.get(event.name, 0) + event.gpu_end - event.gpu_start
+                self.free_queries.extend(event.queries)
+                event.queries = None
+        self.gpu_times = gpu_times
+
+        if self.trace is not None:
+            self.trace_frame(events, counters)
+
+    def record_present(self, input_time: float):
+        # Input to photon, approximated by the GPU finishing the first frame that reflects the input
+        if not self.gpu_enabled:
+            self.input_latencies.append(time.perf_counter() - input_time)
+            return
+        query = self.allocate_query()
+        GL.glQueryCounter(query, GL.GL_TIMESTAMP)
+        self.present_queries.append((query, input_time))
+
+    def resolve_presents(self):
+        while self.present_queries and GL.glGetQueryObjectuiv(self.present_queries[0][0], GL.GL_QUERY_RESULT_AVAILABLE):
+            (query, input_time) = self.present_queries.popleft()
+            self.input_latencies.append(self.read_query(query) - input_time)
+            self.free_queries.append(query)
+
+    def start_trace(self):
+        self.trace = [
+            {'name': 'thread_name', 'ph': 'M', 'pid': 1, 'tid': 1, 'args': {'name': 'CPU'}},
+            {'name': 'thread_name', 'ph': 'M', 'pid': 1, 'tid': 2, 'args': {'name': 'GPU'}}
+        ]
+
+    def trace_frame(self, events: list[ProfileEvent], counters: dict):
+        for event in events:
+            self.trace.append({'name': event.name, 'ph': 'X', 'pid': 1, 'tid': 1, 'ts': event.cpu_start * 1e6, 'dur': (event.cpu_end - event.cpu_start) * 1e6})
+            if event.gpu_start is not None:
+                self.trace.append({'name': event.name, 'ph': 'X', 'pid': 1, 'tid': 2, 'ts': event.gpu_start * 1e6, 'dur': (event.gpu_end - event.gpu_start) * 1e6})
+        if events:
+            self.trace.append({'name': 'counters', 'ph': 'C', 'pid': 1, 'ts': events[0].cpu_start * 1e6, 'args': counters})
+
+    def write_trace(self, filename: str):
+        with open(filename, 'w') as file:
+            json.dump({'traceEvents': self.trace or [], 'displayTimeUnit': 'ms'}, file)
@@ -0,0 +1,57 @@
+import math
+
+# Render scales are rounded to this step so small corrections don't reallocate the render target
+SCALE_STEP = 0.05
+MIN_SCALE = 0.5
+MAX_SCALE = 2.0
+# Largest relative change in one adjustment
+MAX_STEP = 0.15
+# The scale only rises while the GPU uses less than this share of the budget, between that and the budget it is left alone
+HEADROOM = 0.8
+# GPU times are read back a few frames late, after a change the next ones still measure the old scale
+COOLDOWN_FRAMES = 8
+SMOOTHING = 0.2
+# Smoothed samples needed before acting, so a single slow frame never changes the scale
+MIN_SAMPLES = 4
+
+class ResolutionController:
+    def __init__(self, target_frame_time: float, scale: float = 1.0, min_scale: float = MIN_SCALE, max_scale: float = MAX_SCALE):
+        self.target_frame_time = target_frame_time
+        self.min_scale = min_scale
+        self.max_scale = max_scale
+        self.scale = scale
+        self.gpu_time = None
+        self.samples = 0
+        self.cooldown = COOLDOWN_FRAMES
+        self.changes = 0
+
+    def update(self, gpu_time: float) -> float:
+        if not gpu_time:
+            return self.scale
+        if self.cooldown > 0:
+            self.cooldown -= 1
+            return self.scale
+        self.gpu_time = gpu_time if self.gpu_time is None else self.gpu_time + (gpu_time - self.gpu_time) * SMOOTHING
+        self.samples += 1
+        if self.samples < MIN_SAMPLES:
+            return self.scale
+
+        over_budget = self.gpu_time > self.target_frame_time
+        if not over_budget and self.gpu_time >= self.target_frame_time * HEADROOM:
+            return self.scale
+
+        # Fragment work grows with the pixel count, so the side length follows the square root of the time ratio
+        step = min(max(math.sqrt(self.target_frame_time / self.gpu_time), 1 - MAX_STEP), 1 + MAX_STEP)
+        scale = round(self.scale * step / SCALE_STEP) * SCALE_STEP
+        scale = min(scale, self.scale - SCALE_STEP) if over_budget else max(scale, self.scale + SCALE_STEP)
+        scale = round(min(max(scale, self.min_scale), self.max_scale), 2)
+        if scale == self.scale:
+            return self.scale
+
+        self.scale = scale
+        self.changes += 1
+        # Samples from the old scale are skipped, then the smoothed time starts over
+        self.cooldown = COOLDOWN_FRAMES
+        self.gpu_time = None
+        self.samples = 0
+        return self.scale
@@ -0,0 +1,113 @@
+from OpenGL import GL
+
+import ctypes
+import hashlib
+import numpy as np
+
+# Buffer views are packed into shared GL buffers of at most this size
+BUFFER_ARENA_SIZE = 64 << 20
+
+def content_hash(data) -> str:
+    return hashlib.blake2b(np.ascontiguousarray(np.frombuffer(data, np.uint8) if isinstance(data, (bytes, memoryview)) else data), digest_size=16).hexdigest()
+
+def file_hash(filename: str) -> str:
+    digest = hashlib.blake2b(digest_size=16)
+    with open(filename, 'rb') as file:
+        for chunk in iter(lambda: file.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def create_vao(vertex_buffer: int, stride: int, attributes: tuple, index_buffer: int) -> int:
+    vao = GL.glGenVertexArrays(1)
+    GL.glBindVertexArray(vao)
+    GL.glBindBuffer(GL.GL_ARRAY_BUFFER, vertex_buffer)
+    for (location, size, component_type, normalized, offset) in attributes:
+        GL.glEnableVertexAttribArray(location)
+        GL.glVertexAttribPointer(location, size, component_type, normalized, stride, ctypes.c_void_p(offset))
+    GL.glBindBuffer(GL.GL_ELEMENT_ARRAY_BUFFER, index_buffer)
+    GL.glBindVertexArray(0)
+    GL.glBindBuffer(GL.GL_ARRAY_BUFFER, 0)
+    return vao
+
+class ResourcePool:
+    # Content addressed GPU resources shared by every object in a scene
+    def __init__(self):
+        self.chunks = {}
+        self.buffers = []
+        self.vaos = {}
+        # Instance buffer and first instance each pooled instanced VAO currently reads from
+        self.instance_sources = {}
+        self.textures = {}
+        self.requested_bytes = 0
+        self.unique_bytes = 0
+        self.requested_texture_bytes = 0
+        self.unique_texture_bytes = 0
+        self.texture_requests = 0
+
+    def upload(self, chunks: list[tuple]) -> dict:
+        # Chunks already in the pool are reused, new ones with the same target and alignment are packed into shared buffers
+        placements = {}
+        arenas = []
+        open_arenas = {}
+        new_chunks = {}
+        for (key, target, alignment, data) in chunks:
+            self.requested_bytes += data.nbytes
+            content = (target, alignment, content_hash(data))
+            if content in self.chunks:
+                placements[key] = self.chunks[content]
+                continue
+            if content in new_chunks:
+                new_chunks[content].append(key)
+                continue
+            new_chunks[content] = [key]
+
+            arena = open_arenas.get((target, alignment))
+            if arena is None or (arena[1] > 0 and arena[1] + data.nbytes > BUFFER_ARENA_SIZE):
+                arena = [target, 0, []]
+                arenas.append(arena)
+                open_arenas[(target, alignment)] = arena
+            offset = (arena[1] + alignment - 1) // alignment * alignment
+            arena[2].append((content, offset, data))
+            arena[1] = offset + data.nbytes
+
+        buffers = np.atleast_1d(GL.glGenBuffers(len(arenas))).tolist() if arenas else []
+        self.buffers += buffers
+        for ((target, size, arena_chunks), buffer) in zip(arenas, buffers):
+            GL.glBindBuffer(target, buffer)
+            GL.glBufferData(target, size, None, GL.GL_STATIC_DRAW)
+            for (content, offset, data) in arena_chunks:
+                if data.nbytes:
+                    GL.glBufferSubData(target, offset, data.nbytes, data)
+                self.chunks[content] = (buffer, offset)
+                self.unique_bytes += data.nbytes
+                for key in new_chunks[content]:
+                    placements[key] = (buffer, offset)
+            GL.glBindBuffer(target, 0)
+        return placements
+
+    def vao(self, layout: tuple, create=create_vao) -> int:
+        # Instanced VAOs enable more attributes, so they are pooled apart from plain ones over the same buffers
+        key = (create, layout)
+        if key not in self.vaos:
+            self.vaos[key] = create(*layout)
+        return self.vaos[key]
+
+    def texture(self, key: tuple, create, nbytes: int):
+        self.texture_requests += 1
+        self.requested_texture_bytes += nbytes
+        if key not in self.textures:
+            self.textures[key] = create()
+            self.unique_texture_bytes += nbytes
+        return self.textures[key]
+
+    def share(self, geometry_bytes: int, textures: list):
+        # Spawned copies reference everything their source uploaded
+        self.requested_bytes += geometry_bytes
+        for texture in textures:
+            self.texture_requests += 1
+            self.requested_texture_bytes += texture.level_bytes(0)
+
+    def report(self) -> str:
+        return 'GPU resources: geometry %.1fMB requested, %.1fMB unique; %i textures requested, %i unique (%.1fMB, %.1fMB unique at full resolution)' % (
+            self.requested_bytes / (1 << 20), self.unique_bytes / (1 << 20), self.texture_requests, len(self.textures),
+            self.requested_texture_bytes / (1 << 20), self.unique_texture_bytes / (1 << 20))
@@ -1,29 +1,90 @@
 from OpenGL import GL
 
 from objects import GltfObject, Camera, Skybox
-from lights import Light
+from lights import Light, CUBE_FACES
 from shaders import ShaderCache
+from glstate import GLState
+from culling import frustum_planes
+from lighting import LightGrid, ShadowAtlas, LIGHTS_BINDING
+from uniforms import UniformRing, FRAME_BINDING, FRAME_BLOCK_SIZE, MATERIALS_BINDING, frame_block
+from loader import AssetLoader
+from assetcache import AssetCache
+from profiler import Profiler
+from overlay import ProfilerOverlay
+from occlusion import HiZBuffer
+from textures import TextureStreamer
+from resources import ResourcePool
+from resolution import ResolutionController
+from capture import FrameCapture
 
 import glm
 import math
+import numpy as np
+
+# Compiled together at startup, the main variants cover models with and without textures
+STARTUP_PROGRAMS = [
+    ('main', ()),
+    ('main', ('COLOR_TEXTURE',)),
+    ('shadow', ()),
+    ('skybox', ()),
+    ('postproc', ()),
+    ('overlay', ()),
+    ('hiz', ())
+]
 
 class Scene:
-    def __init__(self, objects: list[GltfObject], camera: Camera, light: Light, skybox: Skybox):
+    def __init__(self, objects: list[GltfObject], camera: Camera, lights: list[Light], skybox: Skybox, shadow_budget: int = 4, cache_directory: str = '.glview_cache', occlusion_culling: bool = False, hot_reload_shaders: bool = False, texture_budget: int = 256 << 20, render_scale: float = 1.0, target_frame_time: float = 0):
         self.objects = objects
         self.camera = camera
-        self.light = light
+        self.lights = lights
         self.skybox = skybox
-        self.shader_cache = ShaderCache()
+        self.shadow_atlas = ShadowAtlas(shadow_budget)
+        self.light_grid = LightGrid()
+        self.gl_state = GLState()
+        self.asset_cache = AssetCache(cache_directory) if cache_directory else None
+        self.shader_cache = ShaderCache(self.asset_cache, ('SHADOWS',) if shadow_budget > 0 else (), {'Lights': LIGHTS_BINDING, 'Frame': FRAME_BINDING, 'Materials': MATERIALS_BINDING})
+        # One block for the camera and one per shadow face rendered in a frame
+        self.frame_uniforms = UniformRing(FRAME_BLOCK_SIZE, 1 + shadow_budget * len(CUBE_FACES))
+        self.hot_reload_shaders = hot_reload_shaders
+        self.loader = AssetLoader(self.asset_cache)
+        self.texture_streamer = TextureStreamer(self.loader.executor, texture_budget)
+        self.resources = ResourcePool()
+        # Offscreen rendering happens at the window size times this, the postprocess pass scales it back
+        self.render_scale = render_scale
+        self.render_size = None
+        self.resolution = ResolutionController(target_frame_time, render_scale) if target_frame_time > 0 else None
+        self.capture = None
+        # Seconds of simulated time, animations are sampled at it
+        self.time = 0
+        self.updated_nodes = 0
+        self.profiler = Profiler()
+        self.overlay = ProfilerOverlay()
+        self.show_overlay = False
+        self.occlusion_culling = occlusion_culling
+        self.hiz = HiZBuffer()
+        self.visible_count = 0
+        self.culled_count = 0
+        self.occluded_count = 0
 
     def init_gl(self, width: int, height: int):
         GL.glEnable(GL.GL_DEPTH_TEST)
         GL.glEnable(GL.GL_CULL_FACE)
         GL.glClearColor(.1, .1, .1, 1)
 
+        layered = [('shadow_layered', ())] if any(light.layered for light in self.lights) else []
+        self.shader_cache.build(STARTUP_PROGRAMS + layered)
+
         for obj in self.objects:
-            obj.init_gl(self.shader_cache)
-        self.light.init_gl(self.shader_cache)
-        self.skybox.init_gl(self.shader_cache)
+            self.loader.load(obj, obj.filename)
+        self.loader.load(self.skybox, self.skybox.filename)
+        for light in self.lights:
+            light.init_gl(self.shader_cache)
+        self.shadow_atlas.init_gl()
+        self.frame_uniforms.init_gl()
+        self.light_grid.init_gl()
+        self.profiler.init_gl()
+        self.overlay.init_gl(self.shader_cache)
+        self.hiz.init_gl(self.shader_cache)
 
         self.render_color_texture = GL.glGenTextures(1)
         GL.glBindTexture(GL.GL_TEXTURE_2D, self.render_color_texture)
@@ -31,7 +92,6 @@ class Scene:
         GL.glTexParameteri(GL.GL_TEXTURE_2D, GL.GL_TEXTURE_MAG_FILTER, GL.GL_LINEAR)
         GL.glTexParameteri(GL.GL_TEXTURE_2D, GL.GL_TEXTURE_WRAP_S, GL.GL_CLAMP_TO_EDGE)
         GL.glTexParameteri(GL.GL_TEXTURE_2D, GL.GL_TEXTURE_WRAP_T, GL.GL_CLAMP_TO_EDGE)
-        GL.glTexImage2D(GL.GL_TEXTURE_2D, 0, GL.GL_RGB, width, height, 0, GL.GL_RGB, GL.GL_UNSIGNED_BYTE, None)
 
         self.render_depth_texture = GL.glGenTextures(1)
         GL.glBindTexture(GL.GL_TEXTURE_2D, self.render_depth_texture)
@@ -39,7 +99,8 @@ class Scene:
         GL.glTexParameteri(GL.GL_TEXTURE_2D, GL.GL_TEXTURE_MAG_FILTER, GL.GL_LINEAR)
         GL.glTexParameteri(GL.GL_TEXTURE_2D, GL.GL_TEXTURE_WRAP_S, GL.GL_CLAMP_TO_EDGE)
         GL.glTexParameteri(GL.GL_TEXTURE_2D, GL.GL_TEXTURE_WRAP_T, GL.GL_CLAMP_TO_EDGE)
-        GL.glTexImage2D(GL.GL_TEXTURE_2D, 0, GL.GL_DEPTH_COMPONENT, width, height, 0, GL.GL_DEPTH_COMPONENT, GL.GL_FLOAT, None)
+        GL.glBindTexture(GL.GL_TEXTURE_2D, 0)
+        self.resize_render_target(*self.scaled_size(width, height))
 
         default_fbo = GL.glGetIntegerv(GL.GL_DRAW_FRAMEBUFFER_BINDING)
 
@@ -51,54 +112,202 @@ class Scene:
 
         self.postproc_program = self.shader_cache.get_shader('postproc')
 
+    def scaled_size(self, width: int, height: int) -> tuple[int, int]:
+        return (max(round(width * self.render_scale), 1), max(round(height * self.render_scale), 1))
+
+    def resize_render_target(self, width: int, height: int):
+        # Storage is respecified on the same texture names, so the framebuffer attachments stay valid
+        GL.glBindTexture(GL.GL_TEXTURE_2D, self.render_color_texture)
+        GL.glTexImage2D(GL.GL_TEXTURE_2D, 0, GL.GL_RGB, width, height, 0, GL.GL_RGB, GL.GL_UNSIGNED_BYTE, None)
+        GL.glBindTexture(GL.GL_TEXTURE_2D, self.render_depth_texture)
+        GL.glTexImage2D(GL.GL_TEXTURE_2D, 0, GL.GL_DEPTH_COMPONENT, width, height, 0, GL.GL_DEPTH_COMPONENT, GL.GL_FLOAT, None)
+        GL.glBindTexture(GL.GL_TEXTURE_2D, 0)
+        self.gl_state.invalidate()
+        self.render_size = (width, height)
+
+    def start_capture(self, capture: FrameCapture):
+        capture.init_gl()
+        self.capture = capture
+
+    def stop_capture(self) -> FrameCapture:
+        capture = self.capture
+        capture.finish()
+        self.capture = None
+        return capture
+
+    def ready_objects(self) -> list[GltfObject]:
+        return [obj for obj in self.objects if obj.ready]
+
+    def asset_ready(self, asset):
+        if asset is self.skybox:
+            return
+        self.texture_streamer.register(asset.textures)
+        for light in self.lights:
+            light.need_shadow_render = True
+
+    def poll_assets(self):
+        for asset in self.loader.poll(self.shader_cache, self.resources):
+            self.asset_ready(asset)
+
+    def wait_for_assets(self):
+        for asset in self.loader.wait(self.shader_cache, self.resources):
+            self.asset_ready(asset)
+
+    def spawn(self, obj: GltfObject, transform: glm.mat4, dynamic: bool = None) -> GltfObject:
+        # Another placement of a loaded model, drawn from the same buffers and textures
+        copy = obj.spawn(transform, dynamic)
+        self.resources.share(copy.geometry_bytes, copy.textures)
+        self.objects.append(copy)
+        self.asset_ready(copy)
+        return copy
+
     def render(self, width: int, height: int):
         default_fbo = GL.glGetIntegerv(GL.GL_DRAW_FRAMEBUFFER_BINDING)
+        self.gl_state.begin_frame()
+        self.profiler.begin_frame()
+        self.frame_uniforms.begin_frame()
+
+        with self.profiler.section('assets'):
+            # Index buffer uploads would land in whichever VAO the last frame left bound
+            self.gl_state.bind_vertex_array(0)
+            self.poll_assets()
+            self.texture_streamer.update()
+        # New assets and streamed mips bind their VAOs and textures directly, everything after goes through gl_state
+        self.gl_state.invalidate()
 
-        self.light.render_shadow_map(self)
+        if self.capture:
+            with self.profiler.section('capture'):
+                self.capture.poll()
+
+        with self.profiler.section('animation'):
+            self.update_animations()
+
+        if self.hot_reload_shaders and self.shader_cache.reload_changed():
+            self.gl_state.forget_programs()
+
+        with self.profiler.section('shadows'):
+            self.render_shadows()
+
+        if self.resolution:
+            self.render_scale = self.resolution.update(self.profiler.gpu_times.get('frame'))
+        (render_width, render_height) = self.scaled_size(width, height)
+        if self.render_size != (render_width, render_height):
+            self.resize_render_target(render_width, render_height)
 
         GL.glBindFramebuffer(GL.GL_FRAMEBUFFER, self.render_fbo)
         
         GL.glClear(GL.GL_COLOR_BUFFER_BIT)
         GL.glClear(GL.GL_DEPTH_BUFFER_BIT)
-        GL.glViewport(0, 0, width, height)
+        GL.glViewport(0, 0, render_width, render_height)
 
         projection_transform = self.camera.projection_transform(float(width) / float(height))
         view_transform = self.camera.view_transform()
 
-        for obj in self.objects:
+        with self.profiler.section('light_grid'):
+            self.light_grid.update(self.gl_state, self.lights, view_transform, projection_transform, render_width, render_height)
+
+        self.frame_uniforms.push(FRAME_BINDING, frame_block(projection_transform, view_transform, self.camera.position))
+
+        with self.profiler.section('opaque', gpu=True):
+            self.render_objects(projection_transform, view_transform, render_height)
+
+        with self.profiler.section('skybox', gpu=True):
+            self.render_skybox(projection_transform, view_transform)
+
+        # Culls the next frame, so a few objects can pop in for a frame when the camera turns quickly
+        if self.occlusion_culling:
+            with self.profiler.section('hiz', gpu=True):
+                self.hiz.build(self.render_depth_texture, render_width, render_height, projection_transform * view_transform, self.gl_state)
+
+        # Read back at the render resolution, before the overlay is drawn
+        if self.capture:
+            with self.profiler.section('capture'):
+                self.capture.read(self.render_fbo, render_width, render_height)
+
+        GL.glBindFramebuffer(GL.GL_FRAMEBUFFER, default_fbo)
+        GL.glViewport(0, 0, width, height)
+
+        with self.profiler.section('postprocess', gpu=True):
+            self.render_postprocess(width, height)
+
+        if self.show_overlay:
+            with self.profiler.section('overlay'):
+                self.overlay.update(self.gl_state, self.profiler)
+                self.overlay.render(self.gl_state, width, height)
+
+        self.frame_uniforms.end_frame()
+        self.profiler.end_frame(self.gl_state, {
+            'visible': self.visible_count,
+            'culled': self.culled_count,
+            'occluded': self.occluded_count,
+            'uniform_blocks': self.frame_uniforms.writes,
+            'texture_bytes': self.texture_streamer.resident_bytes,
+            'texture_latency': self.texture_streamer.latency,
+            'render_scale': self.render_scale,
+            'updated_nodes': self.updated_nodes,
+            'shadow_occluded': sum(light.shadow_occluded_count for light in self.lights)
+        })
+
+    def update_animations(self):
+        self.updated_nodes = 0
+        for obj in self.ready_objects():
+            updated = obj.animate(self.time)
+            if updated == 0:
+                continue
+            self.updated_nodes += updated
+            if obj.changed_bounds is not None:
+                for light in self.lights:
+                    light.invalidate_bounds(*obj.changed_bounds)
+                obj.changed_bounds = None
+
+    def render_shadows(self):
+        self.shadow_atlas.assign(self.lights, self.camera.position)
+        for light in self.lights:
+            light.render_shadow_map(self)
+
+    def render_objects(self, projection_transform: glm.mat4, view_transform: glm.mat4, height: int):
+        planes = frustum_planes(projection_transform * view_transform)
+        occlusion = self.hiz.update() if self.occlusion_culling else None
+        self.visible_count = 0
+        self.culled_count = 0
+        self.occluded_count = 0
+
+        for (i, obj) in enumerate(self.ready_objects()):
+            visible = obj.cull(planes, occlusion)
+            visible_count = int(np.count_nonzero(visible))
+            self.visible_count += visible_count
+            self.culled_count += len(visible) - visible_count - obj.bvh.occluded_count
+            self.occluded_count += obj.bvh.occluded_count
+            if visible_count == 0:
+                continue
+            obj.request_textures(self.texture_streamer, visible, self.camera, height)
+
             program = obj.program
-            GL.glUseProgram(program.program)
+            self.gl_state.use_program(program.program)
             
-            GL.glUniformMatrix4fv(program.uniform_location('projection_transform'), 1, GL.GL_FALSE, glm.value_ptr(projection_transform))
-            GL.glUniformMatrix4fv(program.uniform_location('view_transform'), 1, GL.GL_FALSE, glm.value_ptr(view_transform))
-            GL.glUniform3fv(program.uniform_location('light_position'), 1, glm.value_ptr(self.light.position))
-            GL.glUniform1f(program.uniform_location('light_intensity'), self.light.intensity)
-            GL.glUniform1i(program.uniform_location('shadow_texture'), 0)
+            self.gl_state.uniform_1i(program.uniform_location('shadow_texture'), 0)
+            self.gl_state.bind_texture(0, GL.GL_TEXTURE_CUBE_MAP_ARRAY, self.shadow_atlas.texture)
+            self.light_grid.bind(program, self.gl_state)
 
-            GL.glActiveTexture(GL.GL_TEXTURE0)
-            GL.glBindTexture(GL.GL_TEXTURE_CUBE_MAP, self.light.shadow_texture)
+            with self.profiler.section('object %i' % i, gpu=True):
+                obj.render(program, self.gl_state, visible, obj.select_lods(self.camera))
 
-            obj.render(program)
-            
-            GL.glUseProgram(0)
+    def render_skybox(self, projection_transform: glm.mat4, view_transform: glm.mat4):
+        if not self.skybox.ready:
+            return
 
         program = self.skybox.program
-        GL.glUseProgram(program.program)
-        
-        GL.glUniformMatrix4fv(program.uniform_location('projection_transform'), 1, GL.GL_FALSE, glm.value_ptr(projection_transform))
-        GL.glUniformMatrix4fv(program.uniform_location('view_transform'), 1, GL.GL_FALSE, glm.value_ptr(view_transform))
-        self.skybox.render()        
-        GL.glUseProgram(0)
+        self.gl_state.use_program(program.program)
+        self.skybox.render(self.gl_state)
 
-        GL.glBindFramebuffer(GL.GL_FRAMEBUFFER, default_fbo)
-        GL.glViewport(0, 0, width, height)
-        
+    def render_postprocess(self, width: int, height: int):
         GL.glDisable(GL.GL_DEPTH_TEST)
-        GL.glUseProgram(self.postproc_program.program)
-        GL.glActiveTexture(GL.GL_TEXTURE0)
-        GL.glBindTexture(GL.GL_TEXTURE_2D, self.render_color_texture)
-        GL.glUniform1i(self.postproc_program.uniform_location('frame'), 0)
+        self.gl_state.use_program(self.postproc_program.program)
+        self.gl_state.bind_texture(0, GL.GL_TEXTURE_2D, self.render_color_texture)
+        self.gl_state.uniform_1i(self.postproc_program.uniform_location('frame'), 0)
+        self.gl_state.uniform_2f(self.postproc_program.uniform_location('output_size'), (width, height))
 
         GL.glDrawArrays(GL.GL_TRIANGLE_FAN, 0, 4)
-        GL.glUseProgram(0)
+        self.gl_state.count_draw(2)
+        self.gl_state.use_program(0)
         GL.glEnable(GL.GL_DEPTH_TEST)
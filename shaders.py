@@ -1,53 +1,269 @@
+from assetcache import AssetCache, CACHE_VERSION
+
 from OpenGL import GL
-import sys
+
+import ctypes
+import hashlib
+import os
+import time
+import numpy as np
+
+SHADER_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'shaders')
+
+SHADER_STAGES = (
+    ('vert', GL.GL_VERTEX_SHADER),
+    ('frag', GL.GL_FRAGMENT_SHADER),
+    ('geom', GL.GL_GEOMETRY_SHADER)
+)
+
+# Seconds between checks of the shader sources for changes
+RELOAD_INTERVAL = .5
+
+class ShaderError(Exception):
+    pass
 
 class Shader:
-    def __init__(self, program):
+    def __init__(self, name: str, defines: tuple, block_bindings: dict = None):
+        self.name = name
+        self.defines = defines
+        self.program = 0
+        self.uniforms = {}
+        self.blocks = {}
+        self.block_bindings = dict(block_bindings or {})
+
+    def uniform_location(self, name: str) -> int:
+        return self.uniforms.get(name, -1)
+
+    def bind_block(self, name: str, binding: int):
+        # Remembered so the binding survives a reload
+        self.block_bindings[name] = binding
+        if name in self.blocks:
+            GL.glUniformBlockBinding(self.program, self.blocks[name], binding)
+
+    def attach(self, program: int):
+        if self.program:
+            GL.glDeleteProgram(self.program)
         self.program = program
+
+        # Every location is resolved once here, the render loop never queries the driver
         self.uniforms = {}
-        self.attributes = {}
+        for index in range(GL.glGetProgramiv(program, GL.GL_ACTIVE_UNIFORMS)):
+            (name, size, uniform_type) = GL.glGetActiveUniform(program, index)
+            name = name.decode() if isinstance(name, bytes) else name
+            location = GL.glGetUniformLocation(program, name)
+            if location == -1:
+                continue
+            self.uniforms[name] = location
+            if name.endswith('[0]'):
+                self.uniforms[name[:-3]] = location
+
+        self.blocks = {}
+        for index in range(GL.glGetProgramiv(program, GL.GL_ACTIVE_UNIFORM_BLOCKS)):
+            name = ctypes.create_string_buffer(256)
+            GL.glGetActiveUniformBlockName(program, index, len(name), None, name)
+            self.blocks[name.value.decode()] = index
+        for (name, binding) in self.block_bindings.items():
+            self.bind_block(name, binding)
+
+class ShaderBuild:
+    def __init__(self, shader: Shader, sources: dict, key: str):
+        self.shader = shader
+        self.sources = sources
+        self.key = key
+        self.program = GL.glCreateProgram()
+        self.stages = []
+
+    def compile(self):
+        for (extension, stage) in SHADER_STAGES:
+            if extension not in self.sources:
+                continue
+            shader = GL.glCreateShader(stage)
+            GL.glShaderSource(shader, [self.sources[extension]])
+            GL.glCompileShader(shader)
+            GL.glAttachShader(self.program, shader)
+            self.stages.append((extension, shader))
+
+    def link(self, retrievable: bool):
+        if retrievable:
+            GL.glProgramParameteri(self.program, GL.GL_PROGRAM_BINARY_RETRIEVABLE_HINT, GL.GL_TRUE)
+        GL.glLinkProgram(self.program)
+
+    def finish(self):
+        try:
+            for (extension, shader) in self.stages:
+                if GL.glGetShaderiv(shader, GL.GL_COMPILE_STATUS) == GL.GL_FALSE:
+                    raise ShaderError('%s.%s%s: %s' % (self.shader.name, extension, define_suffix(self.shader.defines), decode_log(GL.glGetShaderInfoLog(shader))))
+            if GL.glGetProgramiv(self.program, GL.GL_LINK_STATUS) == GL.GL_FALSE:
+                raise ShaderError('%s%s: %s' % (self.shader.name, define_suffix(self.shader.defines), decode_log(GL.glGetProgramInfoLog(self.program))))
+        except ShaderError:
+            GL.glDeleteProgram(self.program)
+            raise
+        finally:
+            for (_, shader) in self.stages:
+                GL.glDeleteShader(shader)
+
+def decode_log(log) -> str:
+    return (log.decode() if isinstance(log, bytes) else log).strip()
 
-    def uniform_location(self, name):
-        if name not in self.uniforms:
-            self.uniforms[name] = GL.glGetUniformLocation(self.program, name)
-        return self.uniforms[name]
+def define_suffix(defines: tuple) -> str:
+    return ' [%s]' % ', '.join(defines) if defines else ''
+
+def inject_defines(source: str, defines: tuple) -> str:
+    if not defines:
+        return source
+    (version, rest) = source.split('\n', 1)
+    lines = ['#define %s' % define for define in defines]
+    # Keeps compiler messages pointing at the line in the file
+    return '\n'.join([version, *lines, '#line 2', rest])
 
 class ShaderCache:
-    def __init__(self):
+    def __init__(self, asset_cache: AssetCache = None, defines: tuple = (), block_bindings: dict = None, directory: str = SHADER_DIRECTORY):
+        self.asset_cache = asset_cache
+        self.defines = tuple(defines)
+        self.block_bindings = block_bindings or {}
+        self.directory = directory
         self.cache = {}
+        self.timestamps = {}
+        self.next_reload_check = 0
+        self.binary_hits = 0
+        self.binary_misses = 0
+        self.compile_time = 0
+        self.driver = None
 
-    def get_shader(self, name: str) -> Shader:
-        if name not in self.cache:
-            program = GL.glCreateProgram()
-            with open('shaders/%s.vert' % name) as file:
-                shader = GL.glCreateShader(GL.GL_VERTEX_SHADER)
-                source = file.read()
-                GL.glShaderSource(shader, [source])
-                GL.glCompileShader(shader)
-                if GL.glGetShaderiv(shader, GL.GL_COMPILE_STATUS) == GL.GL_FALSE:
-                    log = GL.glGetShaderInfoLog(shader)
-                    print(log)
-                    sys.exit(1)
-                GL.glAttachShader(program, shader)
-
-            with open('shaders/%s.frag' % name) as file:
-                shader = GL.glCreateShader(GL.GL_FRAGMENT_SHADER)
-                source = file.read()
-                GL.glShaderSource(shader, [source])
-                GL.glCompileShader(shader)
-                if GL.glGetShaderiv(shader, GL.GL_COMPILE_STATUS) == GL.GL_FALSE:
-                    log = GL.glGetShaderInfoLog(shader)
-                    print(log)
-                    sys.exit(1)
-                GL.glAttachShader(program, shader)
+    def init_gl(self):
+        self.driver = '|'.join(GL.glGetString(name).decode() for name in (GL.GL_VENDOR, GL.GL_RENDERER, GL.GL_VERSION))
+        self.binary_formats = GL.glGetIntegerv(GL.GL_NUM_PROGRAM_BINARY_FORMATS) > 0
+        extensions = {GL.glGetStringi(GL.GL_EXTENSIONS, i).decode() for i in range(GL.glGetIntegerv(GL.GL_NUM_EXTENSIONS))}
+        if 'GL_KHR_parallel_shader_compile' in extensions:
+            from OpenGL.GL.KHR.parallel_shader_compile import glMaxShaderCompilerThreadsKHR
+            glMaxShaderCompilerThreadsKHR(0xffffffff)
+
+    def variant_defines(self, defines: tuple) -> tuple:
+        return tuple(sorted(set(self.defines) | set(defines)))
+
+    def get_shader(self, name: str, defines: tuple = ()) -> Shader:
+        defines = self.variant_defines(defines)
+        if (name, defines) not in self.cache:
+            self.build([(name, defines)])
+        return self.cache[(name, defines)]
+
+    def build(self, variants: list[tuple[str, tuple]]):
+        if self.driver is None:
+            self.init_gl()
+        start_time = time.perf_counter()
+
+        builds = []
+        for (name, defines) in variants:
+            defines = self.variant_defines(defines)
+            shader = self.cache.get((name, defines)) or Shader(name, defines, self.block_bindings)
+            build = self.prepare(shader)
+            if build is not None:
+                builds.append(build)
+            self.cache[(name, defines)] = shader
+
+        # Every stage is submitted before any status is queried, so drivers with compiler threads work on them together
+        for build in builds:
+            build.compile()
+        for build in builds:
+            build.link(self.asset_cache is not None and self.binary_formats)
+
+        errors = []
+        for build in builds:
+            try:
+                build.finish()
+            except ShaderError as error:
+                errors.append(str(error))
+                continue
+            build.shader.attach(build.program)
+            self.store_binary(build)
+        self.compile_time += time.perf_counter() - start_time
+        if errors:
+            raise ShaderError('\n'.join(errors))
+
+    def prepare(self, shader: Shader) -> ShaderBuild:
+        sources = {}
+        paths = []
+        for (extension, _) in SHADER_STAGES:
+            path = os.path.join(self.directory, '%s.%s' % (shader.name, extension))
+            if not os.path.exists(path):
+                continue
+            with open(path) as file:
+                sources[extension] = inject_defines(file.read(), shader.defines)
+            paths.append(path)
+        if not sources:
+            raise ShaderError('%s: no sources in %s' % (shader.name, self.directory))
+        self.timestamps[(shader.name, shader.defines)] = self.source_timestamps(paths)
+
+        digest = hashlib.sha256(b'glview-shader-%i-%s' % (CACHE_VERSION, self.driver.encode()))
+        for (extension, source) in sorted(sources.items()):
+            digest.update(b'\0%s\0%s' % (extension.encode(), source.encode()))
+        key = digest.hexdigest()
+
+        program = self.load_binary(shader, key)
+        if program:
+            shader.attach(program)
+            return None
+        return ShaderBuild(shader, sources, key)
+
+    def load_binary(self, shader: Shader, key: str) -> int:
+        if self.asset_cache is None or not self.binary_formats:
+            return 0
+        entry = self.asset_cache.lookup('shaders/%s%s' % (shader.name, define_suffix(shader.defines)), key)
+        if entry is None:
+            self.binary_misses += 1
+            return 0
+
+        binary = np.ascontiguousarray(entry.array('binary'))
+        program = GL.glCreateProgram()
+        GL.glProgramBinary(program, entry.manifest['format'], binary.ctypes.data_as(ctypes.c_void_p), len(binary))
+        # A driver update can reject an older binary, then the program is compiled from source again
+        if GL.glGetProgramiv(program, GL.GL_LINK_STATUS) == GL.GL_FALSE:
+            GL.glDeleteProgram(program)
+            self.binary_misses += 1
+            return 0
+        self.binary_hits += 1
+        return program
+
+    def store_binary(self, build: ShaderBuild):
+        if self.asset_cache is None or not self.binary_formats:
+            return
+        length = GL.glGetProgramiv(build.program, GL.GL_PROGRAM_BINARY_LENGTH)
+        if length <= 0:
+            return
+        binary = np.empty(length, np.uint8)
+        written = GL.GLsizei(0)
+        binary_format = GL.GLenum(0)
+        GL.glGetProgramBinary(build.program, length, ctypes.byref(written), ctypes.byref(binary_format), binary.ctypes.data_as(ctypes.c_void_p))
+        manifest = {'source': build.shader.name, 'defines': list(build.shader.defines), 'format': binary_format.value}
+        self.asset_cache.store(build.key, manifest, {'binary': binary[:written.value]})
+
+    def source_timestamps(self, paths: list[str]) -> tuple:
+        return tuple(os.stat(path).st_mtime_ns if os.path.exists(path) else None for path in paths)
+
+    def reload_changed(self) -> list[Shader]:
+        now = time.perf_counter()
+        if now < self.next_reload_check:
+            return []
+        self.next_reload_check = now + RELOAD_INTERVAL
 
-            GL.glLinkProgram(program)
-            if GL.glGetProgramiv(program, GL.GL_LINK_STATUS) == GL.GL_FALSE:
-                log = GL.glGetProgramInfoLog(program)
-                print(log)
-                sys.exit(1)
-            
-            self.cache[name] = Shader(program)
+        changed = []
+        for (variant, shader) in self.cache.items():
+            (name, _) = variant
+            paths = [os.path.join(self.directory, '%s.%s' % (name, extension)) for (extension, _) in SHADER_STAGES]
+            paths = [path for path in paths if os.path.exists(path)]
+            if self.source_timestamps(paths) != self.timestamps.get(variant):
+                changed.append(variant)
+        if not changed:
+            return []
 
-        return self.cache[name]
+        # A broken edit keeps the previous program running until the source is fixed
+        try:
+            self.build(changed)
+        except ShaderError as error:
+            print('Shader reload failed:\n%s' % error)
+        else:
+            print('Reloaded %s' % ', '.join('%s%s' % (name, define_suffix(defines)) for (name, defines) in changed))
+        return [self.cache[variant] for variant in changed]
 
+    def report(self) -> str:
+        return 'Shaders: %i programs in %ims, %i binary cache hits, %i misses' % (len(self.cache), self.compile_time * 1000, self.binary_hits, self.binary_misses)
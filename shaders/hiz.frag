@@ -0,0 +1,15 @@
+#version 130
+
+uniform sampler2D source;
+uniform ivec2 source_size;
+
+void main()
+{
+    // Each texel keeps the farthest depth of the 2x2 block below it
+    ivec2 texel = ivec2(gl_FragCoord.xy) * 2;
+    ivec2 last = source_size - 1;
+    float depth = max(
+        max(texelFetch(source, min(texel, last), 0).r, texelFetch(source, min(texel + ivec2(1, 0), last), 0).r),
+        max(texelFetch(source, min(texel + ivec2(0, 1), last), 0).r, texelFetch(source, min(texel + ivec2(1, 1), last), 0).r));
+    gl_FragColor = vec4(depth);
+}
\ No newline at end of file
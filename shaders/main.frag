@@ -1,28 +1,45 @@
-#version 130
+#version 410
 
-uniform vec3 base_color;
+const int MAX_LIGHTS = 256;
+const int MAX_MATERIALS = 512;
+
+struct Material {
+    vec4 base_color;
+    vec4 params;
+};
+
+layout(std140) uniform Materials {
+    Material materials[MAX_MATERIALS];
+};
+
+uniform int material_index;
+#ifdef COLOR_TEXTURE
 uniform sampler2D color_texture;
-uniform bool has_color_texture;
-uniform vec3 light_position;
-uniform samplerCubeShadow shadow_texture;
-uniform float light_intensity;
-
-varying vec3 frag_pos;
-varying vec3 frag_normal;
-varying vec2 frag_texcoord;
-void main()
+#endif
+#ifdef SHADOWS
+uniform samplerCubeArrayShadow shadow_texture;
+#endif
+uniform usampler2D light_tiles;
+uniform usamplerBuffer light_indices;
+uniform int tile_size;
+
+layout(std140) uniform Lights {
+    vec4 light_positions[MAX_LIGHTS];
+    vec4 light_params[MAX_LIGHTS];
+};
+
+in vec3 frag_pos;
+in vec3 frag_normal;
+in vec2 frag_texcoord;
+out vec4 frag_color;
+
+float light_visibility(vec3 light_vec, float light_cos, float shadow_slot)
 {
-    vec3 color;
-    if(has_color_texture) {
-        color = texture(color_texture, frag_texcoord).xyz;
-    } else {
-        color = base_color;
+#ifdef SHADOWS
+    if(shadow_slot < 0) {
+        return 1.0;
     }
 
-    vec3 light_vec = frag_pos - light_position;
-    float light_dist = length(light_vec);
-    float light_cos = max(-dot(light_vec / light_dist, frag_normal), 0);
-
     float light_depth = max(max(abs(light_vec.x), abs(light_vec.y)), abs(light_vec.z));
     float far = 30;
     float near = .1;
@@ -30,15 +47,45 @@ void main()
     float depth_ref = (far + near) / (far - near) - (2 * far * near) / ((far - near) * light_depth);
     depth_ref = (depth_ref + 1) / 2;
 
-    float light_visibility = texture(shadow_texture, vec4(light_vec, depth_ref));
+    return texture(shadow_texture, vec4(light_vec, shadow_slot), depth_ref);
+#else
+    return 1.0;
+#endif
+}
+
+void main()
+{
+    vec3 color = materials[material_index].base_color.rgb;
+#ifdef COLOR_TEXTURE
+    if(materials[material_index].params.x > 0) {
+        color = texture(color_texture, frag_texcoord).xyz;
+    }
+#endif
+
+    uvec2 tile = texelFetch(light_tiles, ivec2(gl_FragCoord.xy) / tile_size, 0).xy;
+    vec3 light_irradiance = vec3(0, 0, 0);
+    for(uint i = 0u; i < tile.y; i++) {
+        int light = int(texelFetch(light_indices, int(tile.x + i)).x);
+        vec3 light_vec = frag_pos - light_positions[light].xyz;
+        float light_dist = length(light_vec);
+        float light_range = light_params[light].y;
+        if(light_dist >= light_range) {
+            continue;
+        }
+
+        float light_cos = max(-dot(light_vec / light_dist, frag_normal), 0);
+        float light_window = pow(clamp(1 - pow(light_dist / light_range, 4), 0, 1), 2);
+        float visibility = light_visibility(light_vec, light_cos, light_params[light].x);
+
+        vec3 light_color = vec3(1, 1, 1);
+        vec3 light_radiance = light_color * light_positions[light].w;
+        light_irradiance += light_radiance * visibility * light_window * light_cos / (light_dist * light_dist);
+    }
 
-    vec3 light_color = vec3(1, 1, 1);
-    vec3 light_radiance = light_color * light_intensity;
-    vec3 light_irradiance = light_radiance * light_visibility * light_cos / (light_dist * light_dist);
     vec3 ambient_irradiance = vec3(1, 1, 1);
     vec3 irradiance = light_irradiance + ambient_irradiance;
     vec3 radiance = irradiance * color / 3.14;
 
     vec3 fragColor = radiance / (radiance + vec3(1, 1, 1));
-    gl_FragColor = vec4(fragColor, 1.0);
+    frag_color = vec4(fragColor, 1.0);
 }
\ No newline at end of file
@@ -2,18 +2,28 @@
 layout(location = 0) in highp vec3 position;
 layout(location = 1) in highp vec3 normal;
 layout(location = 2) in highp vec2 texcoord;
+layout(location = 3) in highp mat4 instance_transform;
 
-uniform mat4 projection_transform;
-uniform mat4 view_transform;
+layout(std140) uniform Frame {
+    mat4 projection_transform;
+    mat4 view_transform;
+    vec4 camera_position;
+};
 uniform mat4 model_transform;
-varying vec3 frag_pos;
-varying vec3 frag_normal;
-varying vec2 frag_texcoord;
+uniform bool instanced;
+out vec3 frag_pos;
+out vec3 frag_normal;
+out vec2 frag_texcoord;
 
 void main()
 {
-    gl_Position = projection_transform * view_transform * model_transform * vec4(position, 1);
-    frag_pos = (model_transform * vec4(position, 1)).xyz;
-    frag_normal = (model_transform * vec4(normal, 0)).xyz;
+    mat4 transform = instanced ? instance_transform : model_transform;
+    gl_Position = projection_transform * view_transform * transform * vec4(position, 1);
+    frag_pos = (transform * vec4(position, 1)).xyz;
+    // Cofactors keep normals perpendicular under non-uniform scales, like the dequantization scales of quantized meshes.
+    // They equal det * inverse transpose, so mirrored transforms need the sign of the determinant to keep normals facing out
+    mat3 linear = mat3(transform);
+    mat3 cofactors = mat3(cross(linear[1], linear[2]), cross(linear[2], linear[0]), cross(linear[0], linear[1]));
+    frag_normal = normalize(cofactors * normal) * sign(determinant(linear));
     frag_texcoord = texcoord;
 }
\ No newline at end of file
@@ -0,0 +1,10 @@
+#version 130
+
+uniform sampler2D overlay;
+
+in vec2 tex_coord;
+
+void main()
+{
+    gl_FragColor = texture(overlay, tex_coord);
+}
\ No newline at end of file
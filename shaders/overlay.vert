@@ -0,0 +1,19 @@
+#version 130
+
+uniform vec4 rect;
+
+out vec2 tex_coord;
+
+vec2 corners[4] = vec2[](
+    vec2(0, 0),
+    vec2(1, 0),
+    vec2(1, 1),
+    vec2(0, 1)
+);
+
+void main()
+{
+    vec2 corner = corners[gl_VertexID];
+    tex_coord = vec2(corner.x, 1 - corner.y);
+    gl_Position = vec4(mix(rect.xy, rect.zw, corner), 0, 1);
+}
\ No newline at end of file
@@ -1,10 +1,47 @@
 #version 130
 
 uniform sampler2D frame;
+uniform vec2 output_size;
+
+// Catmull-Rom upscale in nine bilinear taps, sharper than plain bilinear at fractional scales
+vec4 catmull_rom(vec2 position, vec2 size)
+{
+    vec2 center = floor(position - 0.5) + 0.5;
+    vec2 f = position - center;
+    vec2 w0 = f * (-0.5 + f * (1.0 - 0.5 * f));
+    vec2 w1 = 1.0 + f * f * (-2.5 + 1.5 * f);
+    vec2 w2 = f * (0.5 + f * (2.0 - 1.5 * f));
+    vec2 w3 = f * f * (-0.5 + 0.5 * f);
+    vec2 w12 = w1 + w2;
+
+    vec2 p0 = (center - 1.0) / size;
+    vec2 p12 = (center + w2 / w12) / size;
+    vec2 p3 = (center + 2.0) / size;
+
+    vec4 color = vec4(0.0);
+    color += texture(frame, vec2(p0.x, p0.y)) * w0.x * w0.y;
+    color += texture(frame, vec2(p12.x, p0.y)) * w12.x * w0.y;
+    color += texture(frame, vec2(p3.x, p0.y)) * w3.x * w0.y;
+    color += texture(frame, vec2(p0.x, p12.y)) * w0.x * w12.y;
+    color += texture(frame, vec2(p12.x, p12.y)) * w12.x * w12.y;
+    color += texture(frame, vec2(p3.x, p12.y)) * w3.x * w12.y;
+    color += texture(frame, vec2(p0.x, p3.y)) * w0.x * w3.y;
+    color += texture(frame, vec2(p12.x, p3.y)) * w12.x * w3.y;
+    color += texture(frame, vec2(p3.x, p3.y)) * w3.x * w3.y;
+    return max(color, 0.0);
+}
 
 void main()
 {
-    vec4 color = texelFetch(frame, ivec2(gl_FragCoord.xy), 0);
+    vec2 frame_size = vec2(textureSize(frame, 0));
+    vec4 color;
+    if (frame_size == output_size)
+        color = texelFetch(frame, ivec2(gl_FragCoord.xy), 0);
+    else if (frame_size.x < output_size.x)
+        color = catmull_rom(gl_FragCoord.xy / output_size * frame_size, frame_size);
+    else
+        // Above 1.0 the bilinear tap averages the rendered pixels under each output pixel
+        color = texture(frame, gl_FragCoord.xy / output_size);
 
     gl_FragColor = color;
 }
\ No newline at end of file
@@ -1,11 +1,17 @@
 #version 410
 layout(location = 0) in highp vec3 position;
+layout(location = 3) in highp mat4 instance_transform;
 
-uniform mat4 projection_transform;
-uniform mat4 view_transform;
+layout(std140) uniform Frame {
+    mat4 projection_transform;
+    mat4 view_transform;
+    vec4 camera_position;
+};
 uniform mat4 model_transform;
+uniform bool instanced;
 
 void main()
 {
-    gl_Position = projection_transform * view_transform * model_transform * vec4(position, 1);
+    mat4 transform = instanced ? instance_transform : model_transform;
+    gl_Position = projection_transform * view_transform * transform * vec4(position, 1);
 }
\ No newline at end of file
@@ -0,0 +1,5 @@
+#version 130
+
+void main()
+{
+}
\ No newline at end of file
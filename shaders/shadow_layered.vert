@@ -0,0 +1,12 @@
+#version 410
+layout(location = 0) in highp vec3 position;
+layout(location = 3) in highp mat4 instance_transform;
+
+uniform mat4 model_transform;
+uniform bool instanced;
+
+void main()
+{
+    mat4 transform = instanced ? instance_transform : model_transform;
+    gl_Position = transform * vec4(position, 1);
+}
\ No newline at end of file
@@ -1,8 +1,11 @@
 #version 410
 layout(location = 0) in highp vec3 position;
 
-uniform mat4 projection_transform;
-uniform mat4 view_transform;
+layout(std140) uniform Frame {
+    mat4 projection_transform;
+    mat4 view_transform;
+    vec4 camera_position;
+};
 
 varying vec3 frag_pos;
 
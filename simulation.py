@@ -0,0 +1,143 @@
+from scene import Scene
+
+import glfw
+import glm
+import math
+import threading
+
+# The most steps run in one go after a stall, beyond that simulated time is dropped
+MAX_CATCH_UP_STEPS = 8
+
+LIGHT_KEYS = {
+    glfw.KEY_I: (0, 0, -1),
+    glfw.KEY_J: (-1, 0, 0),
+    glfw.KEY_K: (0, 0, 1),
+    glfw.KEY_L: (1, 0, 0),
+    glfw.KEY_U: (0, -1, 0),
+    glfw.KEY_O: (0, 1, 0),
+}
+
+LIGHT_INTENSITY_KEYS = {
+    glfw.KEY_M: -1,
+    glfw.KEY_N: 1
+}
+
+CAMERA_KEYS = {
+    glfw.KEY_W: (0, 0, -1),
+    glfw.KEY_A: (-1, 0, 0),
+    glfw.KEY_S: (0, 0, 1),
+    glfw.KEY_D: (1, 0, 0),
+    glfw.KEY_Q: (0, -1, 0),
+    glfw.KEY_E: (0, 1, 0),
+}
+
+class SimulationState:
+    def __init__(self, time: float, camera_position: glm.vec3, camera_orientation: glm.vec3, light_positions: list[glm.vec3], light_intensities: list[float], input_time: float = None):
+        self.time = time
+        self.camera_position = camera_position
+        self.camera_orientation = camera_orientation
+        self.light_positions = light_positions
+        self.light_intensities = light_intensities
+        self.input_time = input_time
+
+    def interpolate(self, other: 'SimulationState', alpha: float) -> 'SimulationState':
+        return SimulationState(
+            self.time + (other.time - self.time) * alpha,
+            glm.mix(self.camera_position, other.camera_position, alpha),
+            glm.mix(self.camera_orientation, other.camera_orientation, alpha),
+            [glm.mix(a, b, alpha) for (a, b) in zip(self.light_positions, other.light_positions)],
+            [a + (b - a) * alpha for (a, b) in zip(self.light_intensities, other.light_intensities)],
+            other.input_time)
+
+    def apply(self, scene: Scene):
+        scene.time = self.time
+        scene.camera.position = glm.vec3(self.camera_position)
+        scene.camera.orientation = glm.vec3(self.camera_orientation)
+        for (light, position, intensity) in zip(scene.lights, self.light_positions, self.light_intensities):
+            if light.position != position:
+                light.position = glm.vec3(position)
+                light.need_shadow_render = True
+            light.intensity = intensity
+
+class Simulation:
+    def __init__(self, scene: Scene, input_controller: 'InputController', tick_rate: float = 120):
+        self.input_controller = input_controller
+        self.step_time = 1 / tick_rate
+        self.camera_position = glm.vec3(scene.camera.position)
+        self.camera_orientation = glm.vec3(scene.camera.orientation)
+        self.camera_velocity = glm.vec3(scene.camera.velocity)
+        self.light_positions = [glm.vec3(light.position) for light in scene.lights]
+        self.light_intensities = [light.intensity for light in scene.lights]
+        self.next_step_time = None
+        self.lock = threading.Lock()
+        self.previous = self.current = self.snapshot(0, None)
+
+    def snapshot(self, time: float, input_time: float) -> SimulationState:
+        return SimulationState(time, glm.vec3(self.camera_position), glm.vec3(self.camera_orientation), [glm.vec3(position) for position in self.light_positions], list(self.light_intensities), input_time)
+
+    def advance(self, now: float):
+        if self.next_step_time is None:
+            self.next_step_time = now
+        if now - self.next_step_time > MAX_CATCH_UP_STEPS * self.step_time:
+            self.next_step_time = now - MAX_CATCH_UP_STEPS * self.step_time
+
+        while self.next_step_time <= now:
+            (keys, mouse_delta, input_time) = self.input_controller.take()
+            self.step(self.step_time, keys, mouse_delta)
+            state = self.snapshot(self.next_step_time, input_time or self.current.input_time)
+            with self.lock:
+                (self.previous, self.current) = (self.current, state)
+            self.next_step_time += self.step_time
+
+    def interpolate(self, now: float) -> SimulationState:
+        # Rendering runs one step behind the simulation so there are always two states to blend
+        with self.lock:
+            (previous, current) = (self.previous, self.current)
+        alpha = min(max((now - current.time) / self.step_time, 0), 1)
+        return previous.interpolate(current, alpha)
+
+    def step(self, delta_time: float, keys: frozenset, mouse_delta: tuple):
+        rotate_speed = 0.05
+        self.camera_orientation += rotate_speed * glm.vec3(mouse_delta[1], mouse_delta[0], 0)
+        self.camera_orientation.x = min(max(self.camera_orientation.x, -45), 45)
+
+        light_dirs = glm.vec3()
+        for key in LIGHT_KEYS:
+            if key in keys:
+                light_dirs = light_dirs + glm.vec3(*LIGHT_KEYS[key])
+
+        light_velocity = 3.0
+        self.light_positions[0] = self.light_positions[0] + light_dirs * light_velocity * delta_time
+
+        light_intensity_velocity = 500
+        for key in LIGHT_INTENSITY_KEYS:
+            if key in keys:
+                self.light_intensities[0] += LIGHT_INTENSITY_KEYS[key] * light_intensity_velocity * delta_time
+                self.light_intensities[0] = max(self.light_intensities[0], 0)
+
+        dirs = glm.vec3()
+        accel = 15.0
+        for key in CAMERA_KEYS:
+            if key in keys:
+                dirs = dirs + glm.vec3(*CAMERA_KEYS[key])
+        accel_vector = accel * dirs
+
+        matrix = glm.mat4()
+        matrix = matrix * glm.rotate(math.radians(self.camera_orientation.y), glm.vec3(0, 1, 0))
+
+        drag = 15.0
+        drag_vector = matrix * (-self.camera_velocity * drag)
+
+        if accel_vector.x == 0: accel_vector.x = drag_vector.x
+        if accel_vector.y == 0: accel_vector.y = drag_vector.y
+        if accel_vector.z == 0: accel_vector.z = drag_vector.z
+
+        matrix = glm.mat4()
+        matrix = matrix * glm.rotate(math.radians(-self.camera_orientation.y), glm.vec3(0, 1, 0))
+
+        self.camera_velocity += matrix * (accel_vector * delta_time)
+        max_velocity = 7.0
+        if glm.length(self.camera_velocity) > max_velocity:
+            self.camera_velocity = glm.normalize(self.camera_velocity)
+            self.camera_velocity *= max_velocity
+        self.camera_position += self.camera_velocity * delta_time
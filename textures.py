@@ -0,0 +1,167 @@
+from OpenGL import GL
+from PIL import Image
+
+from collections import deque
+from concurrent.futures import Executor
+
+import time
+import numpy as np
+
+# Textures start out with only the mips no larger than this resident
+BASE_SIZE = 64
+# Finer levels uploaded per frame, each one also regenerates its coarser mips on the GPU
+UPLOADS_PER_FRAME = 2
+# Drivers pad RGB8 to four bytes per texel
+BYTES_PER_TEXEL = 4
+LATENCY_SAMPLES = 64
+
+def build_mips(pixels: np.ndarray) -> list[np.ndarray]:
+    # CPU copies of every level down to BASE_SIZE, the coarser ones are generated on the GPU
+    mips = [pixels]
+    image = Image.fromarray(pixels)
+    while max(image.width, image.height) > BASE_SIZE:
+        image = image.resize((max(image.width // 2, 1), max(image.height // 2, 1)), Image.BOX)
+        mips.append(np.asarray(image))
+    return mips
+
+def chain_bytes(width: int, height: int) -> int:
+    total = 0
+    while True:
+        total += width * height * BYTES_PER_TEXEL
+        if width == 1 and height == 1:
+            return total
+        (width, height) = (max(width // 2, 1), max(height // 2, 1))
+
+class StreamedTexture:
+    def __init__(self, mips: list[np.ndarray], sampler: tuple):
+        self.mips = mips
+        self.sampler = sampler
+        self.texture = 0
+        self.level = None
+        self.wanted = self.base_level
+        self.last_used = -1
+        self.request_time = None
+        self.pending = None
+        self.chain_bytes = [chain_bytes(mip.shape[1], mip.shape[0]) for mip in mips]
+        self.upload(self.base_level, np.ascontiguousarray(mips[-1]))
+
+    @property
+    def base_level(self) -> int:
+        return len(self.mips) - 1
+
+    def level_bytes(self, level: int) -> int:
+        return self.chain_bytes[level]
+
+    @property
+    def resident_bytes(self) -> int:
+        return self.chain_bytes[self.level]
+
+    @property
+    def committed_bytes(self) -> int:
+        # Levels already being read count against the budget before they are uploaded
+        return self.chain_bytes[self.pending[0]] if self.pending is not None else self.resident_bytes
+
+    def upload(self, level: int, pixels: np.ndarray):
+        # A new texture whose top is the chosen mip, so coarser levels never hold memory for finer ones
+        (height, width) = pixels.shape[:2]
+        (min_filter, mag_filter, wrap_s, wrap_t) = self.sampler
+        texture = GL.glGenTextures(1)
+        GL.glBindTexture(GL.GL_TEXTURE_2D, texture)
+        GL.glPixelStorei(GL.GL_UNPACK_ALIGNMENT, 1)
+        GL.glTexImage2D(GL.GL_TEXTURE_2D, 0, GL.GL_RGB, width, height, 0, GL.GL_RGB, GL.GL_UNSIGNED_BYTE, pixels)
+        GL.glPixelStorei(GL.GL_UNPACK_ALIGNMENT, 4)
+        GL.glGenerateMipmap(GL.GL_TEXTURE_2D)
+        GL.glTexParameteri(GL.GL_TEXTURE_2D, GL.GL_TEXTURE_MIN_FILTER, min_filter)
+        GL.glTexParameteri(GL.GL_TEXTURE_2D, GL.GL_TEXTURE_MAG_FILTER, mag_filter)
+        GL.glTexParameteri(GL.GL_TEXTURE_2D, GL.GL_TEXTURE_WRAP_S, wrap_s)
+        GL.glTexParameteri(GL.GL_TEXTURE_2D, GL.GL_TEXTURE_WRAP_T, wrap_t)
+        GL.glBindTexture(GL.GL_TEXTURE_2D, 0)
+        if self.texture:
+            GL.glDeleteTextures([self.texture])
+        self.texture = texture
+        self.level = level
+
+class TextureStreamer:
+    def __init__(self, executor: Executor, budget: int):
+        self.executor = executor
+        self.budget = budget
+        self.textures = []
+        self.frame = 0
+        self.latencies = deque(maxlen=LATENCY_SAMPLES)
+        self.uploads = 0
+        self.evictions = 0
+
+    def register(self, textures: list[StreamedTexture]):
+        # Textures shared between objects are only streamed once
+        self.textures += [texture for texture in dict.fromkeys(textures) if all(texture is not other for other in self.textures)]
+
+    @property
+    def resident_bytes(self) -> int:
+        return sum(texture.resident_bytes for texture in self.textures)
+
+    @property
+    def latency(self) -> float:
+        return sum(self.latencies) / len(self.latencies) if self.latencies else 0
+
+    def request(self, texture: StreamedTexture, level: int):
+        level = min(max(level, 0), texture.base_level)
+        if texture.last_used != self.frame:
+            texture.wanted = level
+        else:
+            texture.wanted = min(texture.wanted, level)
+        texture.last_used = self.frame
+        if texture.wanted < texture.level and texture.request_time is None:
+            texture.request_time = time.perf_counter()
+
+    def make_room(self, texture: StreamedTexture, level: int) -> bool:
+        committed = sum(other.committed_bytes for other in self.textures)
+        needed = committed + texture.level_bytes(level) - texture.committed_bytes - self.budget
+        if needed <= 0:
+            return True
+
+        # Least recently used textures drop back to their base level, ones drawn last frame are kept
+        victims = [victim for victim in self.textures if victim is not texture and victim.committed_bytes > victim.level_bytes(victim.base_level) and victim.last_used < self.frame - 1]
+        victims.sort(key=lambda victim: victim.last_used)
+        for victim in victims:
+            if needed <= 0:
+                break
+            needed -= victim.committed_bytes - victim.level_bytes(victim.base_level)
+            victim.upload(victim.base_level, np.ascontiguousarray(victim.mips[-1]))
+            victim.pending = None
+            victim.request_time = None
+            self.evictions += 1
+        return needed <= 0
+
+    def update(self):
+        uploads = 0
+        for texture in self.textures:
+            if texture.pending is None or not texture.pending[1].done() or uploads == UPLOADS_PER_FRAME:
+                continue
+            (level, future) = texture.pending
+            texture.pending = None
+            if level >= texture.level:
+                continue
+            texture.upload(level, future.result())
+            uploads += 1
+            self.uploads += 1
+            if texture.request_time is not None:
+                # Measured per upload, a texture held back by the budget keeps counting from its last one
+                now = time.perf_counter()
+                self.latencies.append(now - texture.request_time)
+                texture.request_time = None if texture.level <= texture.wanted else now
+
+        # Recently used textures with the largest shortfall stream first
+        wanting = [texture for texture in self.textures if texture.pending is None and texture.last_used == self.frame and texture.wanted < texture.level]
+        wanting.sort(key=lambda texture: (-texture.last_used, texture.wanted - texture.level))
+        for texture in wanting:
+            level = texture.wanted
+            while level < texture.level and not self.make_room(texture, level):
+                level += 1
+            if level < texture.level:
+                # Reading the level from the memory mapped cache happens on a loader thread
+                texture.pending = (level, self.executor.submit(np.ascontiguousarray, texture.mips[level]))
+        self.frame += 1
+
+    def report(self) -> str:
+        return 'Textures: %.1fMB resident of %.1fMB budget, %i uploads, %i evictions, streaming latency %.1fms' % (
+            self.resident_bytes / (1 << 20), self.budget / (1 << 20), self.uploads, self.evictions, self.latency * 1000)
@@ -0,0 +1,123 @@
+from glstate import GLState
+
+from OpenGL import GL
+
+import ctypes
+import glm
+import numpy as np
+
+# Must match the block declarations in shaders/*.vert and shaders/main.frag
+FRAME_BINDING = 1
+MATERIALS_BINDING = 2
+MAX_MATERIALS = 512
+
+# std140 Frame block: projection and view matrices, then the camera position
+FRAME_BLOCK_SIZE = 144
+# std140 Material struct: base color, then x set when the material samples a texture
+MATERIAL_SIZE = 32
+
+# Frames the CPU may run ahead before a ring slot is written again
+RING_FRAMES = 3
+
+def matrix_columns(matrix: glm.mat4) -> np.ndarray:
+    # std140 matrices are column major
+    return np.array(matrix, np.float32).T.ravel()
+
+def frame_block(projection_transform: glm.mat4, view_transform: glm.mat4, camera_position: glm.vec3 = None) -> np.ndarray:
+    block = np.zeros(FRAME_BLOCK_SIZE // 4, np.float32)
+    block[:16] = matrix_columns(projection_transform)
+    block[16:32] = matrix_columns(view_transform)
+    if camera_position is not None:
+        block[32:35] = camera_position.to_list()
+    return block
+
+def material_block(materials: list[tuple]) -> np.ndarray:
+    block = np.zeros((len(materials), MATERIAL_SIZE // 4), np.float32)
+    for (i, (texture, base_color)) in enumerate(materials):
+        block[i, :3] = base_color
+        block[i, 4] = texture is not None
+    return block
+
+class UniformRing:
+    def __init__(self, block_size: int, blocks_per_frame: int, frames: int = RING_FRAMES):
+        self.block_size = block_size
+        self.blocks_per_frame = blocks_per_frame
+        self.frames = frames
+        self.frame = 0
+        self.cursor = 0
+        self.fences = [None] * frames
+        self.writes = 0
+
+    def init_gl(self):
+        alignment = int(GL.glGetIntegerv(GL.GL_UNIFORM_BUFFER_OFFSET_ALIGNMENT))
+        self.stride = (self.block_size + alignment - 1) // alignment * alignment
+        self.size = self.stride * self.blocks_per_frame * self.frames
+
+        major = GL.glGetIntegerv(GL.GL_MAJOR_VERSION)
+        minor = GL.glGetIntegerv(GL.GL_MINOR_VERSION)
+        self.persistent = (int(major), int(minor)) >= (4, 4)
+
+        self.buffer = GL.glGenBuffers(1)
+        GL.glBindBuffer(GL.GL_UNIFORM_BUFFER, self.buffer)
+        if self.persistent:
+            # Mapped once for the lifetime of the buffer, writes are plain memory copies
+            flags = GL.GL_MAP_WRITE_BIT | GL.GL_MAP_PERSISTENT_BIT | GL.GL_MAP_COHERENT_BIT
+            GL.glBufferStorage(GL.GL_UNIFORM_BUFFER, self.size, None, flags)
+            self.pointer = ctypes.c_void_p(GL.glMapBufferRange(GL.GL_UNIFORM_BUFFER, 0, self.size, flags)).value
+        else:
+            GL.glBufferData(GL.GL_UNIFORM_BUFFER, self.size, None, GL.GL_STREAM_DRAW)
+        GL.glBindBuffer(GL.GL_UNIFORM_BUFFER, 0)
+
+    def begin_frame(self):
+        self.frame = (self.frame + 1) % self.frames
+        self.cursor = 0
+        self.writes = 0
+        # The slot was last written RING_FRAMES frames ago, normally the GPU finished with it long since
+        fence = self.fences[self.frame]
+        if fence is not None:
+            GL.glClientWaitSync(fence, GL.GL_SYNC_FLUSH_COMMANDS_BIT, 1000000000)
+            GL.glDeleteSync(fence)
+            self.fences[self.frame] = None
+
+    def end_frame(self):
+        if self.persistent:
+            self.fences[self.frame] = GL.glFenceSync(GL.GL_SYNC_GPU_COMMANDS_COMPLETE, 0)
+
+    def write(self, data: np.ndarray) -> int:
+        if self.cursor == self.blocks_per_frame:
+            raise RuntimeError('Uniform ring holds %i blocks per frame' % self.blocks_per_frame)
+        offset = (self.frame * self.blocks_per_frame + self.cursor) * self.stride
+        self.cursor += 1
+        self.writes += 1
+        if self.persistent:
+            ctypes.memmove(self.pointer + offset, data.ctypes.data, data.nbytes)
+        else:
+            GL.glBindBuffer(GL.GL_UNIFORM_BUFFER, self.buffer)
+            GL.glBufferSubData(GL.GL_UNIFORM_BUFFER, offset, data.nbytes, data)
+            GL.glBindBuffer(GL.GL_UNIFORM_BUFFER, 0)
+        return offset
+
+    def bind(self, binding: int, offset: int):
+        GL.glBindBufferRange(GL.GL_UNIFORM_BUFFER, binding, self.buffer, offset, self.block_size)
+
+    def push(self, binding: int, data: np.ndarray):
+        self.bind(binding, self.write(data))
+
+class MaterialBuffer:
+    def __init__(self, materials: list[tuple]):
+        block = material_block(materials)
+        self.count = len(materials)
+        self.buffer = GL.glGenBuffers(1)
+        GL.glBindBuffer(GL.GL_UNIFORM_BUFFER, self.buffer)
+        # Padded to a whole window so the last range bound is always complete
+        windows = (self.count + MAX_MATERIALS - 1) // MAX_MATERIALS
+        GL.glBufferData(GL.GL_UNIFORM_BUFFER, windows * MAX_MATERIALS * MATERIAL_SIZE, None, GL.GL_STATIC_DRAW)
+        GL.glBufferSubData(GL.GL_UNIFORM_BUFFER, 0, block.nbytes, block)
+        GL.glBindBuffer(GL.GL_UNIFORM_BUFFER, 0)
+
+    def bind(self, state: GLState, material: int) -> int:
+        # Models with more materials than a block holds bind the window containing this one
+        window = material // MAX_MATERIALS
+        size = MAX_MATERIALS * MATERIAL_SIZE
+        state.bind_uniform_buffer(MATERIALS_BINDING, self.buffer, window * size, size)
+        return material - window * MAX_MATERIALS